@@ -0,0 +1,306 @@
+"""
+Arrow path from the time-series data in the feature store to the model
+input.
+
+The store read is kept as an Arrow table (through polars, in
+requirements.txt, which hsfs can return and which converts to Arrow
+without a copy), and filtered with Arrow compute. The rides of the rows left are scattered into the
+(locations x lags) lag matrix, in one contiguous float32 buffer, so the
+store only needs the rows with rides (see `src.data.get_sparse_ts_data`).
+`src.model.predict_features` builds the model input from it in one
+float32 array, that the booster reads directly.
+
+Run the benchmark of this path against the pandas one with:
+
+    python -m src.arrow_features
+"""
+import time
+from datetime import datetime
+from typing import Callable, Optional, Sequence, Tuple, TYPE_CHECKING
+
+import numpy as np
+import pandas as pd
+
+import src.config as config
+from src.hours import from_hour_index, to_hour_index
+
+if TYPE_CHECKING:
+    import pyarrow as pa
+
+
+def read_arrow(read: Callable, **kwargs) -> "pa.Table":
+    """
+    Calls an hsfs read method (`FeatureView.get_batch_data`, `Query.read`)
+    and returns its data as an Arrow table, through polars. Older hsfs
+    versions without polars support fall back to converting the pandas
+    DataFrame, which copies the data once
+    """
+    import pyarrow as pa
+
+    try:
+        data = read(dataframe_type='polars', **kwargs)
+    except (TypeError, ImportError):
+        # hsfs without `dataframe_type`, or polars not installed
+        data = read(**kwargs)
+
+    if isinstance(data, pa.Table):
+        return data
+    if hasattr(data, 'to_arrow'):
+        return data.to_arrow()
+    return pa.Table.from_pandas(data, preserve_index=False)
+
+
+def get_lag_matrix(ts_data: "pa.Table",
+                   current_date: datetime,
+                   lags: Optional[Sequence[int]] = None,
+                   n_features: int = config.N_FEATURES,
+                   location_ids: Optional[np.ndarray] = None
+                   ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Lag matrix to predict `current_date`, from time-series data as an Arrow
+    table.
+
+    The rows of the `lags` hours are filtered with Arrow compute, and their
+    rides scattered into a zero matrix, so (location, hour) slots the store
+    does not have, as in sparse time-series data, count as 0 rides.
+
+    Args:
+        ts_data (pa.Table): columns `pickup_hour`, `pickup_location_id` and
+            `rides`, covering the `lags` hours before `current_date`
+        current_date (datetime): hour to predict
+        lags (Optional[Sequence[int]]): lags (in hours) to read, see
+            `src.model.get_model_lags`. All `n_features` lags if None
+        n_features (int): largest lag
+        location_ids (Optional[np.ndarray]): locations to predict. The ones
+            with rides in the `lags` hours if None
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]:
+            - float32 (locations x lags) matrix, C-contiguous
+            - lags of its columns, from the most to the least distant
+            - pickup_location_id of its rows, sorted
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if lags is None:
+        lags = range(n_features, 0, -1)
+    lags = np.array(sorted(set(lags), reverse=True))
+
+    # the hours of the lags, in the type of the column, so the lookups run
+    # on the timestamps as read, without converting them. Arrow timestamps
+    # are UTC, tz-aware or not
+    pickup_hour = ts_data['pickup_hour']
+    lag_hours = pa.array(from_hour_index(to_hour_index(current_date) - lags)).cast(pickup_hour.type)
+
+    # the lag hours are in ascending order, as the columns, so the position
+    # of a row's hour among them is its column
+    columns = pc.index_in(pickup_hour, value_set=lag_hours)
+
+    location_id = ts_data['pickup_location_id']
+    if location_ids is None:
+        location_ids = pc.unique(location_id.filter(pc.is_valid(columns))).to_numpy()
+    location_ids = np.unique(np.asarray(location_ids))
+    rows = pc.index_in(location_id, value_set=pa.array(location_ids).cast(location_id.type))
+
+    # one filter, of the 3 columns the scatter reads
+    is_in_grid = pc.and_(pc.is_valid(columns), pc.is_valid(rows))
+    rows, columns, rides = (pc.filter(array, is_in_grid).to_numpy()
+                            for array in (rows, columns, pc.cast(ts_data['rides'], pa.float32())))
+
+    lag_values = np.zeros((len(location_ids), len(lags)), dtype=np.float32)
+    lag_values[rows, columns] = rides
+
+    return lag_values, lags, location_ids
+
+
+def load_lag_matrix_from_store(current_date: datetime,
+                               lags: Optional[Sequence[int]] = None,
+                               n_features: int = config.N_FEATURES,
+                               location_ids: Optional[np.ndarray] = None
+                               ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Reads the time-series data needed to predict `current_date` as an Arrow
+    table, and returns its `get_lag_matrix`.
+
+    With all lags, the feature view is read for the last `n_features`
+    hours. With a lag subset, only the pickup_hours of those lags are read
+    from the feature group, so pass the `location_ids` to predict (e.g. the
+    online buffer's) to keep the locations without rides in those hours.
+    """
+    from src.feature_store_api import get_feature_store
+
+    if lags is None:
+        lags = range(n_features, 0, -1)
+    lags = np.array(sorted(set(lags), reverse=True))
+    current_hour = to_hour_index(current_date)
+    feature_store = get_feature_store()
+
+    if len(lags) == n_features:
+        print('Fetching all available data from feature store')
+        feature_view = feature_store.get_feature_view(
+            name=config.FEATURE_VIEW_NAME,
+            version=config.FEATURE_VIEW_VERSION
+        )
+        # one day of margin on both sides, as the store filters on event time
+        ts_data = read_arrow(
+            feature_view.get_batch_data,
+            start_time=from_hour_index(current_hour - n_features - 24),
+            end_time=from_hour_index(current_hour - 1 + 24)
+        )
+    else:
+        print(f'Fetching {len(lags)} lags from feature store')
+        feature_group = feature_store.get_feature_group(
+            name=config.FEATURE_GROUP_NAME,
+            version=config.FEATURE_GROUP_VERSION
+        )
+        pickup_hours = list(from_hour_index(current_hour - lags))
+        ts_data = read_arrow(feature_group.filter(feature_group.pickup_hour.isin(pickup_hours)).read)
+
+    return get_lag_matrix(ts_data, current_date, lags, n_features, location_ids)
+
+
+def _get_features_with_pandas(ts_data: pd.DataFrame,
+                              current_date: datetime,
+                              n_features: int = config.N_FEATURES) -> pd.DataFrame:
+    """
+    The pandas path `load_batch_of_features_from_store` followed before,
+    kept as the baseline of `benchmark_feature_paths`
+    """
+    current_hour = to_hour_index(current_date)
+    hour_index = to_hour_index(ts_data['pickup_hour'])
+    ts_data = ts_data[(hour_index >= current_hour - n_features) & (hour_index < current_hour)]
+
+    location_ids = ts_data['pickup_location_id'].unique()
+    ts_data = ts_data.sort_values(by=['pickup_location_id', 'pickup_hour'])
+
+    x = np.ndarray(shape=(len(location_ids), n_features), dtype=np.float32)
+    for i, location_id in enumerate(location_ids):
+        ts_data_i = ts_data.loc[ts_data.pickup_location_id == location_id, :]
+        ts_data_i = ts_data_i.sort_values(by=['pickup_hour'])
+        x[i, :] = ts_data_i['rides'].values
+
+    features = pd.DataFrame(
+        x,
+        columns=[f'rides_previous_{i+1}_hour' for i in reversed(range(n_features))]
+    )
+    features['pickup_hour'] = current_date
+    features['pickup_location_id'] = location_ids
+    features.sort_values(by=['pickup_location_id'], inplace=True)
+
+    return features
+
+
+def _measure_allocations(run: Callable[[], object]) -> dict:
+    """
+    Runs `run` once, tracing the memory numpy and pandas allocate
+    (tracemalloc) and the allocations of Arrow's memory pool, which
+    tracemalloc does not see. tracemalloc only reports the peak, Arrow's
+    pool also the total allocated
+    """
+    import tracemalloc
+
+    import pyarrow as pa
+
+    default_pool = pa.default_memory_pool()
+    pool = pa.proxy_memory_pool(default_pool)
+    pa.set_memory_pool(pool)
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+        _, python_peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        pa.set_memory_pool(default_pool)
+
+    return {
+        'seconds': seconds,
+        'python_peak_bytes': python_peak_bytes,
+        'arrow_peak_bytes': pool.max_memory(),
+        'arrow_allocations': pool.num_allocations(),
+        'arrow_bytes_allocated': pool.total_bytes_allocated(),
+    }
+
+
+def benchmark_feature_paths(ts_data: pd.DataFrame,
+                            current_date: datetime,
+                            model,
+                            n_runs: int = 3) -> pd.DataFrame:
+    """
+    Compares one inference run (lag matrix and predictions for
+    `current_date`) on the pandas path and on the Arrow path, from the same
+    store read: a DataFrame for the former, an Arrow table for the latter.
+
+    Args:
+        ts_data (pd.DataFrame): time-series data covering the N_FEATURES
+            hours before `current_date`
+        current_date (datetime): hour to predict
+        model: fitted `get_pipeline` pipeline on all lags
+        n_runs (int): runs per path. The report keeps the fastest one
+
+    Returns:
+        pd.DataFrame: one row per path, with
+            - seconds
+            - python_peak_bytes: peak memory allocated by numpy and pandas
+            - arrow_peak_bytes, arrow_allocations, arrow_bytes_allocated:
+              in Arrow's memory pool
+            - lag_matrix_copies: peak bytes of both, in units of the
+              float32 lag matrix, i.e. the copies of the data the path
+              holds at once on its way to the model
+            - max_abs_diff: of the predictions, against the pandas path
+    """
+    import pyarrow as pa
+
+    from src.model import get_features_from_lag_matrix, predict_features
+
+    table = pa.Table.from_pandas(ts_data, preserve_index=False)
+    predictions = {}
+
+    def _pandas_path():
+        features = _get_features_with_pandas(ts_data.copy(), current_date)
+        predictions['pandas'] = model.predict(features)
+
+    def _arrow_path():
+        lag_values, lags, location_ids = get_lag_matrix(table, current_date)
+        features = get_features_from_lag_matrix(lag_values, lags, location_ids, current_date)
+        predictions['arrow'] = predict_features(model, features)
+
+    rows = {}
+    for name, run in [('pandas', _pandas_path), ('arrow', _arrow_path)]:
+        runs = [_measure_allocations(run) for _ in range(n_runs)]
+        rows[name] = min(runs, key=lambda r: r['seconds'])
+
+    report = pd.DataFrame.from_dict(rows, orient='index')
+    n_locations = ts_data['pickup_location_id'].nunique()
+    lag_matrix_bytes = n_locations * config.N_FEATURES * np.dtype(np.float32).itemsize
+    report['lag_matrix_copies'] = (
+        (report['python_peak_bytes'] + report['arrow_peak_bytes']) / lag_matrix_bytes)
+    report['max_abs_diff'] = [
+        float(np.abs(predictions[name] - predictions['pandas']).max()) for name in report.index]
+
+    return report
+
+
+if __name__ == '__main__':
+    # synthetic data in the shape of the production feature view: 265
+    # locations, 4 weeks of hours, and a small model trained on it
+    from src.data import transform_ts_data_into_features_and_target
+    from src.model import get_pipeline
+
+    rng = np.random.default_rng(0)
+    n_locations, n_hours = 265, config.N_FEATURES + 24 * 7
+    pickup_hours = pd.date_range('2024-01-01', periods=n_hours, freq='h', tz='UTC')
+    ts_data = pd.DataFrame({
+        'pickup_hour': np.tile(pickup_hours, n_locations),
+        'pickup_location_id': np.repeat(np.arange(1, n_locations + 1), n_hours),
+        'rides': rng.poisson(10, n_locations * n_hours).astype(np.int64),
+    })
+
+    features, target = transform_ts_data_into_features_and_target(
+        ts_data, input_seq_len=config.N_FEATURES, step_size=24)
+    model = get_pipeline(n_estimators=50, verbose=-1).fit(features, target)
+
+    current_date = pickup_hours[-1] + pd.Timedelta(hours=1)
+    print(benchmark_feature_paths(ts_data, current_date, model).to_string())
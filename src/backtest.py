@@ -0,0 +1,198 @@
+"""
+Rolling-origin backtesting over one windowed (features, target) matrix
+"""
+import hashlib
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from src.data_split import iter_fold_views
+from src.hours import hour_of_week, to_hour_index
+from src.paths import MODELS_DIR
+
+BACKTEST_MODELS_DIR = MODELS_DIR / 'backtest'
+
+
+def get_forecast_origins(from_date: datetime,
+                         to_date: datetime,
+                         every: timedelta = timedelta(days=7)) -> List[pd.Timestamp]:
+    """Forecast origins from `from_date` to `to_date` (inclusive), every `every`"""
+    return list(pd.date_range(from_date, to_date, freq=pd.Timedelta(every)))
+
+
+def _get_row_hashes(features: pd.DataFrame, targets: pd.Series) -> np.ndarray:
+    """
+    (rows x 2) uint64 hashes of the contents of each row of `features` and
+    `targets`, computed once per backtest, so each fold key covers the data
+    its model is trained on
+    """
+    return np.column_stack([
+        pd.util.hash_pandas_object(features, index=False).to_numpy(),
+        pd.util.hash_pandas_object(targets, index=False).to_numpy(),
+    ])
+
+
+def _fold_key(model_name: str,
+              origin: pd.Timestamp,
+              horizon: timedelta,
+              train_hashes: np.ndarray) -> str:
+    """
+    Hash that identifies the model trained for one fold: the model, the
+    origin and horizon, and the contents of its training rows, so models
+    are retrained when the features or targets are rebuilt
+    """
+    key = f'{model_name}|{origin.isoformat()}|{pd.Timedelta(horizon).isoformat()}|' \
+          f'{len(train_hashes)}'
+    digest = hashlib.sha1(key.encode())
+    digest.update(np.ascontiguousarray(train_hashes))
+    return digest.hexdigest()[:16]
+
+
+def _run_fold(model_fn: Callable,
+              origin: pd.Timestamp,
+              X_train: pd.DataFrame,
+              y_train: pd.Series,
+              X_test: pd.DataFrame,
+              y_test: pd.Series,
+              model_path: Optional[Path]) -> pd.DataFrame:
+    """
+    Fits (or loads from `model_path`) the model for one origin, and
+    predicts its test rows. The splits are views of the backtest's frame
+    """
+    import joblib
+
+    if model_path is not None and model_path.exists():
+        model = joblib.load(model_path)
+    else:
+        model = model_fn()
+        model.fit(X_train, y_train)
+        if model_path is not None:
+            joblib.dump(model, model_path)
+
+    return pd.DataFrame({
+        'origin': origin,
+        'pickup_hour': X_test['pickup_hour'].to_numpy(),
+        'pickup_location_id': X_test['pickup_location_id'].to_numpy(),
+        'target': y_test.to_numpy(),
+        'prediction': np.asarray(model.predict(X_test)),
+    })
+
+
+def run_backtest(features: pd.DataFrame,
+                 targets: pd.Series,
+                 origins: List[datetime],
+                 model_fn: Callable,
+                 model_name: str,
+                 horizon: timedelta = timedelta(days=7),
+                 train_window: Optional[timedelta] = None,
+                 gap: timedelta = timedelta(hours=0),
+                 n_jobs: int = 4,
+                 cache_dir: Optional[Path] = BACKTEST_MODELS_DIR) -> pd.DataFrame:
+    """
+    Evaluates a model over many forecast origins. For each origin, the model
+    is trained on the rows with pickup_hour < origin - gap (and >=
+    origin - gap - train_window, if given), and predicts the rows with
+    origin <= pickup_hour < origin + horizon.
+
+    `features` and `targets` are built once, e.g. with
+    `transform_ts_data_into_features_and_target`, and sorted by time (one
+    copy, only if they are not sorted yet). Every fold is then a contiguous
+    block of rows, passed to the model as views (see
+    `src.data_split.iter_fold_views`), so no data is copied per origin.
+
+    Args:
+        features (pd.DataFrame): model inputs, with `pickup_hour` and
+            `pickup_location_id` columns
+        targets (pd.Series): target values aligned with `features`
+        origins (List[datetime]): forecast origins
+        model_fn (Callable): returns a new unfitted model, with
+            `fit(X, y)` and `predict(X)`, e.g. `lambda: get_pipeline(**params)`
+        model_name (str): name that identifies `model_fn` and its
+            hyper-parameters in the model cache
+        horizon (timedelta): length of each test period
+        train_window (Optional[timedelta]): length of the training period.
+            None means an expanding window from the start of the data
+        gap (timedelta): time between the end of training and the origin
+        n_jobs (int): folds trained in parallel. Threads are used, so the
+            (large) feature matrix is shared and LightGBM runs without the GIL
+        cache_dir (Optional[Path]): where fitted models are cached per fold,
+            keyed by the model name, origin, horizon and the contents of the
+            training rows. None disables the cache
+
+    Returns:
+        pd.DataFrame: one row per test prediction, with columns `origin`,
+        `pickup_hour`, `pickup_location_id`, `target` and `prediction`
+    """
+    import joblib
+
+    # sorted by time, so every fold is a contiguous block of rows
+    pickup_hours = to_hour_index(features['pickup_hour'])
+    if np.any(pickup_hours[1:] < pickup_hours[:-1]):
+        order = np.argsort(pickup_hours, kind='stable')
+        features, targets, pickup_hours = features.iloc[order], targets.iloc[order], pickup_hours[order]
+
+    row_hashes = None
+    if cache_dir is not None:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        row_hashes = _get_row_hashes(features, targets)
+
+    def _position(t: datetime) -> int:
+        return int(np.searchsorted(pickup_hours, to_hour_index(t), side='left'))
+
+    folds = []
+    for origin in origins:
+        origin = pd.Timestamp(origin)
+        train_end = _position(origin - gap)
+        train_start = 0 if train_window is None else _position(origin - gap - train_window)
+        test_start, test_end = _position(origin), _position(origin + horizon)
+
+        if train_end <= train_start or test_end <= test_start:
+            print(f'Skipping origin {origin}: not enough data')
+            continue
+        folds.append((origin, slice(train_start, train_end), slice(test_start, test_end)))
+
+    model_paths = [
+        None if cache_dir is None
+        else cache_dir / f'{_fold_key(model_name, origin, horizon, row_hashes[train_rows])}.pkl'
+        for origin, train_rows, _ in folds
+    ]
+    fold_views = iter_fold_views(features, targets, [(train, test) for _, train, test in folds])
+
+    print(f'Backtesting {model_name} over {len(folds)} origins')
+    results = joblib.Parallel(n_jobs=n_jobs, prefer='threads')(
+        joblib.delayed(_run_fold)(model_fn, origin, *views, model_path)
+        for (origin, _, _), views, model_path in zip(folds, fold_views, model_paths)
+    )
+
+    return pd.concat(results, ignore_index=True)
+
+
+def compute_backtest_metrics(results: pd.DataFrame, by: str) -> pd.DataFrame:
+    """
+    Aggregates backtest predictions into MAE and bias
+
+    Args:
+        results (pd.DataFrame): output of `run_backtest`
+        by (str): 'origin', 'pickup_location_id' or 'hour_of_week'
+
+    Returns:
+        pd.DataFrame: columns `by`, `mae`, `bias` and `n_obs`
+    """
+    error = results['prediction'].to_numpy() - results['target'].to_numpy()
+
+    if by == 'hour_of_week':
+        keys = hour_of_week(results['pickup_hour'])
+    else:
+        keys = results[by].to_numpy()
+
+    errors = pd.DataFrame({by: keys, 'abs_error': np.abs(error), 'error': error})
+    metrics = errors.groupby(by).agg(
+        mae=('abs_error', 'mean'),
+        bias=('error', 'mean'),
+        n_obs=('error', 'size'),
+    )
+
+    return metrics.reset_index()
@@ -0,0 +1,191 @@
+"""
+Scores a whole range of past hours at once, e.g. to backfill predictions for
+monitoring or to re-score history with a new model.
+
+The lag matrices of every hour in the range are strided windows over one
+dense (locations x hours) matrix, built from a single slice of time-series
+data, instead of one store read and pivot per hour
+"""
+from datetime import datetime, timedelta
+from typing import Iterator, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+import src.config as config
+from src.data import get_ts_matrix
+from src.hours import to_hour_index, to_utc
+
+
+def load_ts_range_from_store(from_hour: datetime,
+                             to_hour: datetime,
+                             n_features: int = config.N_FEATURES) -> pd.DataFrame:
+    """
+    Reads, in one call, the time-series data needed to predict every hour
+    in [from_hour, to_hour]: from `n_features` hours before `from_hour` up
+    to the hour before `to_hour`
+
+    Returns:
+        pd.DataFrame: columns `pickup_hour`, `pickup_location_id` and `rides`
+    """
+    from src.feature_store_api import get_feature_store
+
+    from_hour, to_hour = to_utc(pd.Timestamp(from_hour)), to_utc(pd.Timestamp(to_hour))
+    fetch_data_from = from_hour - timedelta(hours=n_features)
+    fetch_data_to = to_hour - timedelta(hours=1)
+
+    feature_view = get_feature_store().get_feature_view(
+        name=config.FEATURE_VIEW_NAME,
+        version=config.FEATURE_VIEW_VERSION
+    )
+    ts_data = feature_view.get_batch_data(
+        start_time=(fetch_data_from - timedelta(days=1)),
+        end_time=(fetch_data_to + timedelta(days=1))
+    )
+    pickup_hours = to_hour_index(ts_data['pickup_hour'])
+    keep = ((pickup_hours >= to_hour_index(fetch_data_from))
+            & (pickup_hours <= to_hour_index(fetch_data_to)))
+
+    return ts_data.loc[keep, ['pickup_hour', 'pickup_location_id', 'rides']]
+
+
+def iter_lag_features(ts_data: pd.DataFrame,
+                      from_hour: datetime,
+                      to_hour: datetime,
+                      lags: Optional[Sequence[int]] = None,
+                      batch_hours: int = 24,
+                      n_features: int = config.N_FEATURES) -> Iterator[pd.DataFrame]:
+    """
+    Yields the features of every (location, hour) in [from_hour, to_hour],
+    `batch_hours` hours at a time, in the same format as
+    `load_batch_of_features_from_store`.
+
+    (location, hour) slots missing in `ts_data` count as 0 rides, so it can
+    be the sparse time-series data the feature pipeline writes.
+
+    Args:
+        ts_data (pd.DataFrame): time-series data covering the `n_features`
+            hours before `from_hour` up to the hour before `to_hour`
+        from_hour (datetime): first hour to predict
+        to_hour (datetime): last hour to predict, included
+        lags (Optional[Sequence[int]]): lags (in hours) to build, see
+            `src.model.get_model_lags`. All `n_features` lags if None
+        batch_hours (int): hours per yielded batch. Each batch holds a
+            (locations * batch_hours, len(lags)) float32 matrix
+        n_features (int): largest lag
+
+    Yields:
+        pd.DataFrame: lag columns, from the most to the least distant,
+        `pickup_hour` and `pickup_location_id`, sorted by hour and location
+    """
+    from_hour, to_hour = to_utc(pd.Timestamp(from_hour)), to_utc(pd.Timestamp(to_hour))
+    first_hour = from_hour - timedelta(hours=n_features)
+    n_target_hours = (to_hour - from_hour) // timedelta(hours=1) + 1
+
+    # the grid starts exactly at `first_hour`, so window k (columns
+    # k ... k + n_features - 1) is the input of hour from_hour + k
+    grid, location_ids, _ = get_ts_matrix(ts_data,
+                                          from_hour=first_hour,
+                                          to_hour=to_hour - timedelta(hours=1))
+
+    # (locations, n_target_hours, n_features) view, without copying
+    windows = sliding_window_view(grid, n_features, axis=1)
+
+    if lags is None:
+        lags = range(n_features, 0, -1)
+    lags = np.array(sorted(set(lags), reverse=True))
+    columns = n_features - lags
+    column_names = [f'rides_previous_{lag}_hour' for lag in lags]
+
+    for start in range(0, n_target_hours, batch_hours):
+        end = min(start + batch_hours, n_target_hours)
+
+        # only the batch is materialized, hour-major then location
+        x = windows[:, start:end][:, :, columns].transpose(1, 0, 2).reshape(-1, len(lags))
+
+        features = pd.DataFrame(x, columns=column_names)
+        features['pickup_hour'] = pd.date_range(
+            from_hour + timedelta(hours=start), periods=end - start, freq='h'
+        ).repeat(len(location_ids))
+        features['pickup_location_id'] = np.tile(location_ids, end - start)
+
+        yield features
+
+
+def score_hour_range(model,
+                     ts_data: pd.DataFrame,
+                     from_hour: datetime,
+                     to_hour: datetime,
+                     batch_hours: int = 24) -> pd.DataFrame:
+    """
+    Predicts the demand of every location for every hour in
+    [from_hour, to_hour], with one model.predict per batch of hours.
+
+    Returns:
+        pd.DataFrame: columns `pickup_location_id`, `predicted_demand` and
+        `pickup_hour`, as written by the inference pipeline
+    """
+    from src.model import get_model_lags, predict_features
+
+    predictions = []
+    for features in iter_lag_features(ts_data, from_hour, to_hour,
+                                      lags=get_model_lags(model),
+                                      batch_hours=batch_hours):
+        predictions.append(pd.DataFrame({
+            'pickup_location_id': features['pickup_location_id'].to_numpy(),
+            'predicted_demand': predict_features(model, features).round(0),
+            'pickup_hour': features['pickup_hour'].array,
+        }))
+
+    if not predictions:
+        return pd.DataFrame(columns=['pickup_location_id', 'predicted_demand', 'pickup_hour'])
+
+    return pd.concat(predictions, ignore_index=True)
+
+
+def backfill_predictions(from_hour: datetime,
+                         to_hour: datetime,
+                         model=None,
+                         feature_group=None,
+                         batch_hours: int = 24) -> pd.DataFrame:
+    """
+    Scores every hour in [from_hour, to_hour] and writes the predictions to
+    the predictions feature group, in one bulk `delta_insert`.
+
+    Args:
+        from_hour (datetime): first hour to predict
+        to_hour (datetime): last hour to predict, included
+        model: trained model. Loaded from the model registry if None
+        feature_group: feature group to write to. The predictions feature
+            group if None, and then the predictions are also mirrored to
+            the local prediction store
+        batch_hours (int): hours scored per model.predict call
+
+    Returns:
+        pd.DataFrame: the predictions
+    """
+    from src.feature_store_api import delta_insert, get_or_create_feature_group
+
+    if model is None:
+        from src.inference_1 import load_model_from_registry
+        model = load_model_from_registry()
+
+    ts_data = load_ts_range_from_store(from_hour, to_hour)
+    predictions = score_hour_range(model, ts_data, from_hour, to_hour, batch_hours)
+
+    is_predictions_feature_group = feature_group is None
+    if is_predictions_feature_group:
+        feature_group = get_or_create_feature_group(
+            name=config.FEATURE_GROUP_MODEL_PREDICTIONS,
+            version=1,
+            description="Predictions generated by our production model",
+            primary_key=['pickup_location_id', 'pickup_hour'],
+            event_time='pickup_hour'
+        )
+    delta_insert(feature_group, predictions)
+    if is_predictions_feature_group:
+        from src.prediction_store import mirror_predictions
+        mirror_predictions(predictions)
+
+    return predictions
@@ -1,23 +1,10 @@
 import os
-from dotenv import load_dotenv
+import sys
 
 from src.paths import PARENT_DIR
 
-# load key-value pairs from .env file located in the parent directory
-load_dotenv(PARENT_DIR / '.env')
-
 HOPSWORKS_PROJECT_NAME = 'nyc_taxiride_demand'
 
-# Try Streamlit secrets first, then environment variable
-try:
-    import streamlit as st
-    HOPSWORKS_API_KEY = st.secrets["HOPSWORKS_API_KEY"]
-except:
-    try:
-        HOPSWORKS_API_KEY = os.environ['HOPSWORKS_API_KEY']
-    except:
-        raise Exception('Set HOPSWORKS_API_KEY in Streamlit secrets or .env file')
-
 FEATURE_GROUP_NAME = 'time_series_hourly_feature_group'
 FEATURE_GROUP_VERSION = 1
 FEATURE_VIEW_NAME = 'time_series_hourly_feature_view'
@@ -26,6 +13,65 @@ MODEL_NAME = 'taxi_demand_predictor_next_hour'
 MODEL_VERSION = 1
 FEATURE_GROUP_MODEL_PREDICTIONS = 'model_predictions_feature_group'
 FEATURE_VIEW_MONITORING = 'monitoring_feature_view'
+FEATURE_GROUP_MODEL_METRICS = 'model_metrics_feature_group'
+FEATURE_GROUP_MODEL_METRICS_VERSION = 1
+# directory of the project's datasets where the rollup cube of the metrics
+# feature group is shared with the monitoring dashboard
+ROLLUP_CUBE_DATASET_DIR = 'Resources/rollups'
+# directory of the project's datasets where `delta_insert` keeps what was
+# last written to each feature group, as the pipelines run on fresh machines
+WRITE_DIGESTS_DATASET_DIR = 'Resources/write_digests'
+FEATURE_GROUP_SHADOW_PREDICTIONS = 'shadow_predictions_feature_group'
+FEATURE_GROUP_SHADOW_PREDICTIONS_VERSION = 1
+
+# registry versions scored in shadow mode next to MODEL_VERSION, whose
+# predictions are only written to the shadow predictions feature group
+SHADOW_MODEL_VERSIONS = []
+
+# pickup_location_ids go from 1 to 265 in the NYC taxi zones
+N_LOCATIONS = 265
 
 # Number of historical hours used as features (28 days * 24 hours)
-N_FEATURES = 24 * 28
\ No newline at end of file
+N_FEATURES = 24 * 28
+
+
+def _get_hopsworks_api_key() -> str:
+    """
+    Reads the Hopsworks API key from Streamlit secrets or from the
+    environment (after loading the .env file in the parent directory).
+
+    Streamlit secrets are tried first only inside a Streamlit app, so scripts
+    and pipelines do not pay the import of streamlit.
+    """
+    def _from_streamlit_secrets() -> str:
+        import streamlit as st
+        return st.secrets["HOPSWORKS_API_KEY"]
+
+    def _from_environment() -> str:
+        from dotenv import load_dotenv
+
+        # load key-value pairs from .env file located in the parent directory
+        load_dotenv(PARENT_DIR / '.env')
+        return os.environ['HOPSWORKS_API_KEY']
+
+    sources = [_from_environment, _from_streamlit_secrets]
+    if 'streamlit' in sys.modules:
+        sources.reverse()
+
+    for source in sources:
+        try:
+            return source()
+        except Exception:
+            continue
+
+    raise Exception('Set HOPSWORKS_API_KEY in Streamlit secrets or .env file')
+
+
+def __getattr__(name: str):
+    # HOPSWORKS_API_KEY is resolved on first use, not when the module is
+    # imported, so code that does not talk to Hopsworks does not need it
+    if name == 'HOPSWORKS_API_KEY':
+        value = _get_hopsworks_api_key()
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
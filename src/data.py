@@ -1,10 +1,25 @@
+import hashlib
+import json
+from datetime import datetime
+
 import pandas as pd
 import numpy as np
-import requests
 from pathlib import Path
 from tqdm import tqdm
-from typing import Optional, List
-from src.paths import RAW_DATA_DIR, TRANSFORMED_DATA_DIR
+from typing import Optional, List, Tuple
+from src.data_quality import save_quality_report, validate_raw_file
+from src.hours import from_hour_index, to_hour_index
+from src.paths import (
+    DATA_DIR,
+    HOURLY_AGGREGATES_DIR,
+    RAW_DATA_DIR,
+    TRANSFORMED_DATA_DIR,
+    create_directories
+)
+
+# version of the validation + aggregation logic behind the cached hourly
+# aggregates. Bump it when either changes, so the cache is rebuilt
+AGGREGATION_VERSION = 1
 
 
 def download_one_file_of_raw_data(year: int, month: int) -> Path:
@@ -22,6 +37,8 @@ def download_one_file_of_raw_data(year: int, month: int) -> Path:
     Raises:
     - Exception: If the file cannot be downloaded (e.g., 404 or network error).
     """
+    import requests
+
     # Construct the URL for the dataset
     URL = f"https://d37ci6vzurychx.cloudfront.net/trip-data/yellow_tripdata_{year}-{month:02d}.parquet"  # Replace with actual base URL
 
@@ -60,50 +77,64 @@ def validate_raw_data(rides: pd.DataFrame,
     """
     # Keep only rides for this month
     this_month_start = f'{year}-{month:02d}-01'
-    next_month_start = f'{year}-{month+1:02d}-01' if month < 12 else f'{year+1}-{month}-01'
+    next_month_start = f'{year}-{month+1:02d}-01' if month < 12 else f'{year+1}-01-01'
     rides = rides[rides['pickup_datetime'] >= this_month_start]
     rides = rides[rides['pickup_datetime'] < next_month_start]
 
     return rides
 
+def _get_local_raw_file(year: int, month: int) -> Optional[Path]:
+    """
+    Returns the local raw file for `year`-`month`, downloading it first if
+    needed. None if the file is not available
+    """
+    local_file = RAW_DATA_DIR / f'rides_{year}-{month:02d}.parquet'
+    if not local_file.exists():
+        try:
+            # download the file from the NYC website
+            print(f'Downloading file {year}-{month:02d}')
+            download_one_file_of_raw_data(year=year, month=month)
+        except:
+            print(f'{year}-{month:02d} file is not available')
+            return None
+    else:
+        print(f'File {year}-{month:02d} was already in local storage')
+
+    return local_file
+
+def _load_validated_raw_file(local_file: Path, year: int, month: int) -> pd.DataFrame:
+    # load and validate the file in one pass, which also drops nulls,
+    # invalid zones, dropoffs before pickups and duplicated trips
+    rides, report = validate_raw_file(local_file, year, month)
+    save_quality_report(report)
+    print(f'{year}-{month:02d}: kept {report["n_valid"]} of {report["n_rows"]} rows, '
+          f'{report["n_anomalous_hours"]} hours with anomalous volume')
+
+    return rides
+
+def _get_months(months: Optional[List[int]]) -> List[int]:
+    if months is None:
+        # download data for the entire year (all months)
+        return list(range(1, 13))
+    elif isinstance(months, int):
+        # download data only for the months specified by `months`
+        return [months]
+    return months
+
 def load_raw_data(year: int,
                   months: Optional[List[int]]=None) -> pd.DataFrame:
     """"""
+    create_directories()
+
     rides = pd.DataFrame()
 
-    if months is None:
-        # download data only for the months specified by `months`
-        months = list(range(1, 13))
-    elif isinstance(months, int):
-        # download data for the entire year (all months)
-        months = [months]
-
-    for month in months:
-
-        local_file = RAW_DATA_DIR / f'rides_{year}-{month:02d}.parquet'
-        if not local_file.exists():
-            try:
-                # download the file from the NYC website
-                print(f'Downloading file {year}-{month:02d}')
-                download_one_file_of_raw_data(year=year, month=month)
-            except:
-                print(f'{year}-{month:02d} file is not available')
-                continue
-        else:
-            print(f'File {year}-{month:02d} was already in local storage')
-
-        # load the file into pandas
-        rides_one_month = pd.read_parquet(local_file)
-
-        # rename columns
-        rides_one_month = rides_one_month[['tpep_pickup_datetime', 'PULocationID']]
-        rides_one_month.rename(columns={
-            'tpep_pickup_datetime': 'pickup_datetime',
-            'PULocationID': 'pickup_location_id'
-        }, inplace=True)
-
-        # validate the file
-        rides_one_month = validate_raw_data(rides_one_month, year, month)
+    for month in _get_months(months):
+
+        local_file = _get_local_raw_file(year, month)
+        if local_file is None:
+            continue
+
+        rides_one_month = _load_validated_raw_file(local_file, year, month)
 
         # append to existing data
         rides = pd.concat([rides, rides_one_month])
@@ -113,48 +144,242 @@ def load_raw_data(year: int,
 
     return rides
 
-def add_missing_slots(rides: pd.DataFrame) -> pd.DataFrame:
+def _get_file_checksum(path: Path) -> str:
+    """SHA-256 of the file contents"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
 
-    location_ids = rides['pickup_location_id'].unique()
-    full_range = pd.date_range(
-        rides['pickup_hour'].min(), rides['pickup_hour'].max(), freq='h'
-    )
-    output = pd.DataFrame()
-    for location_id in tqdm(location_ids):
+def _get_hourly_aggregates_path(year: int, month: int) -> Path:
+    return HOURLY_AGGREGATES_DIR / f'rides_{year}-{month:02d}.v{AGGREGATION_VERSION}.parquet'
 
-        # keep only rides for this location_id
-        rides_i = rides.loc[rides['pickup_location_id'] == location_id, ['pickup_hour', 'rides']]
+def aggregate_rides_per_hour(rides: pd.DataFrame) -> pd.DataFrame:
+    """
+    Counts rides per pickup_hour and pickup_location_id. Only (hour, location)
+    pairs with at least one ride are returned
+    """
+    rides['pickup_hour'] = rides['pickup_datetime'].dt.floor('h')
+    agg_rides = rides.groupby(['pickup_hour', 'pickup_location_id']).size().reset_index()
+    agg_rides.rename(columns={0: 'rides'}, inplace=True)
 
-        # quick way to add missing dates with 0 in a series
-        rides_i.set_index('pickup_hour', inplace=True)
-        rides_i.index = pd.DatetimeIndex(rides_i.index)
-        rides_i = rides_i.reindex(full_range, fill_value=0)
+    return agg_rides
 
-        # add back location_id columns
-        rides_i['pickup_location_id'] = location_id
+def load_hourly_aggregates(year: int, month: int) -> Optional[pd.DataFrame]:
+    """
+    Returns the rides per pickup_hour and pickup_location_id in the raw file
+    for `year`-`month`, from a cache in HOURLY_AGGREGATES_DIR.
 
-        # append to output
-        output = pd.concat([output, rides_i])
+    The cache entry is keyed by the aggregation version (in its file name)
+    and by the SHA-256 of the raw file (in a sidecar JSON), so it is rebuilt
+    when the raw file or the validation/aggregation logic changes. The
+    checksum is only recomputed when the size or mtime of the raw file
+    changed since it was last computed.
 
-    # move the purchase_day from the index to a dataframe column
-    output = output.reset_index().rename(columns={'index': 'pickup_hour'})
-    
-    return output
+    Returns:
+        Optional[pd.DataFrame]: columns `pickup_hour`, `pickup_location_id`
+        and `rides`. None if the raw file is not available
+    """
+    local_file = _get_local_raw_file(year, month)
+    if local_file is None:
+        return None
+
+    cache_path = _get_hourly_aggregates_path(year, month)
+    metadata_path = cache_path.with_suffix('.json')
+
+    stat = local_file.stat()
+    metadata = {}
+    if cache_path.exists() and metadata_path.exists():
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+
+        if metadata['size'] == stat.st_size and metadata['mtime_ns'] == stat.st_mtime_ns:
+            return pd.read_parquet(cache_path)
+
+    # new or modified raw file (or only touched, which the checksum tells)
+    checksum = _get_file_checksum(local_file)
+    if metadata.get('checksum') == checksum:
+        agg_rides = pd.read_parquet(cache_path)
+    else:
+        print(f'Aggregating rides per hour for {year}-{month:02d}')
+        rides = _load_validated_raw_file(local_file, year, month)
+        agg_rides = aggregate_rides_per_hour(rides)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        agg_rides.to_parquet(cache_path, index=False)
+
+    with open(metadata_path, 'w') as f:
+        json.dump({'checksum': checksum,
+                   'size': stat.st_size,
+                   'mtime_ns': stat.st_mtime_ns,
+                   'aggregation_version': AGGREGATION_VERSION}, f)
+
+    return agg_rides
+
+def load_hourly_rides(year: int,
+                      months: Optional[List[int]]=None) -> pd.DataFrame:
+    """
+    Same rides as `load_raw_data`, already counted per pickup_hour and
+    pickup_location_id, from the hourly-aggregates cache. Raw rows are only
+    read for files that are new or were modified.
+
+    Returns:
+        pd.DataFrame: columns `pickup_hour`, `pickup_location_id` and `rides`,
+        only for (hour, location) pairs with at least one ride
+    """
+    create_directories()
+
+    agg_rides = [load_hourly_aggregates(year, month) for month in _get_months(months)]
+    agg_rides = [agg for agg in agg_rides if agg is not None]
+    if not agg_rides:
+        return pd.DataFrame(columns=['pickup_hour', 'pickup_location_id', 'rides'])
+
+    return pd.concat(agg_rides, ignore_index=True)
+
+def add_missing_slots(rides: pd.DataFrame) -> pd.DataFrame:
+    """
+    Adds the (location, hour) slots without rides, with 0 rides, between the
+    first and the last pickup_hour of `rides`. See `densify_ts_data`
+    """
+    return densify_ts_data(rides)
 
 def transform_raw_data_into_ts_data(
         rides:pd.DataFrame
 ) -> pd.DataFrame:
     """"""
     # Sum rides per location and pickup_hour
-    rides['pickup_hour'] = rides['pickup_datetime'].dt.floor('h')
-    agg_rides = rides.groupby(['pickup_hour', 'pickup_location_id']).size().reset_index()
-    agg_rides.rename(columns={0: 'rides'}, inplace=True)
+    agg_rides = aggregate_rides_per_hour(rides)
 
     # add rows for (locations, pickup_hours)s with 0 rides
     agg_rides_all_slots = add_missing_slots(agg_rides)
 
     return agg_rides_all_slots
 
+def _get_grid_positions(ts_data: pd.DataFrame,
+                        location_ids: Optional[np.ndarray] = None,
+                        from_hour: Optional[datetime] = None,
+                        to_hour: Optional[datetime] = None
+                        ) -> Tuple[np.ndarray, int, int, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Dense (locations x hours) grid of time-series data, and the cell of
+    each of its rows.
+
+    Returns:
+        Tuple[np.ndarray, int, int, np.ndarray, np.ndarray, np.ndarray]:
+            - sorted pickup_location_ids, one per grid row
+            - hour index of the first grid column
+            - number of grid columns
+            - grid row and column of each row of `ts_data`
+            - whether each row of `ts_data` is inside the grid
+    """
+    hour_index = to_hour_index(ts_data['pickup_hour'])
+    ids = ts_data['pickup_location_id'].to_numpy()
+
+    if location_ids is None:
+        location_ids, rows = np.unique(ids, return_inverse=True)
+        keep = np.ones(len(ids), dtype=bool)
+    else:
+        location_ids = np.unique(np.asarray(location_ids))
+        rows = np.searchsorted(location_ids, ids)
+        keep = rows < len(location_ids)
+        keep[keep] = location_ids[rows[keep]] == ids[keep]
+
+    if len(hour_index) == 0 and (from_hour is None or to_hour is None):
+        return location_ids, 0, 0, rows, hour_index, keep
+
+    first_hour = to_hour_index(from_hour) if from_hour is not None else int(hour_index.min())
+    last_hour = to_hour_index(to_hour) if to_hour is not None else int(hour_index.max())
+    columns = hour_index.astype(np.int64) - first_hour
+    keep &= (columns >= 0) & (columns <= last_hour - first_hour)
+
+    return location_ids, first_hour, max(last_hour - first_hour + 1, 0), rows, columns, keep
+
+def _get_grid_hours(ts_data: pd.DataFrame, first_hour: int, n_hours: int) -> pd.DatetimeIndex:
+    """pickup_hour of each grid column, tz-aware if `ts_data` is"""
+    hours = pd.DatetimeIndex(ts_data['pickup_hour'])
+    grid_hours = from_hour_index(np.arange(first_hour, first_hour + n_hours),
+                                 utc=hours.tz is not None)
+    return grid_hours.as_unit(hours.unit)
+
+def get_ts_matrix(ts_data: pd.DataFrame,
+                  location_ids: Optional[np.ndarray] = None,
+                  from_hour: Optional[datetime] = None,
+                  to_hour: Optional[datetime] = None
+                  ) -> Tuple[np.ndarray, np.ndarray, pd.DatetimeIndex]:
+    """
+    Pivots time-series data from long format into a dense
+    (locations x hours) matrix, with one vectorized scatter.
+    (location, hour) slots missing in `ts_data` are filled with 0 rides, so
+    it reads sparse time-series data (see `get_sparse_ts_data`) as well as
+    dense.
+
+    The grid spans the locations and hours of `ts_data`, unless its bounds
+    are given. Rows of `ts_data` outside the bounds are ignored.
+
+    Args:
+        ts_data (pd.DataFrame): columns `pickup_hour`, `pickup_location_id` and `rides`
+        location_ids (Optional[np.ndarray]): pickup_location_ids of the rows
+        from_hour (Optional[datetime]): pickup_hour of the first column
+        to_hour (Optional[datetime]): pickup_hour of the last column, included
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, pd.DatetimeIndex]:
+            - float32 matrix of rides, with shape (n_locations, n_hours)
+            - sorted pickup_location_ids, one per row
+            - pickup_hours, one per column
+    """
+    location_ids, first_hour, n_hours, rows, columns, keep = _get_grid_positions(
+        ts_data, location_ids, from_hour, to_hour)
+
+    matrix = np.zeros((len(location_ids), n_hours), dtype=np.float32)
+    matrix[rows[keep], columns[keep]] = ts_data['rides'].to_numpy()[keep]
+
+    return matrix, location_ids, _get_grid_hours(ts_data, first_hour, n_hours)
+
+def get_sparse_ts_data(ts_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Rows of time-series data with at least one ride, which is all the
+    feature store keeps: the (location, hour) slots without rides are
+    implied by the grid readers densify into, the locations and the hours
+    they read (see `get_ts_matrix` and `densify_ts_data`).
+
+    Slots going back to 0 rides are not written, so data already in the
+    store is only ever corrected upwards, as late rides arrive.
+    """
+    return ts_data[ts_data['rides'].to_numpy() != 0].reset_index(drop=True)
+
+def densify_ts_data(ts_data: pd.DataFrame,
+                    location_ids: Optional[np.ndarray] = None,
+                    from_hour: Optional[datetime] = None,
+                    to_hour: Optional[datetime] = None) -> pd.DataFrame:
+    """
+    Time-series data with one row per (location, hour) of the grid, with 0
+    rides in the slots missing in `ts_data`, in one vectorized scatter.
+
+    Args:
+        ts_data (pd.DataFrame): columns `pickup_hour`, `pickup_location_id`
+            and `rides`, e.g. sparse time-series data read from the store
+        location_ids, from_hour, to_hour: bounds of the grid, as in
+            `get_ts_matrix`. The locations and hours of `ts_data` if None
+
+    Returns:
+        pd.DataFrame: columns `pickup_hour`, `pickup_location_id` and
+        `rides`, sorted by location and hour
+    """
+    location_ids, first_hour, n_hours, rows, columns, keep = _get_grid_positions(
+        ts_data, location_ids, from_hour, to_hour)
+
+    rides = ts_data['rides'].to_numpy()
+    dense_rides = np.zeros(len(location_ids) * n_hours, dtype=rides.dtype)
+    dense_rides[rows[keep] * n_hours + columns[keep]] = rides[keep]
+
+    grid_hours = _get_grid_hours(ts_data, first_hour, n_hours)
+    return pd.DataFrame({
+        'pickup_hour': grid_hours[np.tile(np.arange(n_hours), len(location_ids))],
+        'pickup_location_id': np.repeat(location_ids, n_hours),
+        'rides': dense_rides,
+    })
+
 def get_cutoff_indices(data: pd.DataFrame,
                        n_features: int,
                        step_size: int) -> list:
@@ -235,4 +460,33 @@ def transform_ts_data_into_features_and_target(ts_data: pd.DataFrame,
     features = pd.concat(features_list, ignore_index=True)
     targets = pd.concat(targets_list, ignore_index=True)
 
-    return features, targets['target_rides_next_hour']
\ No newline at end of file
+    return features, targets['target_rides_next_hour']
+
+
+def load_taxi_zone_lookup() -> pd.DataFrame:
+    """
+    Loads the NYC taxi zone lookup table, downloading it the first time
+
+    Returns:
+        pd.DataFrame: columns `pickup_location_id`, `borough`, `zone`
+        and `service_zone`
+    """
+    local_file = DATA_DIR / 'taxi_zone_lookup.csv'
+    if not local_file.exists():
+        import requests
+
+        URL = 'https://d37ci6vzurychx.cloudfront.net/misc/taxi_zone_lookup.csv'
+        response = requests.get(URL)
+        if response.status_code != 200:
+            raise Exception(f'{URL} is not available')
+        local_file.parent.mkdir(parents=True, exist_ok=True)
+        local_file.write_bytes(response.content)
+
+    zones = pd.read_csv(local_file)
+    zones = zones.rename(columns={
+        'LocationID': 'pickup_location_id',
+        'Borough': 'borough',
+        'Zone': 'zone',
+    })
+
+    return zones[['pickup_location_id', 'borough', 'zone', 'service_zone']]
@@ -0,0 +1,232 @@
+"""
+Single-pass data-quality checks for the raw rides files.
+
+The parquet file is streamed in record batches, and every check is a
+vectorized mask over the batch, so the whole file is validated in about the
+time it takes to read it
+"""
+import json
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.config import N_LOCATIONS
+from src.hours import HOURS_PER_WEEK, hour_of_week, to_hour_index
+from src.paths import QUALITY_REPORTS_DIR
+
+# raw columns read from the file, and the ones that identify a trip for
+# duplicate detection. Two different trips can share the pickup time and
+# zone, but not all of these
+PICKUP_COLUMN = 'tpep_pickup_datetime'
+DROPOFF_COLUMN = 'tpep_dropoff_datetime'
+LOCATION_COLUMN = 'PULocationID'
+DUPLICATE_KEY_COLUMNS = [
+    'VendorID', PICKUP_COLUMN, DROPOFF_COLUMN, LOCATION_COLUMN, 'DOLocationID',
+    'trip_distance', 'total_amount',
+]
+
+# hours whose robust z-score of log-volume is above this are reported as
+# anomalous (Iglewicz and Hoaglin's cutoff for modified z-scores), if their
+# volume is also at least ANOMALY_MIN_RELATIVE_CHANGE away from the expected
+# one. The second condition avoids flagging tiny deviations in months where
+# volume is very regular, and the MAD is small
+ANOMALY_Z_THRESHOLD = 3.5
+ANOMALY_MIN_RELATIVE_CHANGE = 0.5
+
+BATCH_SIZE = 1_000_000
+
+
+def _to_numpy(column, fill_value) -> np.ndarray:
+    import pyarrow.compute as pc
+    return pc.fill_null(column, fill_value).to_numpy(zero_copy_only=False)
+
+
+def get_hourly_volume_anomalies(hourly_rides: np.ndarray,
+                                first_hour: pd.Timestamp,
+                                threshold: float = ANOMALY_Z_THRESHOLD,
+                                min_relative_change: float = ANOMALY_MIN_RELATIVE_CHANGE
+                                ) -> List[Dict]:
+    """
+    Flags hours whose total volume is far from the median of the same
+    hour-of-week in the month.
+
+    The score is a modified z-score of log(1 + rides): the residual against
+    the hour-of-week median, divided by the median absolute residual.
+
+    Args:
+        hourly_rides (np.ndarray): rides per consecutive hour
+        first_hour (pd.Timestamp): hour of `hourly_rides[0]`
+        threshold (float): minimum absolute z-score to report
+        min_relative_change (float): minimum relative difference between
+            the rides and the expected rides to report
+
+    Returns:
+        List[Dict]: one dict per anomalous hour, with keys `pickup_hour`,
+        `rides`, `expected_rides` and `robust_z`
+    """
+    if len(hourly_rides) == 0:
+        return []
+
+    log_rides = np.log1p(hourly_rides.astype(np.float64))
+    how = hour_of_week(to_hour_index(first_hour) + np.arange(len(hourly_rides)))
+
+    # median per hour-of-week, from the (few) weeks in the file
+    expected = np.zeros(HOURS_PER_WEEK)
+    for h in np.unique(how):
+        expected[h] = np.median(log_rides[how == h])
+
+    residuals = log_rides - expected[how]
+    mad = np.median(np.abs(residuals))
+    if mad == 0:
+        return []
+    robust_z = 0.6745 * residuals / mad
+
+    relative_change = np.abs(np.expm1(residuals))
+    anomalies = np.flatnonzero((np.abs(robust_z) > threshold)
+                               & (relative_change >= min_relative_change))
+    return [
+        {
+            'pickup_hour': (first_hour + pd.Timedelta(hours=int(i))).isoformat(),
+            'rides': int(hourly_rides[i]),
+            'expected_rides': float(np.expm1(expected[how[i]])),
+            'robust_z': float(robust_z[i]),
+        }
+        for i in anomalies
+    ]
+
+
+def validate_raw_file(path: Path,
+                      year: int,
+                      month: int,
+                      batch_size: int = BATCH_SIZE) -> Tuple[pd.DataFrame, Dict]:
+    """
+    Streams the raw parquet file for `year`-`month` and runs all the checks
+    in one pass over its record batches:
+
+        - pickups outside the month of the file
+        - pickups in the future
+        - null pickup times or locations
+        - locations outside 1..N_LOCATIONS
+        - dropoffs before their pickup
+        - duplicated trips, by hash of DUPLICATE_KEY_COLUMNS
+        - hours with an anomalous total volume
+
+    Rows failing any of the first 6 checks are dropped. A row can fail more
+    than one check, so the counts do not add up to `n_dropped`. Volume
+    anomalies are only reported.
+
+    Args:
+        path (Path): raw parquet file
+        year (int): year of the file
+        month (int): month of the file
+        batch_size (int): rows per record batch
+
+    Returns:
+        Tuple[pd.DataFrame, Dict]:
+            - valid rides, with columns `pickup_datetime` and `pickup_location_id`
+            - quality report
+    """
+    import pyarrow.parquet as pq
+
+    start = time.perf_counter()
+
+    month_start = np.datetime64(f'{year}-{month:02d}-01', 'h')
+    next_month_start = np.datetime64(
+        f'{year + 1}-01-01' if month == 12 else f'{year}-{month + 1:02d}-01', 'h')
+    now = np.datetime64(pd.Timestamp.now(tz='UTC').tz_localize(None))
+
+    parquet_file = pq.ParquetFile(path)
+    available_columns = set(parquet_file.schema_arrow.names)
+    key_columns = [c for c in DUPLICATE_KEY_COLUMNS if c in available_columns]
+    columns = list(dict.fromkeys([PICKUP_COLUMN, LOCATION_COLUMN]
+                                 + ([DROPOFF_COLUMN] if DROPOFF_COLUMN in available_columns else [])
+                                 + key_columns))
+
+    counts = dict.fromkeys(
+        ['n_null_pickups', 'n_null_locations', 'n_invalid_locations',
+         'n_out_of_range_pickups', 'n_future_pickups', 'n_dropoff_before_pickup'], 0)
+    n_rows = 0
+    pickups, locations, row_hashes = [], [], []
+
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        n_rows += batch.num_rows
+
+        pickup_col = batch.column(PICKUP_COLUMN)
+        location_col = batch.column(LOCATION_COLUMN)
+
+        pickup = _to_numpy(pickup_col.cast('timestamp[us]'), 0).astype('datetime64[us]')
+        location = _to_numpy(location_col, 0).astype(np.int64)
+
+        null_pickup = pickup_col.is_null().to_numpy(zero_copy_only=False)
+        null_location = location_col.is_null().to_numpy(zero_copy_only=False)
+        invalid_location = ~null_location & ((location < 1) | (location > N_LOCATIONS))
+        out_of_range = ~null_pickup & ((pickup < month_start) | (pickup >= next_month_start))
+        future = ~null_pickup & (pickup > now)
+
+        valid = ~(null_pickup | null_location | invalid_location | out_of_range | future)
+
+        if DROPOFF_COLUMN in columns:
+            dropoff_col = batch.column(DROPOFF_COLUMN)
+            dropoff = _to_numpy(dropoff_col.cast('timestamp[us]'), 0).astype('datetime64[us]')
+            null_dropoff = dropoff_col.is_null().to_numpy(zero_copy_only=False)
+            dropoff_before_pickup = ~null_pickup & ~null_dropoff & (dropoff < pickup)
+            valid &= ~dropoff_before_pickup
+            counts['n_dropoff_before_pickup'] += int(dropoff_before_pickup.sum())
+
+        counts['n_null_pickups'] += int(null_pickup.sum())
+        counts['n_null_locations'] += int(null_location.sum())
+        counts['n_invalid_locations'] += int(invalid_location.sum())
+        counts['n_out_of_range_pickups'] += int(out_of_range.sum())
+        counts['n_future_pickups'] += int(future.sum())
+
+        pickups.append(pickup[valid])
+        locations.append(location[valid])
+
+        keys = batch.select(key_columns).filter(valid).to_pandas()
+        row_hashes.append(pd.util.hash_pandas_object(keys, index=False).to_numpy())
+
+    pickups = np.concatenate(pickups) if pickups else np.array([], dtype='datetime64[us]')
+    locations = np.concatenate(locations) if locations else np.array([], dtype=np.int64)
+    row_hashes = np.concatenate(row_hashes) if row_hashes else np.array([], dtype=np.uint64)
+
+    # keep the first occurrence of each trip. A hash table lookup, instead
+    # of sorting the hashes
+    is_first = ~pd.Series(row_hashes).duplicated(keep='first').to_numpy()
+    n_duplicates = int((~is_first).sum())
+    pickups, locations = pickups[is_first], locations[is_first]
+
+    # total rides per hour of the month, up to the last hour with data
+    hour_index = ((pickups - month_start) // np.timedelta64(1, 'h')).astype(np.int64)
+    hourly_rides = np.bincount(hour_index)
+    anomalies = get_hourly_volume_anomalies(hourly_rides, pd.Timestamp(month_start))
+
+    rides = pd.DataFrame({'pickup_datetime': pickups, 'pickup_location_id': locations})
+
+    report = {
+        'file': Path(path).name,
+        'year': year,
+        'month': month,
+        'n_rows': n_rows,
+        **counts,
+        'n_duplicates': n_duplicates,
+        'n_valid': len(rides),
+        'n_dropped': n_rows - len(rides),
+        'n_anomalous_hours': len(anomalies),
+        'anomalous_hours': anomalies,
+        'elapsed_seconds': time.perf_counter() - start,
+    }
+
+    return rides, report
+
+
+def save_quality_report(report: Dict, reports_dir: Path = QUALITY_REPORTS_DIR) -> Path:
+    """Saves `report` as JSON, one file per raw file"""
+    reports_dir = Path(reports_dir)
+    reports_dir.mkdir(parents=True, exist_ok=True)
+    path = reports_dir / f"rides_{report['year']}-{report['month']:02d}.json"
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    return path
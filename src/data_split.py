@@ -1,8 +1,23 @@
 from datetime import datetime
-from typing import Tuple
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 
+from src.hours import to_hour_index, to_naive_utc
+from src.paths import TABULAR_DATA_DIR
+
+# hive partition key of the tabular dataset, 'YYYY-MM' of `pickup_hour`.
+# Strings in this format sort like the months they stand for
+PARTITION_COLUMN = 'pickup_month'
+
+# rows per parquet row group. The rows are sorted by `pickup_hour`, so each
+# row group spans a few hours, and its min/max statistics let reads skip
+# the row groups outside a date range
+ROW_GROUP_SIZE = 50_000
+
+
 def train_test_split(df: pd.DataFrame,
                      cutoff_date: datetime,
                      target_column_name: str,
@@ -52,4 +67,348 @@ def train_test_split(df: pd.DataFrame,
 
     return X_train, y_train, X_test, y_test
 
-    
\ No newline at end of file
+
+def _get_sorted_hours(pickup_hours: pd.Series) -> np.ndarray:
+    """Hour index of each ``pickup_hour``, checked to be sorted"""
+    hours = to_hour_index(pickup_hours)
+    if np.any(hours[1:] < hours[:-1]):
+        raise ValueError('Rows must be sorted by pickup_hour, '
+                         'e.g. df.sort_values("pickup_hour", ignore_index=True)')
+    return hours
+
+
+def _get_month(date: datetime) -> str:
+    return to_naive_utc(pd.Timestamp(date)).strftime('%Y-%m')
+
+
+def write_tabular_dataset(df: pd.DataFrame, path: Path = TABULAR_DATA_DIR) -> Path:
+    """
+    Write the tabular (features and target) data as a parquet dataset,
+    partitioned by month of ``pickup_hour``.
+
+    Rows are sorted by ``pickup_hour`` and ``pickup_location_id``, so the
+    row groups of each file cover consecutive hours. Months already in the
+    dataset are replaced, the rest are kept.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Output of ``transform_ts_data_into_features_and_target``, with the
+        target as one more column.
+    path : Path
+        Directory of the dataset.
+
+    Returns
+    -------
+    Path
+        ``path``.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    df = df.sort_values(['pickup_hour', 'pickup_location_id'], kind='stable')
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    months = to_naive_utc(pd.DatetimeIndex(df['pickup_hour']))
+    table = table.append_column(PARTITION_COLUMN, pa.array(months.strftime('%Y-%m')))
+
+    ds.write_dataset(
+        table,
+        Path(path),
+        format='parquet',
+        partitioning=ds.partitioning(pa.schema([(PARTITION_COLUMN, pa.string())]),
+                                     flavor='hive'),
+        existing_data_behavior='delete_matching',
+        max_rows_per_group=ROW_GROUP_SIZE,
+        min_rows_per_group=ROW_GROUP_SIZE,
+        basename_template='part-{i}.parquet',
+    )
+
+    return Path(path)
+
+
+def _get_dataset(path: Path):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    return ds.dataset(
+        Path(path),
+        format='parquet',
+        partitioning=ds.partitioning(pa.schema([(PARTITION_COLUMN, pa.string())]),
+                                     flavor='hive'),
+    )
+
+
+def _get_date_filter(dataset,
+                     from_date: Optional[datetime],
+                     to_date: Optional[datetime]):
+    """
+    Filter for ``from_date <= pickup_hour < to_date``, on both the
+    partition key (to skip whole months) and ``pickup_hour`` (to skip row
+    groups by their statistics, and then filter the rows)
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    hour_type = dataset.schema.field('pickup_hour').type
+
+    def _to_scalar(date: datetime):
+        date = to_naive_utc(pd.Timestamp(date))
+        if getattr(hour_type, 'tz', None) is not None:
+            date = date.tz_localize('UTC')
+        return pa.scalar(date, type=hour_type)
+
+    filter_ = None
+    if from_date is not None:
+        filter_ = ((ds.field(PARTITION_COLUMN) >= _get_month(from_date))
+                   & (ds.field('pickup_hour') >= _to_scalar(from_date)))
+    if to_date is not None:
+        to_filter = ((ds.field(PARTITION_COLUMN) <= _get_month(to_date))
+                     & (ds.field('pickup_hour') < _to_scalar(to_date)))
+        filter_ = to_filter if filter_ is None else filter_ & to_filter
+
+    return filter_
+
+
+def load_tabular_dataset(from_date: Optional[datetime] = None,
+                         to_date: Optional[datetime] = None,
+                         columns: Optional[List[str]] = None,
+                         as_arrow: bool = False,
+                         path: Path = TABULAR_DATA_DIR):
+    """
+    Read the rows of the tabular dataset with ``from_date <= pickup_hour <
+    to_date``, opening only the months in that range and the row groups
+    whose statistics overlap it.
+
+    Parameters
+    ----------
+    from_date : Optional[datetime]
+        First hour to read. From the first one in the dataset if None.
+    to_date : Optional[datetime]
+        Hour after the last one to read. Up to the last one if None.
+    columns : Optional[List[str]]
+        Columns to read. All of them if None.
+    as_arrow : bool
+        Return the ``pyarrow.Table`` read, instead of converting it to a
+        DataFrame.
+    path : Path
+        Directory of the dataset, see ``write_tabular_dataset``.
+
+    Returns
+    -------
+    pd.DataFrame or pyarrow.Table
+        The rows, sorted by ``pickup_hour`` and ``pickup_location_id``.
+    """
+    dataset = _get_dataset(path)
+    if columns is None:
+        columns = [name for name in dataset.schema.names if name != PARTITION_COLUMN]
+
+    table = dataset.to_table(columns=columns, filter=_get_date_filter(dataset, from_date, to_date))
+    if as_arrow:
+        return table
+
+    # the Arrow buffers are released as each column is converted, so the
+    # peak memory is about one copy of the data
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def train_test_split_from_dataset(cutoff_date: datetime,
+                                  target_column_name: str,
+                                  from_date: Optional[datetime] = None,
+                                  to_date: Optional[datetime] = None,
+                                  columns: Optional[List[str]] = None,
+                                  as_arrow: bool = False,
+                                  path: Path = TABULAR_DATA_DIR):
+    """
+    Same split as ``train_test_split``, read from the month-partitioned
+    tabular dataset: each half only reads the months, row groups and
+    columns it needs, and no split is copied after reading.
+
+    Parameters
+    ----------
+    cutoff_date : datetime
+        Rows with a ``pickup_hour`` earlier than it are training rows, the
+        rest are test rows.
+    target_column_name : str
+        Name of the target column to be predicted.
+    from_date : Optional[datetime]
+        First hour of the training set. From the start of the dataset if None.
+    to_date : Optional[datetime]
+        Hour after the last one of the test set. Up to the end of the
+        dataset if None.
+    columns : Optional[List[str]]
+        Feature columns to read. All of them if None.
+    as_arrow : bool
+        Return ``pyarrow.Table`` features and ``pyarrow.ChunkedArray``
+        targets, which share the buffers read from the files.
+    path : Path
+        Directory of the dataset, see ``write_tabular_dataset``.
+
+    Returns
+    -------
+    X_train, y_train, X_test, y_test
+        DataFrames and Series, or their Arrow counterparts with ``as_arrow``.
+    """
+    if columns is not None:
+        columns = [c for c in columns if c != target_column_name] + [target_column_name]
+
+    splits = []
+    for split_from, split_to in [(from_date, cutoff_date), (cutoff_date, to_date)]:
+        table = load_tabular_dataset(split_from, split_to, columns, as_arrow=True, path=path)
+
+        # dropping a column from a table does not copy the others
+        X, y = table.drop_columns([target_column_name]), table.column(target_column_name)
+        if not as_arrow:
+            X = X.to_pandas(split_blocks=True, self_destruct=True)
+            y = y.to_pandas().rename(target_column_name)
+        splits.extend([X, y])
+
+    return tuple(splits)
+
+
+def train_test_split_views(df: pd.DataFrame,
+                           cutoff_date: datetime,
+                           target_column_name: str,
+                           ) -> Tuple[pd.DataFrame, pd.Series, pd.DataFrame, pd.Series]:
+    """
+    Same split as ``train_test_split``, for a DataFrame sorted by
+    ``pickup_hour``: each half is a contiguous block of rows, so the splits
+    are slices of ``df`` that share its data instead of copies.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Input DataFrame, sorted by ``pickup_hour``.
+    cutoff_date : datetime
+        Datetime threshold used to divide the data into training and test sets.
+    target_column_name : str
+        Name of the target column to be predicted.
+
+    Returns
+    -------
+    X_train, y_train, X_test, y_test
+        Row slices of ``df``. If the target is the last column, as in
+        the tabular data, the features are a column slice of ``df`` too.
+        Otherwise they are copied once, when dropping the target.
+    """
+    pickup_hours = _get_sorted_hours(df['pickup_hour'])
+    cutoff = np.searchsorted(pickup_hours, to_hour_index(cutoff_date))
+
+    if df.columns[-1] == target_column_name:
+        X = df.iloc[:, :-1]
+    else:
+        X = df.drop(columns=target_column_name)
+    y = df[target_column_name]
+
+    return X.iloc[:cutoff], y.iloc[:cutoff], X.iloc[cutoff:], y.iloc[cutoff:]
+
+
+def time_series_folds(pickup_hours: pd.Series,
+                      n_folds: int = 5,
+                      val_hours: Optional[int] = None,
+                      gap_hours: int = 0,
+                      train_hours: Optional[int] = None) -> Iterator[Tuple[slice, slice]]:
+    """
+    Generate time-based (train, validation) folds over rows sorted by
+    ``pickup_hour``, as row position slices.
+
+    The last ``n_folds * val_hours`` hours are split into ``n_folds``
+    consecutive validation windows. The training window of each fold ends
+    ``gap_hours`` before its validation window starts, and starts:
+
+        - at the first hour, if ``train_hours`` is None (expanding window)
+        - ``train_hours`` before its end, otherwise (sliding window)
+
+    A gap of at least the largest lag keeps the validation features from
+    overlapping the training targets.
+
+    Parameters
+    ----------
+    pickup_hours : pd.Series
+        ``pickup_hour`` of each row, sorted.
+    n_folds : int
+        Number of folds.
+    val_hours : Optional[int]
+        Hours in each validation window. If None, the span of the data
+        divided by ``n_folds + 1``, as in sklearn's ``TimeSeriesSplit``.
+    gap_hours : int
+        Hours between the end of each training window and the start of
+        its validation window.
+    train_hours : Optional[int]
+        Hours in each training window. If None, all the hours before the gap.
+
+    Yields
+    ------
+    Tuple[slice, slice]
+        Row positions of the training and the validation rows.
+    """
+    hours = _get_sorted_hours(pickup_hours)
+    if len(hours) == 0:
+        return
+
+    end = int(hours[-1]) + 1
+    if val_hours is None:
+        val_hours = (end - int(hours[0])) // (n_folds + 1)
+    if val_hours <= 0:
+        raise ValueError('The data spans too few hours for the folds')
+
+    for fold in range(n_folds):
+        val_start = end - (n_folds - fold) * val_hours
+        train_end = val_start - gap_hours
+
+        rows = np.searchsorted(hours, [train_end, val_start, val_start + val_hours])
+        train_start = 0
+        if train_hours is not None:
+            train_start = np.searchsorted(hours, train_end - train_hours)
+
+        if rows[0] <= train_start:
+            raise ValueError(f'Fold {fold} has no training rows')
+
+        yield slice(int(train_start), int(rows[0])), slice(int(rows[1]), int(rows[2]))
+
+
+def expanding_window_folds(pickup_hours: pd.Series,
+                           n_folds: int = 5,
+                           val_hours: Optional[int] = None,
+                           gap_hours: int = 0) -> Iterator[Tuple[slice, slice]]:
+    """
+    Folds that train on all the hours before each validation window, see
+    ``time_series_folds``.
+    """
+    return time_series_folds(pickup_hours, n_folds, val_hours, gap_hours)
+
+
+def sliding_window_folds(pickup_hours: pd.Series,
+                         train_hours: int,
+                         n_folds: int = 5,
+                         val_hours: Optional[int] = None,
+                         gap_hours: int = 0) -> Iterator[Tuple[slice, slice]]:
+    """
+    Folds that train on the ``train_hours`` hours before each validation
+    window, see ``time_series_folds``.
+    """
+    return time_series_folds(pickup_hours, n_folds, val_hours, gap_hours, train_hours)
+
+
+def iter_fold_views(X: pd.DataFrame,
+                    y: pd.Series,
+                    folds: Iterable[Tuple[slice, slice]],
+                    ) -> Iterator[Tuple[pd.DataFrame, pd.Series, pd.DataFrame, pd.Series]]:
+    """
+    Views of ``X`` and ``y`` for each fold of ``time_series_folds``.
+
+    Parameters
+    ----------
+    X : pd.DataFrame
+        Features, sorted by ``pickup_hour``.
+    y : pd.Series
+        Target values, aligned with ``X``.
+    folds : Iterable[Tuple[slice, slice]]
+        Row position slices of each fold.
+
+    Yields
+    ------
+    X_train, y_train, X_val, y_val
+        Row slices of ``X`` and ``y``, that share their data.
+    """
+    for train_rows, val_rows in folds:
+        yield X.iloc[train_rows], y.iloc[train_rows], X.iloc[val_rows], y.iloc[val_rows]
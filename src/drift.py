@@ -0,0 +1,178 @@
+"""
+Compact, mergeable histograms of hourly demand and predictions, per location
+and hour-of-week, to detect drift against the training-time distribution
+"""
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.config import N_LOCATIONS
+from src.hours import HOURS_PER_WEEK, hour_of_week
+
+# bin edges for hourly ride counts. One bin per value for small counts and
+# roughly log-spaced bins after that, as demand spans several orders of
+# magnitude across zones
+RIDES_BIN_EDGES = np.array(
+    [0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144, 233, 377, 610], dtype=np.float64
+)
+
+# smoothing added to empty bins before computing divergences
+EPSILON = 1e-4
+
+
+class DemandSketch:
+    """
+    Histogram of hourly values with shape (N_LOCATIONS, HOURS_PER_WEEK, n_bins).
+
+    Sketches built with the same bin edges can be merged by adding their
+    counts, so a reference built at training time and the weekly sketches
+    built in production are directly comparable, and updating a sketch with
+    one new hour of data costs O(locations).
+    """
+
+    def __init__(self,
+                 bin_edges: np.ndarray = RIDES_BIN_EDGES,
+                 counts: Optional[np.ndarray] = None,
+                 last_pickup_hour: Optional[pd.Timestamp] = None):
+        self.bin_edges = np.asarray(bin_edges, dtype=np.float64)
+        # most recent pickup_hour added, so pipeline re-runs can skip it
+        self.last_pickup_hour = last_pickup_hour
+        n_bins = len(self.bin_edges)
+        if counts is None:
+            counts = np.zeros((N_LOCATIONS, HOURS_PER_WEEK, n_bins), dtype=np.int32)
+        assert counts.shape == (N_LOCATIONS, HOURS_PER_WEEK, n_bins)
+        self.counts = counts
+
+    def update(self,
+               location_ids: np.ndarray,
+               pickup_hours: pd.Series,
+               values: np.ndarray) -> "DemandSketch":
+        """
+        Adds one observation per row. All arguments must have the same length,
+        and `pickup_hours` can be a single hour shared by all the rows.
+
+        Rows with a location_id outside 1..N_LOCATIONS are ignored.
+        """
+        location_ids = np.asarray(location_ids, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        if np.ndim(pickup_hours) == 0:
+            pickup_hours = [pickup_hours] * len(location_ids)
+        hours = hour_of_week(pickup_hours)
+
+        valid = (location_ids >= 1) & (location_ids <= N_LOCATIONS) & ~np.isnan(values)
+        rows = location_ids[valid] - 1
+        bins = np.searchsorted(self.bin_edges, values[valid], side='right') - 1
+        bins = np.clip(bins, 0, len(self.bin_edges) - 1)
+
+        np.add.at(self.counts, (rows, hours[valid], bins), 1)
+
+        latest = pd.to_datetime(pd.Series(pickup_hours)).max()
+        if self.last_pickup_hour is None or latest > self.last_pickup_hour:
+            self.last_pickup_hour = latest
+
+        return self
+
+    def merge(self, other: "DemandSketch") -> "DemandSketch":
+        """Returns a new sketch with the observations of both sketches"""
+        if not np.array_equal(self.bin_edges, other.bin_edges):
+            raise ValueError('Cannot merge sketches with different bin edges')
+        last_pickup_hours = [h for h in (self.last_pickup_hour, other.last_pickup_hour) if h is not None]
+        return DemandSketch(self.bin_edges,
+                            self.counts + other.counts,
+                            max(last_pickup_hours) if last_pickup_hours else None)
+
+    @property
+    def n_observations(self) -> int:
+        return int(self.counts.sum())
+
+    def save(self, path: Path) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        last_pickup_hour = '' if self.last_pickup_hour is None else self.last_pickup_hour.isoformat()
+        np.savez_compressed(path,
+                            bin_edges=self.bin_edges,
+                            counts=self.counts,
+                            last_pickup_hour=np.array(last_pickup_hour))
+
+    @classmethod
+    def load(cls, path: Path) -> "DemandSketch":
+        with np.load(path) as data:
+            last_pickup_hour = str(data['last_pickup_hour'])
+            return cls(data['bin_edges'],
+                       data['counts'],
+                       pd.Timestamp(last_pickup_hour) if last_pickup_hour else None)
+
+
+def _divergences(reference: np.ndarray,
+                 current: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Population stability index and Jensen-Shannon divergence between
+    histograms, along the last axis
+    """
+    p = reference + EPSILON
+    p = p / p.sum(axis=-1, keepdims=True)
+    q = current + EPSILON
+    q = q / q.sum(axis=-1, keepdims=True)
+    m = 0.5 * (p + q)
+
+    psi = ((q - p) * np.log(q / p)).sum(axis=-1)
+    js = 0.5 * (p * np.log(p / m)).sum(axis=-1) + 0.5 * (q * np.log(q / m)).sum(axis=-1)
+
+    return psi, js
+
+
+def compute_drift_scores(reference: DemandSketch,
+                         current: DemandSketch,
+                         by_hour_of_week: bool = False) -> pd.DataFrame:
+    """
+    Compares the `current` sketch against the training-time `reference`.
+
+    Args:
+        reference (DemandSketch): sketch built from the training data
+        current (DemandSketch): sketch built in production
+        by_hour_of_week (bool): if True, returns one score per location and
+            hour of the week, instead of one per location
+
+    Returns:
+        pd.DataFrame: columns `pickup_location_id`, (`hour_of_week`),
+        `n_observations`, `psi` and `js_divergence`, sorted by decreasing
+        psi. Only locations (and hours) with current observations are kept.
+        As a rule of thumb, psi > 0.2 is a significant shift.
+    """
+    if by_hour_of_week:
+        ref_counts, cur_counts = reference.counts, current.counts
+    else:
+        ref_counts, cur_counts = reference.counts.sum(axis=1), current.counts.sum(axis=1)
+
+    psi, js = _divergences(ref_counts.astype(np.float64), cur_counts.astype(np.float64))
+    n_obs = cur_counts.sum(axis=-1)
+
+    if by_hour_of_week:
+        location_idx, hours = np.indices(n_obs.shape)
+        scores = pd.DataFrame({
+            'pickup_location_id': location_idx.ravel() + 1,
+            'hour_of_week': hours.ravel(),
+            'n_observations': n_obs.ravel(),
+            'psi': psi.ravel(),
+            'js_divergence': js.ravel(),
+        })
+    else:
+        scores = pd.DataFrame({
+            'pickup_location_id': np.arange(1, N_LOCATIONS + 1),
+            'n_observations': n_obs,
+            'psi': psi,
+            'js_divergence': js,
+        })
+
+    scores = scores[scores['n_observations'] > 0]
+
+    return scores.sort_values(by='psi', ascending=False).reset_index(drop=True)
+
+
+def get_week_key(current_date: datetime) -> str:
+    """Name of the weekly sketch `current_date` belongs to, e.g. '2026-W03'"""
+    year, week, _ = pd.Timestamp(current_date).isocalendar()
+    return f'{year}-W{week:02d}'
@@ -1,26 +1,84 @@
-from typing import Optional
-import hsfs
-import hopsworks
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
 
 import src.config as config
+from src.paths import DATA_DIR
 
-def get_feature_store() -> hsfs.feature_store.FeatureStore:
+if TYPE_CHECKING:
+    import hopsworks
+    import hsfs
+    from hopsworks.core.dataset_api import DatasetApi
+    import numpy as np
+    import pandas as pd
+
+# digests of what was last written to each feature group, one file per
+# feature group version
+WRITE_DIGESTS_DIR = DATA_DIR / 'write_digests'
+
+def get_hopsworks_project() -> "hopsworks.project.Project":
+    """
+    Connects to Hopsworks and returns the project
+    """
+    import hopsworks
+
+    return hopsworks.login(
+        project=config.HOPSWORKS_PROJECT_NAME,
+        api_key_value=config.HOPSWORKS_API_KEY
+    )
+
+def get_feature_store() -> "hsfs.feature_store.FeatureStore":
     """
     Connects to Hopsworks and returns a pointer to the feature store
     
     Returns:
         hsfs.feature_store.FeatureStore: pointer to the feature store
     """
-    project = hopsworks.login(
-        project=config.HOPSWORKS_PROJECT_NAME,
-        api_key_value=config.HOPSWORKS_API_KEY
-    )
-    return project.get_feature_store()
+    return get_hopsworks_project().get_feature_store()
+
+def get_dataset_api() -> "DatasetApi":
+    """
+    Datasets of the project, where the pipelines share files with each
+    other and with the apps
+    """
+    return get_hopsworks_project().get_dataset_api()
+
+def download_dataset_file(remote_dir: str,
+                          local_path: Path,
+                          dataset_api: Optional["DatasetApi"] = None) -> bool:
+    """
+    Downloads the file named like `local_path` from `remote_dir` in the
+    project's datasets to `local_path`
+
+    Returns:
+        bool: False if there is no such file in `remote_dir`
+    """
+    dataset_api = dataset_api or get_dataset_api()
+    remote_path = f'{remote_dir}/{Path(local_path).name}'
+    if not dataset_api.exists(remote_path):
+        return False
+
+    Path(local_path).parent.mkdir(parents=True, exist_ok=True)
+    dataset_api.download(remote_path, local_path=str(Path(local_path).parent), overwrite=True)
+    return True
+
+def upload_dataset_file(local_path: Path,
+                        remote_dir: str,
+                        dataset_api: Optional["DatasetApi"] = None) -> None:
+    """
+    Uploads `local_path` to `remote_dir` in the project's datasets,
+    replacing the file of the same name
+    """
+    dataset_api = dataset_api or get_dataset_api()
+    if not dataset_api.exists(remote_dir):
+        dataset_api.mkdir(remote_dir)
+    dataset_api.upload(str(local_path), remote_dir, overwrite=True)
 
 def get_feature_group(
         name: str,
         version: Optional[int] = 1
-) -> hsfs.feature_group.FeatureGroup:
+) -> "hsfs.feature_group.FeatureGroup":
     """
     Connects to the feature store and returns a pointer to the given
     feature group `name`
@@ -82,4 +140,275 @@ def get_feature_view(name: str, version: int = 1):
     return feature_store.get_feature_view(
         name=name,
         version=version
-    )
\ No newline at end of file
+    )
+
+
+def _get_write_digest_path(feature_group) -> Path:
+    return WRITE_DIGESTS_DIR / f'{feature_group.name}_v{feature_group.version}.npz'
+
+
+def _load_write_digest(path: Path) -> Tuple["np.ndarray", "np.ndarray"]:
+    """
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: sorted partition keys (hours as int64
+        nanoseconds since epoch, UTC) and their uint64 digests
+    """
+    import numpy as np
+
+    if not Path(path).exists():
+        return np.array([], dtype=np.int64), np.array([], dtype=np.uint64)
+    with np.load(path) as data:
+        return data['keys'], data['digests']
+
+
+def _save_write_digest(path: Path,
+                       keys: "np.ndarray",
+                       digests: "np.ndarray") -> None:
+    """Writes the digest, replacing `path` atomically"""
+    import numpy as np
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.npz.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, keys=keys, digests=digests)
+    os.replace(tmp_path, path)
+
+
+def _pull_write_digest(path: Path) -> Optional["DatasetApi"]:
+    """
+    Replaces the local digest in `path` with the one shared in the
+    project's datasets, if there is one
+
+    Returns:
+        Optional[DatasetApi]: to push the digest back with. None if the
+        project could not be reached, in which case the local digest is
+        used, and at worst rows that did not change are written again
+    """
+    try:
+        dataset_api = get_dataset_api()
+        download_dataset_file(config.WRITE_DIGESTS_DATASET_DIR, path, dataset_api)
+        return dataset_api
+    except Exception as e:
+        print(f'Could not download the shared write digest: {e!r}')
+        return None
+
+
+def _push_write_digest(path: Path, dataset_api: "DatasetApi") -> None:
+    try:
+        upload_dataset_file(path, config.WRITE_DIGESTS_DATASET_DIR, dataset_api)
+    except Exception as e:
+        print(f'Could not upload the shared write digest: {e!r}')
+
+
+def _partition_keys(df: "pd.DataFrame", partition_col: str) -> "np.ndarray":
+    # int64 nanoseconds since epoch, in UTC for tz-aware columns
+    import pandas as pd
+    return pd.DatetimeIndex(df[partition_col]).as_unit('ns').asi8
+
+
+def compute_partition_digests(
+    df: "pd.DataFrame",
+    partition_col: str = 'pickup_hour'
+) -> Tuple["np.ndarray", "np.ndarray", "np.ndarray"]:
+    """
+    Hashes every row of `df` and adds up the hashes of each partition, so the
+    digest of a partition does not depend on the order of its rows.
+
+    Args:
+        df (pd.DataFrame): rows to write
+        partition_col (str): datetime column that defines the partitions
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]:
+            - sorted partition keys, as int64 nanoseconds since epoch (UTC)
+            - uint64 digest of each partition
+            - partition index (into the keys) of each row of `df`
+    """
+    import numpy as np
+    import pandas as pd
+
+    # same column order and datetime resolution on every call, so digests
+    # are comparable across runs
+    hashed = df[sorted(df.columns)]
+    datetime_cols = hashed.select_dtypes(include=['datetime', 'datetimetz']).columns
+    hashed = hashed.assign(**{col: hashed[col].dt.as_unit('ns') for col in datetime_cols})
+    row_hashes = pd.util.hash_pandas_object(hashed, index=False).to_numpy()
+
+    keys, row_partitions = np.unique(_partition_keys(df, partition_col), return_inverse=True)
+
+    # uint64 sums wrap around, which is fine for a digest
+    order = np.argsort(row_partitions, kind='stable')
+    starts = np.searchsorted(row_partitions[order], np.arange(len(keys)))
+    digests = np.add.reduceat(row_hashes[order], starts) if len(keys) \
+        else np.array([], dtype=np.uint64)
+
+    return keys, digests.astype(np.uint64), row_partitions
+
+
+def get_changed_rows(
+    df: "pd.DataFrame",
+    previous_keys: "np.ndarray",
+    previous_digests: "np.ndarray",
+    partition_col: str = 'pickup_hour'
+) -> Tuple["pd.DataFrame", "np.ndarray", "np.ndarray"]:
+    """
+    Compares the partitions of `df` with the digests of the last write.
+
+    Returns:
+        Tuple[pd.DataFrame, np.ndarray, np.ndarray]:
+            - rows of the partitions that are new or changed
+            - keys of those partitions
+            - their new digests
+    """
+    import numpy as np
+
+    keys, digests, row_partitions = compute_partition_digests(df, partition_col)
+
+    # previous_keys are sorted, so each key is looked up with a binary search
+    positions = np.searchsorted(previous_keys, keys)
+    positions = np.minimum(positions, max(len(previous_keys) - 1, 0))
+    if len(previous_keys):
+        unchanged = (previous_keys[positions] == keys) & (previous_digests[positions] == digests)
+    else:
+        unchanged = np.zeros(len(keys), dtype=bool)
+
+    changed = ~unchanged
+    changed_rows = df[changed[row_partitions]]
+
+    return changed_rows, keys[changed], digests[changed]
+
+
+def _split_into_chunks(df: "pd.DataFrame",
+                       partition_col: str,
+                       chunk_size: int) -> List["pd.DataFrame"]:
+    """
+    Splits `df` into chunks of about `chunk_size` rows, without splitting a
+    partition, so each partition is written (and acknowledged) as a whole
+    """
+    import numpy as np
+
+    df = df.sort_values(partition_col, kind='stable')
+    partition_values = _partition_keys(df, partition_col)
+
+    # rows where a new partition starts, and the chunk each one falls in
+    starts = np.flatnonzero(np.r_[True, partition_values[1:] != partition_values[:-1]])
+    chunk_of_start = starts // chunk_size
+    chunk_starts = starts[np.r_[True, chunk_of_start[1:] != chunk_of_start[:-1]]]
+    bounds = np.r_[chunk_starts, len(df)]
+
+    return [df.iloc[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def delta_insert(
+    feature_group,
+    df: "pd.DataFrame",
+    partition_col: str = 'pickup_hour',
+    write_options: Optional[Dict] = None,
+    chunk_size: int = 50_000,
+    n_jobs: int = 4,
+    digest_path: Optional[Path] = None,
+    shared: bool = True
+) -> "pd.DataFrame":
+    """
+    Inserts into `feature_group` only the partitions (e.g. hours) of `df`
+    that are new or changed since the last `delta_insert` into it.
+
+    A digest per partition of what was written is kept in `digest_path`.
+    It is only updated for the partitions whose insert succeeded, so a
+    failed write is retried by the next call. With `shared`, the digest is
+    also kept in the project's datasets (config.WRITE_DIGESTS_DATASET_DIR),
+    so runs on fresh machines, as the scheduled workflows, start from it.
+
+    When there are more than `chunk_size` rows to write, they are inserted
+    in chunks of whole partitions from `n_jobs` threads. The offline
+    materialization job then runs once, after all chunks, instead of once
+    per chunk.
+
+    Args:
+        feature_group: feature group to insert into
+        df (pd.DataFrame): full frame to write, e.g. the last 28 days
+        partition_col (str): datetime column that defines the partitions
+        write_options (Optional[Dict]): passed to `feature_group.insert`.
+            Defaults to {"wait_for_job": True}
+        chunk_size (int): approximate number of rows per insert
+        n_jobs (int): number of parallel inserts
+        digest_path (Optional[Path]): digest file. Defaults to one file
+            per feature group version in WRITE_DIGESTS_DIR
+        shared (bool): download the digest from the project's datasets
+            before comparing, and upload it back after the insert
+
+    Returns:
+        pd.DataFrame: rows that were inserted
+    """
+    import numpy as np
+
+    write_options = {"wait_for_job": True, **(write_options or {})}
+    digest_path = digest_path or _get_write_digest_path(feature_group)
+    dataset_api = _pull_write_digest(digest_path) if shared else None
+
+    previous_keys, previous_digests = _load_write_digest(digest_path)
+    changed_rows, changed_keys, changed_digests = get_changed_rows(
+        df, previous_keys, previous_digests, partition_col)
+
+    print(f'Inserting {len(changed_rows)} of {len(df)} rows '
+          f'({len(changed_keys)} new or changed {partition_col} values)')
+    if changed_rows.empty:
+        return changed_rows
+
+    chunks = _split_into_chunks(changed_rows, partition_col, chunk_size)
+    if len(chunks) == 1:
+        feature_group.insert(changed_rows, write_options=write_options)
+        written_keys = changed_keys
+        errors = []
+    else:
+        chunk_options = {**write_options, "start_offline_materialization": False}
+
+        def _insert(chunk):
+            feature_group.insert(chunk, write_options=chunk_options)
+
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(_insert, chunk) for chunk in chunks]
+
+        errors, written = [], []
+        for chunk, future in zip(chunks, futures):
+            if future.exception() is None:
+                written.append(np.unique(_partition_keys(chunk, partition_col)))
+            else:
+                errors.append(future.exception())
+        written_keys = np.concatenate(written) if written else np.array([], dtype=np.int64)
+
+        if written:
+            feature_group.materialization_job.run(
+                await_termination=write_options["wait_for_job"])
+
+    # record the digests of the partitions that made it, then surface errors
+    is_written = np.isin(changed_keys, written_keys)
+    keys = np.concatenate([previous_keys, changed_keys[is_written]])
+    digests = np.concatenate([previous_digests, changed_digests[is_written]])
+    # the last occurrence of a key is the newest digest
+    keys, last = np.unique(keys[::-1], return_index=True)
+    _save_write_digest(digest_path, keys, digests[::-1][last])
+    if dataset_api is not None:
+        _push_write_digest(digest_path, dataset_api)
+
+    if errors:
+        raise errors[0]
+
+    return changed_rows
+
+
+def reset_write_digest(feature_group, shared: bool = True) -> None:
+    """
+    Forgets what was written to `feature_group`, so the next `delta_insert`
+    writes the whole frame, e.g. after the feature group was recreated.
+    With `shared`, the digest in the project's datasets is removed too
+    """
+    path = _get_write_digest_path(feature_group)
+    path.unlink(missing_ok=True)
+
+    if shared:
+        dataset_api = get_dataset_api()
+        remote_path = f'{config.WRITE_DIGESTS_DATASET_DIR}/{path.name}'
+        if dataset_api.exists(remote_path):
+            dataset_api.remove(remote_path)
@@ -22,8 +22,11 @@ from src.inference import(
     get_model_predictions
 )
 
+import src.config as config
+from src.map_payload import ZoneMapPayloads
 from src.paths import DATA_DIR
-from src.plot import plot_one_sample
+from src.plot import plot_top_samples
+from src.prediction_cache import PredictionCache
 
 st.set_page_config(layout="wide")
 
@@ -34,7 +37,7 @@ st.header(f'{current_date}')
 
 progress_bar = st.sidebar.header('o Working progress')
 progress_bar = st.sidebar.progress(0)
-N_STEPS = 7
+N_STEPS = 6
 
 
 def load_shape_data_file():
@@ -42,6 +45,7 @@ def load_shape_data_file():
     # download file
     URL = 'https://d37ci6vzurychx.cloudfront.net/misc/taxi_zones.zip'
     response = requests.get(url=URL)
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
     path = DATA_DIR / f'taxi_zones.zip'
     if response.status_code == 200:
         open(path, "wb").write(response.content)
@@ -55,47 +59,51 @@ def load_shape_data_file():
     # load and return shape file
     return gpd.read_file(DATA_DIR / 'taxi_zones/taxi_zones.shp').to_crs('epsg:4326')
 
+@st.cache_resource
+def _get_map_payloads() -> ZoneMapPayloads:
+    """Shape data and map payloads, shared by all the sessions of the app,
+    so the shape file is downloaded and serialized only once per process
+    """
+    return ZoneMapPayloads(load_shape_data_file())
+
+@st.cache_resource
+def _get_prediction_cache() -> PredictionCache:
+    """Features and predictions of each hour, computed once and shared by
+    all the sessions (and reruns) of the app
+    """
+    return PredictionCache()
+
+@st.cache_resource
+def _get_model():
+    """Model from the registry, loaded once per process, and only when
+    the predictions of an hour are not cached yet
+    """
+    return load_model_from_registry()
+
+prediction_cache = _get_prediction_cache()
+
 with st.spinner(text="Downloading shape file to plot taxi zones"):
-    geo_df = load_shape_data_file()
+    map_payloads = _get_map_payloads()
     st.sidebar.write('Shape file was downloaded')
     progress_bar.progress(1/N_STEPS)
 
 with st.spinner(text="Fetching batch of inference data"):
-    features = load_batch_of_features_from_store(current_date=current_date)
+    # read from the store once per hour, for every session
+    features = prediction_cache.get_features(current_date, load_batch_of_features_from_store)
     st.sidebar.write('Inference features fetched from the store')
     progress_bar.progress(2/N_STEPS)
-    print(f'{features}')
-
-with st.spinner(text="Loading ML model from the registry"):
-    model = load_model_from_registry()
-    st.sidebar.write('ML model was loaded from the registry')
-    progress_bar.progress(3/N_STEPS)
 
 with st.spinner(text="Computing model predictions"):
-    results = get_model_predictions(model, features)
+    # the model is only loaded (and run) when this hour is not cached yet
+    results = prediction_cache.get_predictions(
+        current_date, config.MODEL_VERSION, features,
+        lambda features: get_model_predictions(_get_model(), features))
     st.sidebar.write('Model predictions completed')
-    progress_bar.progress(4/N_STEPS)
+    progress_bar.progress(3/N_STEPS)
 
 with st.spinner(text="Preparing data to plot"):
-
-    def pseudocolor(val, minval, maxval, startcolor, stopcolor):
-        """
-        Convert value in the range minval..maxval to a color in the range
-        startcolor to stopcolor. The colors passed and the one returned are
-        composed of a sequence of N component values.
-        
-        Credis to https://stackoverflow.com/a/10987855
-        """
-        f = float(val - minval) / (maxval - minval)
-        return tuple(f*(b-a)+a for (a, b) in zip(startcolor, stopcolor))
-    
-    df = pd.merge(geo_df, results, right_on='pickup_location_id', left_on='LocationID')
-
-    BLACK, GREEN = (0, 0, 0), (0, 255, 0)
-    df['color_scaling'] = df['predicted_demand']
-    max_pred, min_pred = df['color_scaling'].max(), df['color_scaling'].min()
-    df['fill_color'] = df['color_scaling'].apply(lambda x: pseudocolor(x, min_pred, max_pred, BLACK, GREEN))
-    progress_bar.progress(5/N_STEPS)
+    map_data = map_payloads.get(current_date, config.MODEL_VERSION, results)
+    progress_bar.progress(4/N_STEPS)
 
 with st.spinner(text="Generating NYC Map"):
 
@@ -110,20 +118,20 @@ with st.spinner(text="Generating NYC Map"):
 
     geojson = pdk.Layer(
         "GeoJsonLayer",
-        df,
+        map_data,
         opacity=0.25,
         stroked=False,
         filled=True,
         extruded=False,
         wireframe=True,
         get_elevation=10,
-        get_fill_color='fill_color',
+        get_fill_color='properties.fill_color',
         get_line_color=[255, 255, 255],
         auto_highight=True,
         pickable=True
     )
 
-    tooltip = {"html": "<b>Zone:</b> [{LocationID}] {zone} <br /> <b>Predicted rides:</b> {predicted_demand}"}
+    tooltip = {"html": "<b>Zone:</b> [{properties.LocationID}] {properties.zone} <br /> <b>Predicted rides:</b> {properties.predicted_demand}"}
 
     r = pdk.Deck(
         layers=[geojson],
@@ -132,20 +140,17 @@ with st.spinner(text="Generating NYC Map"):
     )
 
     st.pydeck_chart(r)
-    progress_bar.progress(6/N_STEPS)
+    progress_bar.progress(5/N_STEPS)
 
 with st.spinner(text="Plotting time-series data"):
-    row_indices = np.argsort(results['predicted_demand'].values)[::-1]
     n_to_plot = 10
 
-    # plot each time-series with the prediction
-    for row_id in row_indices[:n_to_plot]:
-        fig = plot_one_sample(
-            features=features,
-            targets=results['predicted_demand'],
-            example_id=row_id,
-            predictions=pd.Series(results['predicted_demand'])
-        )
-        st.plotly_chart(fig, theme='streamlit', use_container_width=True, width='stretch')
-
-    progress_bar.progress(7/N_STEPS)
\ No newline at end of file
+    # one faceted figure with the top locations by predicted demand
+    fig = plot_top_samples(
+        features=features,
+        predictions=results['predicted_demand'],
+        n_to_plot=n_to_plot
+    )
+    st.plotly_chart(fig, theme='streamlit', use_container_width=True, width='stretch')
+
+    progress_bar.progress(6/N_STEPS)
@@ -6,13 +6,16 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from datetime import datetime, timedelta, timezone
 
-import numpy as np
 import pandas as pd
 import streamlit as st
-from sklearn.metrics import mean_absolute_error
 import plotly.express as px
 
-from src.monitoring import load_predictions_and_actual_values_from_store
+from src.metrics import (
+    ALL_LOCATIONS,
+    load_error_metrics_from_store,
+    summarize_error_metrics
+)
+from src.rollup import RollupCube, download_rollup_cube
 
 st.set_page_config(layout='wide')
 
@@ -22,57 +25,76 @@ st.title(f'Monitring dashboard 🔍')
 
 progress_bar = st.sidebar.header('⚙️ Working Progress')
 progress_bar = st.sidebar.progress(0)
-N_STEPS = 3
+N_STEPS = 4
 
 @st.cache_data
-def _load_predictions_and_actual_values_from_store(
+def _load_error_metrics_from_store(
     from_date: datetime,
     to_date: datetime
 ) -> pd.DataFrame:
     """
-    Wrapped version of src.monitoring.load_predictions_and_actual_values_from_store, so
+    Wrapped version of src.metrics.load_error_metrics_from_store, so
     we can add Streamlit Caching
     
     Args:
-        from_date (datetime): min datetime for which we want predictions and actual values
+        from_date (datetime): min datetime for which we want error metrics
 
-        from_date (datetime): max datetime for which we want predictions and actual values
+        to_date (datetime): max datetime for which we want error metrics
     
     Returns:
         pd.DataFrame: DataFrame with columns:
-            - pickup_location_id
             - pickup_hour
-            - predicted_demand
-            - rides (actual demand)
+            - pickup_location_id (ALL_LOCATIONS for the per-hour aggregates)
+            - n_obs, rides, predicted_demand, abs_error, error, abs_pct_error, n_nonzero
+            - mae, mape, bias
     """
-    return load_predictions_and_actual_values_from_store(from_date, to_date)
+    return load_error_metrics_from_store(from_date, to_date)
 
-with st.spinner(text='Fetching model predictions and actual values from the store'):
-    monitoring_df = _load_predictions_and_actual_values_from_store(
-        from_date=current_date - timedelta(days=14),
+@st.cache_data
+def _get_borough_metrics(
+    _metrics: pd.DataFrame,
+    from_date: datetime,
+    to_date: datetime
+) -> pd.DataFrame:
+    """
+    Error metrics per borough between `from_date` and `to_date`, read by
+    index from the rollup cube `materialize_error_metrics` shares next to
+    the metrics feature group. Rolled up from the loaded `_metrics` only if
+    no cube was shared yet. Cached per (from_date, to_date), which changes
+    every hour, like the metrics
+    """
+    cube = download_rollup_cube()
+    if cube is None:
+        cube = RollupCube.from_metrics(_metrics)
+    return cube.query('borough', from_hour=from_date, to_hour=to_date, by_hour=False)
+
+from_date = current_date - timedelta(days=14)
+
+with st.spinner(text='Fetching error metrics from the store'):
+    metrics_df = _load_error_metrics_from_store(
+        from_date=from_date,
         to_date=current_date
     )
-    st.sidebar.write('✅ Model predictions and actual values loaded')
+    st.sidebar.write('✅ Error metrics loaded')
     progress_bar.progress(1/N_STEPS)
 
-if monitoring_df.empty:
-    st.error("⚠️ No data available! The monitoring DataFrame is empty.")
+if metrics_df.empty:
+    st.error("⚠️ No data available! The error metrics table is empty.")
     st.stop()
 
 with st.spinner(text='Plotting aggregate MAE hour-by-hour'):
 
+    # global metrics over the whole period
+    summary = summarize_error_metrics(metrics_df).iloc[0]
+    col_mae, col_mape, col_bias = st.columns(3)
+    col_mae.metric('MAE', f"{summary['mae']:.2f}")
+    col_mape.metric('MAPE', f"{100 * summary['mape']:.1f}%")
+    col_bias.metric('Bias', f"{summary['bias']:+.2f}")
+
     st.header('Mean Absolute Error (MAE) hour-by-hour')
     
-    # MAE per pickup_hour
-    # Calculate absolute error first, then aggregate
-    monitoring_df['abs_error'] = abs(monitoring_df['rides'] - monitoring_df['predicted_demand'])
-    mae_per_hour = (
-        monitoring_df
-        .groupby('pickup_hour')['abs_error']
-        .mean()
-        .reset_index(name='mae')
-        .sort_values(by='pickup_hour')
-    )
+    # MAE per pickup_hour, already aggregated over all locations
+    mae_per_hour = metrics_df[metrics_df.pickup_location_id == ALL_LOCATIONS]
 
     fig = px.bar(
         mae_per_hour,
@@ -83,16 +105,30 @@ with st.spinner(text='Plotting aggregate MAE hour-by-hour'):
 
     progress_bar.progress(2/N_STEPS)
 
+with st.spinner(text='Plotting MAE per borough'):
+
+    st.header('Mean Absolute Error (MAE) per borough')
+
+    borough_metrics = _get_borough_metrics(metrics_df, from_date, current_date)
+    fig = px.bar(
+        borough_metrics,
+        x='group', y='mae',
+        hover_data=['rides', 'predicted_demand', 'mape', 'bias', 'rollup_abs_error'],
+        labels={'group': 'borough'},
+        template='plotly_dark',
+    )
+    st.plotly_chart(fig, theme="streamlit", use_container_width=True, width="stretch")
+
+    progress_bar.progress(3/N_STEPS)
+
 with st.spinner(text="Plotting MAE hour-by-hour for top locations"):
 
     st.header('Mean Absolute Error (MAE) per location per hour')
 
+    per_location = metrics_df[metrics_df.pickup_location_id != ALL_LOCATIONS]
     top_locations_by_demand = (
-        monitoring_df
-        .groupby('pickup_location_id')['rides']
-        .sum()
-        .sort_values(ascending=False)
-        .reset_index()
+        summarize_error_metrics(per_location, by=['pickup_location_id'])
+        .sort_values(by='rides', ascending=False)
         .head(10)['pickup_location_id']
     )
 
@@ -100,14 +136,7 @@ with st.spinner(text="Plotting MAE hour-by-hour for top locations"):
         
         st.subheader(f'Location ID: {location_id}')
         
-        mae_per_hour = (
-            monitoring_df[monitoring_df.pickup_location_id == location_id]
-            .groupby('pickup_hour')
-            .apply(lambda g: mean_absolute_error(g['rides'], g['predicted_demand']))
-            .reset_index()
-            .rename(columns={0: 'mae'})
-            .sort_values(by='pickup_hour')
-        )
+        mae_per_hour = per_location[per_location.pickup_location_id == location_id]
 
         fig = px.bar(
             mae_per_hour,
@@ -116,5 +145,4 @@ with st.spinner(text="Plotting MAE hour-by-hour for top locations"):
         )
         st.plotly_chart(fig, theme="streamlit", use_container_width=True, width="stretch")
 
-    progress_bar.progress(3/N_STEPS)
-
+    progress_bar.progress(4/N_STEPS)
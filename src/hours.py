@@ -0,0 +1,99 @@
+"""
+Canonical representation of `pickup_hour`: an int32 number of hours since
+1970-01-01 00:00 UTC.
+
+`pickup_hour` arrives as naive UTC datetimes (local files), tz-aware UTC
+datetimes (feature store, pipelines) or strings. Converting it once to an
+hour index, at the boundary where the data is read, makes the comparisons,
+joins and windowing integer arithmetic, with no timezone to reconcile.
+Naive datetimes are taken as UTC.
+"""
+from datetime import datetime
+from typing import Union
+
+import numpy as np
+import pandas as pd
+
+HOUR_INDEX_DTYPE = np.int32
+
+HOURS_PER_WEEK = 24 * 7
+
+# 1970-01-01 was a Thursday, dayofweek 3 (Monday is 0)
+_EPOCH_DAY_OF_WEEK = 3
+
+
+def to_utc(hours):
+    """Timestamp or DatetimeIndex in UTC, localizing naive ones"""
+    if hours.tz is None:
+        return hours.tz_localize('UTC')
+    return hours.tz_convert('UTC')
+
+
+def to_naive_utc(hours):
+    """Timestamp or DatetimeIndex as naive UTC, converting tz-aware ones"""
+    if hours.tz is None:
+        return hours
+    return hours.tz_convert('UTC').tz_localize(None)
+
+
+def to_hour_index(hours) -> Union[int, np.ndarray]:
+    """
+    Hours since the epoch of `hours`, rounded down to the hour.
+
+    Args:
+        hours: one datetime (or string), or a Series, DatetimeIndex or array
+            of them. Integers are taken as hour indices already, and only
+            cast to int32
+
+    Returns:
+        Union[int, np.ndarray]: int for a single hour, int32 array otherwise
+    """
+    if isinstance(hours, (datetime, np.datetime64, str)):
+        # Timestamp.value is in nanoseconds since the epoch, in UTC
+        return int(pd.Timestamp(hours).value // 3_600_000_000_000)
+    if isinstance(hours, (int, np.integer)):
+        return int(hours)
+
+    if not hasattr(hours, 'dtype'):
+        hours = np.asarray(hours)
+    if pd.api.types.is_integer_dtype(hours.dtype):
+        return np.asarray(hours, dtype=HOUR_INDEX_DTYPE)
+
+    # asi8 is the time since the epoch in UTC, also for tz-aware hours
+    seconds = pd.DatetimeIndex(hours).as_unit('s').asi8
+    return (seconds // 3600).astype(HOUR_INDEX_DTYPE)
+
+
+def from_hour_index(hour_index, utc: bool = True):
+    """
+    Timestamps of hour indices, tz-aware UTC or naive UTC.
+    Meant for the boundaries where the data is written or shown.
+
+    Returns:
+        pd.Timestamp for a single index, pd.DatetimeIndex otherwise
+    """
+    tz = 'UTC' if utc else None
+    if np.ndim(hour_index) == 0:
+        return pd.Timestamp(int(hour_index) * 3600, unit='s', tz=tz)
+    seconds = np.asarray(hour_index, dtype=np.int64) * 3600
+    hours = pd.DatetimeIndex(seconds.astype('datetime64[s]'))
+    return hours.tz_localize('UTC') if utc else hours
+
+
+def hour_of_day(hour_index):
+    """Hour of the day, from 0 to 23"""
+    return hour_index % 24
+
+
+def day_of_week(hour_index):
+    """Day of the week, from 0 (Monday) to 6 (Sunday)"""
+    return (hour_index // 24 + _EPOCH_DAY_OF_WEEK) % 7
+
+
+def hour_of_week(hours) -> np.ndarray:
+    """
+    Hour of the week, from 0 (Monday 00:00) to 167 (Sunday 23:00), of hour
+    indices or datetimes
+    """
+    hour_index = np.asarray(to_hour_index(hours), dtype=np.int64)
+    return day_of_week(hour_index) * 24 + hour_of_day(hour_index)
@@ -0,0 +1,115 @@
+"""
+Import-time budget of the src modules.
+
+Each module is imported in a fresh interpreter with `python -X importtime`.
+The check fails if a module takes longer than its budget, or if importing it
+pulls in one of the heavy dependencies that must only load on first use.
+
+Run it from the project root with:
+
+    python -m src.import_budget
+"""
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+from src.paths import PARENT_DIR
+
+# cumulative import time budget per module, in milliseconds. Most modules
+# import pandas, which alone takes ~300-500ms, so their budget is dominated
+# by it. The budgets are loose enough to absorb CI noise, but catch any
+# module that starts importing lightgbm, sklearn or hopsworks eagerly
+IMPORT_TIME_BUDGETS_MS: Dict[str, int] = {
+    'src.paths': 50,
+    'src.config': 50,
+    'src.hours': 1000,
+    'src.feature_store_api': 100,
+    'src.data': 1000,
+    'src.data_quality': 1000,
+    'src.data_split': 1000,
+    'src.model': 1000,
+    'src.sampling': 1000,
+    'src.arrow_features': 1000,
+    'src.inference': 1000,
+    'src.inference_1': 1000,
+    'src.batch_inference': 1000,
+    'src.shadow': 1000,
+    'src.monitoring': 1000,
+    'src.metrics': 1000,
+    'src.rollup': 1000,
+    'src.drift': 1000,
+    'src.online_features': 1000,
+    'src.pipelines': 1000,
+    'src.scheduler': 1000,
+    'src.map_payload': 1000,
+    'src.prediction_cache': 1000,
+    'src.prediction_store': 1000,
+    'src.plot': 1000,
+    'src.backtest': 1000,
+}
+
+# dependencies that must be imported lazily, inside the functions that use them
+LAZY_DEPENDENCIES = [
+    'hopsworks', 'hsfs', 'hsml', 'lightgbm', 'sklearn', 'streamlit',
+    'requests', 'plotly', 'dotenv', 'scipy', 'polars',
+]
+
+
+def measure_import(module: str, n_runs: int = 3) -> Tuple[float, List[str]]:
+    """
+    Imports `module` in `n_runs` fresh interpreters
+
+    Returns:
+        Tuple[float, List[str]]:
+            - best cumulative import time of `module`, in milliseconds
+            - LAZY_DEPENDENCIES that were imported along with it
+    """
+    code = (
+        f'import sys; import {module}; '
+        f'print(",".join(m for m in {LAZY_DEPENDENCIES!r} if m in sys.modules))'
+    )
+
+    best_ms, eager = float('inf'), []
+    for _ in range(n_runs):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code],
+            cwd=PARENT_DIR, capture_output=True, text=True, check=True
+        )
+
+        # lines look like "import time:   self [us] | cumulative | imported package"
+        for line in result.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == module:
+                best_ms = min(best_ms, int(fields[1]) / 1000)
+
+        eager = [m for m in result.stdout.strip().split(',') if m]
+
+    return best_ms, eager
+
+
+def check_import_budgets(
+        budgets: Dict[str, int] = IMPORT_TIME_BUDGETS_MS) -> List[str]:
+    """
+    Returns:
+        List[str]: one message per module over budget or with eager heavy
+        imports. Empty if all modules are within budget
+    """
+    violations = []
+    for module, budget_ms in budgets.items():
+        elapsed_ms, eager = measure_import(module)
+        status = 'ok' if elapsed_ms <= budget_ms and not eager else 'FAIL'
+        print(f'{module:<24} {elapsed_ms:8.1f} ms  (budget {budget_ms} ms)  {status}')
+
+        if elapsed_ms > budget_ms:
+            violations.append(f'{module} took {elapsed_ms:.1f} ms to import (budget {budget_ms} ms)')
+        if eager:
+            violations.append(f'{module} imports {eager} eagerly')
+
+    return violations
+
+
+if __name__ == '__main__':
+    violations = check_import_budgets()
+    for violation in violations:
+        print(violation)
+    sys.exit(1 if violations else 0)
@@ -1,20 +1,29 @@
-from datetime import datetime, timedelta
+from datetime import datetime
+from typing import Optional, Sequence, TYPE_CHECKING
 
-import hopsworks
-from hsfs.feature_store import FeatureStore
-import pandas as pd
 import numpy as np
+import pandas as pd
 
 import src.config as config
+from src.arrow_features import load_lag_matrix_from_store
+from src.hours import from_hour_index, to_hour_index
+from src.model import get_features_from_lag_matrix, predict_features
+from src.online_features import RideHistoryBuffer
+from src.prediction_store import PREDICTION_COLUMNS, LocalPredictionStore
+
+if TYPE_CHECKING:
+    import hopsworks
+    from hsfs.feature_store import FeatureStore
 
-def get_hopsworks_project() -> hopsworks.project.Project:
+def get_hopsworks_project() -> "hopsworks.project.Project":
+    import hopsworks
 
     return hopsworks.login(
         project=config.HOPSWORKS_PROJECT_NAME,
         api_key_value=config.HOPSWORKS_API_KEY
     )
 
-def get_feature_store() -> FeatureStore:
+def get_feature_store() -> "FeatureStore":
     project = get_hopsworks_project()
     return project.get_feature_store()
 
@@ -22,7 +31,7 @@ def get_model_predictions(model, features: pd.DataFrame) -> pd.DataFrame:
     """"""
 
     # past rides_columns = [c for c in features.columns if c.startswith('rides_)]
-    predictions = model.predict(features)
+    predictions = predict_features(model, features)
 
     results = pd.DataFrame()
     results['pickup_location_id'] = features['pickup_location_id'].values
@@ -30,7 +39,11 @@ def get_model_predictions(model, features: pd.DataFrame) -> pd.DataFrame:
 
     return results
 
-def load_batch_of_features_from_store(current_date: datetime,) -> pd.DataFrame:
+def load_batch_of_features_from_store(
+    current_date: datetime,
+    online_buffer: Optional[RideHistoryBuffer] = None,
+    lags: Optional[Sequence[int]] = None
+) -> pd.DataFrame:
 
     """Fetches the batch of features used by the ML system for `current_date`
     
@@ -38,6 +51,14 @@ def load_batch_of_features_from_store(current_date: datetime,) -> pd.DataFrame:
         current_date (datetime): datetime of the prediction for which 
         we want to get the batch of features
 
+        online_buffer (Optional[RideHistoryBuffer]): in-memory history of
+        rides. If it already has the hour before `current_date`, features
+        are read from it instead of the feature store
+
+        lags (Optional[Sequence[int]]): lags (in hours) the model uses, see
+        `src.model.get_model_lags`. Only these hours are fetched. All
+        N_FEATURES lags if None
+
     Returns:
         pd.DataFrame: 3 columns:
             - `pickup_hour`
@@ -45,51 +66,18 @@ def load_batch_of_features_from_store(current_date: datetime,) -> pd.DataFrame:
             - `pickup_location_id`
     """
 
-    feature_store = get_feature_store()
-
-    n_features = config.N_FEATURES
-
-    # Find the most recent data available and use that as reference
-    fetch_data_to = current_date - timedelta(hours=1)
-    fetch_data_from = current_date - timedelta(days=28)
-    print(f'Fetching all available data from feature store')
-    feature_view = feature_store.get_feature_view(
-        name=config.FEATURE_VIEW_NAME,
-        version=config.FEATURE_VIEW_VERSION
-    )
-
-    # get_batch_data returns a single DataFrame (not a tuple)
-    ts_data = feature_view.get_batch_data(
-        start_time=(fetch_data_from - timedelta(days=1)),
-        end_time=(fetch_data_to + timedelta(days=1))
-    )
-    ts_data = ts_data[ts_data.pickup_hour.between(fetch_data_from, fetch_data_to)]
-
-    # validate we are not missing data in the feature store
-    location_ids = ts_data['pickup_location_id'].unique()
-    assert len(ts_data) == n_features * len(location_ids) 
-    
-    # sort data by location and time
-    ts_data.sort_values(by=['pickup_location_id', 'pickup_hour'], inplace=True)
-
-    # transpose time-series data as a feature vector, for each location_id
-    x = np.ndarray(shape=(len(location_ids), n_features), dtype=np.float32)
-    for i, location_id in enumerate(location_ids):
-        ts_data_i = ts_data.loc[ts_data.pickup_location_id == location_id, :]
-        ts_data_i = ts_data_i.sort_values(by=['pickup_hour'])
-        x[i, :] = ts_data_i['rides'].values
-
-    # numpy arrays to Pandas dataframes
-    features = pd.DataFrame(
-        x,
-        columns=[f'rides_previous_{i+1}_hour' for i in reversed(range(n_features))]
-    )
+    if online_buffer is not None and online_buffer.covers(current_date):
+        print('Reading features from the online buffer')
+        return online_buffer.get_features(current_date, lags=lags)
 
-    features['pickup_hour'] = current_date
-    features['pickup_location_id'] = location_ids
-    features.sort_values(by=['pickup_location_id'], inplace=True)
+    # the store read is kept in Arrow, and the lag matrix is one buffer
+    # the features are a view of. The store only has the slots with rides,
+    # so the buffer, if any, tells which locations to predict
+    lag_values, lags, location_ids = load_lag_matrix_from_store(
+        current_date, lags,
+        location_ids=online_buffer.location_ids if online_buffer is not None else None)
 
-    return features
+    return get_features_from_lag_matrix(lag_values, lags, location_ids, current_date)
 
 def load_model_from_registry():
 
@@ -111,16 +99,21 @@ def load_model_from_registry():
 
 def load_predictions_from_store(
     from_pickup_hour: datetime,
-    to_pickup_hour: datetime
+    to_pickup_hour: datetime,
+    local_store: Optional[LocalPredictionStore] = None
 ) -> pd.DataFrame:
     """
-    Fetches model predictions from the feature store for a given time range.
+    Fetches model predictions for a given time range, from the local
+    prediction store. Only the hours it does not have are read from the
+    feature store, with a filter on their range, and are mirrored locally.
     
     Args:
         from_pickup_hour (datetime): min datetime (rounded hour) for which we want to get
             predictions
         to_pickup_hour (datetime): max datetime (rounded hour) for which we want to get
             predictions
+        local_store (Optional[LocalPredictionStore]): local copy of the
+            predictions. The one in PREDICTIONS_DIR if None
     
     Returns:
         pd.DataFrame: columns:
@@ -128,36 +121,42 @@ def load_predictions_from_store(
             - predicted_demand
             - pickup_hour
     """
-    from src.feature_store_api import get_feature_store
-    
-    feature_store = get_feature_store()
-    
-    # Get the predictions feature group
-    prediction_fg = feature_store.get_feature_group(
-        name=config.FEATURE_GROUP_MODEL_PREDICTIONS,
-        version=1
-    )
-    
-    # Fetch predictions for the specified time range
-    try:
-        predictions = prediction_fg.read()
-        predictions['pickup_hour'] = pd.to_datetime(predictions['pickup_hour'])
-        
-        # Filter to the requested time range
-        predictions = predictions[
-            predictions['pickup_hour'].between(from_pickup_hour, to_pickup_hour)
-        ]
-        
-        # Sort by pickup_hour and location
-        predictions = predictions.sort_values(
-            by=['pickup_hour', 'pickup_location_id']
-        ).reset_index(drop=True)
-        
-        return predictions
-        
-    except Exception as e:
-        print(f"Error fetching predictions: {e}")
-        raise ValueError(
-            f"Could not fetch predictions from {from_pickup_hour} to {to_pickup_hour}. "
-            f"Make sure the inference pipeline has run and saved predictions."
-        )
+    if local_store is None:
+        local_store = LocalPredictionStore()
+
+    predictions, missing_hours = local_store.read(from_pickup_hour, to_pickup_hour)
+
+    if missing_hours:
+        from src.feature_store_api import get_feature_store
+
+        # Fetch only the range of the missing hours
+        try:
+            prediction_fg = get_feature_store().get_feature_group(
+                name=config.FEATURE_GROUP_MODEL_PREDICTIONS,
+                version=1
+            )
+            remote_predictions = prediction_fg.filter(
+                (prediction_fg.pickup_hour >= from_hour_index(min(missing_hours)))
+                & (prediction_fg.pickup_hour <= from_hour_index(max(missing_hours)))
+            ).read()
+
+        except Exception as e:
+            print(f"Error fetching predictions: {e}")
+            raise ValueError(
+                f"Could not fetch predictions from {from_pickup_hour} to {to_pickup_hour}. "
+                f"Make sure the inference pipeline has run and saved predictions."
+            )
+
+        # hours the local store has may be more recent than the offline
+        # feature group, so only the missing ones are taken from it
+        is_missing = np.isin(to_hour_index(remote_predictions['pickup_hour']), missing_hours)
+        remote_predictions = remote_predictions.loc[is_missing, PREDICTION_COLUMNS]
+        local_store.write(remote_predictions)
+
+        fetched_predictions, _ = local_store.read_hours(missing_hours)
+        predictions = pd.concat([predictions, fetched_predictions], ignore_index=True)
+
+    # Sort by pickup_hour and location
+    return predictions.sort_values(
+        by=['pickup_hour', 'pickup_location_id']
+    ).reset_index(drop=True)
@@ -0,0 +1,165 @@
+"""
+Prebuilt GeoJSON payloads for the NYC taxi zones demand map
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+BLACK, GREEN = (0, 0, 0), (0, 255, 0)
+
+# zone attributes from the shape file we keep in the payload
+ZONE_PROPERTIES = ['LocationID', 'zone', 'borough']
+
+
+def pseudocolor(values: np.ndarray,
+                startcolor: Tuple[int, ...] = BLACK,
+                stopcolor: Tuple[int, ...] = GREEN,
+                minval: Optional[float] = None,
+                maxval: Optional[float] = None) -> np.ndarray:
+    """
+    Vectorized version of the per-row `pseudocolor` the frontends used to
+    apply. Maps each value in the range minval..maxval linearly to a color
+    between `startcolor` and `stopcolor`.
+
+    Args:
+        values (np.ndarray): 1D array of values to color
+        startcolor (Tuple[int, ...]): color for `minval`
+        stopcolor (Tuple[int, ...]): color for `maxval`
+        minval (Optional[float]): lower end of the scale. Defaults to values.min()
+        maxval (Optional[float]): upper end of the scale. Defaults to values.max()
+
+    Returns:
+        np.ndarray: (len(values), len(startcolor)) array of uint8 colors.
+        When maxval == minval there is no range to scale over, and every
+        value gets `startcolor` instead of a division by zero.
+    """
+    values = np.nan_to_num(np.asarray(values, dtype=np.float64))
+    if len(values) == 0:
+        return np.empty((0, len(startcolor)), dtype=np.uint8)
+
+    minval = values.min() if minval is None else minval
+    maxval = values.max() if maxval is None else maxval
+
+    span = maxval - minval
+    if span > 0:
+        f = np.clip((values - minval) / span, 0.0, 1.0)
+    else:
+        f = np.zeros_like(values)
+
+    start = np.asarray(startcolor, dtype=np.float64)
+    stop = np.asarray(stopcolor, dtype=np.float64)
+    colors = start + f[:, None] * (stop - start)
+
+    return np.rint(colors).astype(np.uint8)
+
+
+def get_predictions_fingerprint(predictions: pd.DataFrame) -> str:
+    """
+    Fingerprint of a batch of predictions, so a payload is only reused for
+    the exact predictions it was built from
+    """
+    digest = hashlib.sha1(predictions['pickup_location_id'].to_numpy(dtype=np.int64))
+    digest.update(np.ascontiguousarray(predictions['predicted_demand'].to_numpy(dtype=np.float64)))
+
+    return digest.hexdigest()[:16]
+
+
+class ZoneMapPayloads:
+    """
+    Builds one GeoJSON FeatureCollection per (pickup_hour, model_version,
+    predictions fingerprint), with the predicted demand and fill color of each zone in its properties.
+
+    The zone geometries are serialized once, when the object is created, and
+    shared by all the payloads. Payloads are kept in a small LRU cache, so
+    every dashboard session that asks for the same hour gets the same
+    prebuilt object instead of re-merging and re-coloring the data.
+    """
+
+    def __init__(self, geo_df: pd.DataFrame, max_entries: int = 24):
+        """
+        Args:
+            geo_df (GeoDataFrame): taxi zones shape data with columns
+                `LocationID`, `zone`, `borough` and `geometry`
+            max_entries (int): max number of payloads kept in memory
+        """
+        geojson = json.loads(geo_df[ZONE_PROPERTIES + ['geometry']].to_json())
+        self._geometries = [f['geometry'] for f in geojson['features']]
+        self._properties = [f['properties'] for f in geojson['features']]
+        self._location_ids = geo_df['LocationID'].to_numpy(dtype=np.int64)
+
+        self._max_entries = max_entries
+        self._payloads: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self,
+            pickup_hour: datetime,
+            model_version: int,
+            predictions: pd.DataFrame) -> dict:
+        """
+        Returns the payload for (`pickup_hour`, `model_version`), building it
+        from `predictions` only if it is not cached yet. The key includes the
+        fingerprint of `predictions`, so new predictions for the same hour
+        (e.g. after the inference pipeline re-runs) get a new payload.
+
+        Args:
+            pickup_hour (datetime): hour the predictions are for
+            model_version (int): version of the model that generated them
+            predictions (pd.DataFrame): columns `pickup_location_id`
+                and `predicted_demand`
+
+        Returns:
+            dict: GeoJSON FeatureCollection. Each feature has the properties
+            `LocationID`, `zone`, `borough`, `predicted_demand` and
+            `fill_color`
+        """
+        key = (pd.Timestamp(pickup_hour), model_version,
+               get_predictions_fingerprint(predictions))
+
+        with self._lock:
+            if key in self._payloads:
+                self._payloads.move_to_end(key)
+                return self._payloads[key]
+
+            payload = self._build(predictions)
+
+            self._payloads[key] = payload
+            if len(self._payloads) > self._max_entries:
+                self._payloads.popitem(last=False)
+
+        return payload
+
+    def _build(self, predictions: pd.DataFrame) -> dict:
+        """Inner-joins zones and predictions and colors them in one pass"""
+        demand = pd.Series(
+            predictions['predicted_demand'].to_numpy(),
+            index=predictions['pickup_location_id'].to_numpy(dtype=np.int64)
+        )
+        demand = demand[~demand.index.duplicated(keep='last')]
+
+        # position of each zone in `demand`, -1 for zones without prediction
+        positions = demand.index.get_indexer(self._location_ids)
+        zone_idx = np.flatnonzero(positions >= 0)
+        zone_demand = demand.to_numpy()[positions[zone_idx]]
+
+        colors = pseudocolor(zone_demand, BLACK, GREEN).tolist()
+        zone_demand = zone_demand.tolist()
+
+        features = []
+        for i, idx in enumerate(zone_idx):
+            properties = dict(self._properties[idx])
+            properties['predicted_demand'] = zone_demand[i]
+            properties['fill_color'] = colors[i]
+            features.append({
+                'type': 'Feature',
+                'geometry': self._geometries[idx],
+                'properties': properties,
+            })
+
+        return {'type': 'FeatureCollection', 'features': features}
+
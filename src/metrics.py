@@ -0,0 +1,182 @@
+"""
+Materialized error metrics, so the monitoring dashboard reads a small table
+instead of re-joining every prediction with its actual value on each load
+"""
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+import src.config as config
+
+# `pickup_location_id` of the rows that aggregate all locations in one hour
+ALL_LOCATIONS = -1
+
+# additive columns we store, so metrics for any group of rows can be
+# re-aggregated from the table without going back to the raw data
+SUM_COLUMNS = ['n_obs', 'rides', 'predicted_demand', 'abs_error',
+               'error', 'abs_pct_error', 'n_nonzero']
+
+
+def _add_ratio_metrics(metrics: pd.DataFrame) -> pd.DataFrame:
+    """Adds `mae`, `mape` and `bias` columns computed from the additive ones"""
+    n_obs = metrics['n_obs'].to_numpy(dtype=np.float64)
+    n_nonzero = metrics['n_nonzero'].to_numpy(dtype=np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        metrics['mae'] = np.where(n_obs > 0, metrics['abs_error'] / n_obs, np.nan)
+        metrics['mape'] = np.where(n_nonzero > 0, metrics['abs_pct_error'] / n_nonzero, np.nan)
+        metrics['bias'] = np.where(n_obs > 0, metrics['error'] / n_obs, np.nan)
+
+    return metrics
+
+
+def compute_error_metrics(monitoring_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Computes error metrics per (pickup_hour, pickup_location_id), plus one
+    row per pickup_hour for all locations together, with
+    `pickup_location_id` = ALL_LOCATIONS.
+
+    Args:
+        monitoring_df (pd.DataFrame): columns `pickup_location_id`,
+            `pickup_hour`, `predicted_demand` and `rides`
+
+    Returns:
+        pd.DataFrame: columns `pickup_hour`, `pickup_location_id`,
+        SUM_COLUMNS, `mae`, `mape` and `bias`. MAPE only considers the
+        rows with rides > 0, and bias is the mean of
+        (predicted_demand - rides)
+    """
+    rides = monitoring_df['rides'].to_numpy(dtype=np.float64)
+    predicted = monitoring_df['predicted_demand'].to_numpy(dtype=np.float64)
+    error = predicted - rides
+    nonzero = rides > 0
+
+    per_location = pd.DataFrame({
+        'pickup_hour': pd.to_datetime(monitoring_df['pickup_hour']).to_numpy(),
+        'pickup_location_id': monitoring_df['pickup_location_id'].to_numpy(dtype=np.int64),
+        'n_obs': np.ones(len(rides), dtype=np.int64),
+        'rides': rides,
+        'predicted_demand': predicted,
+        'abs_error': np.abs(error),
+        'error': error,
+        'abs_pct_error': np.divide(np.abs(error), rides,
+                                   out=np.zeros_like(rides), where=nonzero),
+        'n_nonzero': nonzero.astype(np.int64),
+    })
+
+    # one vectorized reduction over all locations in each hour
+    per_hour = per_location.groupby('pickup_hour', as_index=False)[SUM_COLUMNS].sum()
+    per_hour['pickup_location_id'] = ALL_LOCATIONS
+
+    metrics = pd.concat([per_hour[per_location.columns], per_location], ignore_index=True)
+
+    return _add_ratio_metrics(metrics)
+
+
+def summarize_error_metrics(metrics: pd.DataFrame,
+                            by: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Re-aggregates materialized metrics, e.g. per location over the whole
+    period with `by=['pickup_location_id']`, or globally with `by=None`.
+
+    Args:
+        metrics (pd.DataFrame): output of `compute_error_metrics` or
+            `load_error_metrics_from_store`
+        by (Optional[List[str]]): columns to group by
+
+    Returns:
+        pd.DataFrame: one row per group with SUM_COLUMNS, `mae`, `mape`
+        and `bias`
+    """
+    if by:
+        summary = metrics.groupby(by, as_index=False)[SUM_COLUMNS].sum()
+    else:
+        # global metrics come from the per-hour rows, that already add up
+        # all the locations
+        per_hour = metrics[metrics['pickup_location_id'] == ALL_LOCATIONS]
+        summary = per_hour[SUM_COLUMNS].sum().to_frame().T
+
+    return _add_ratio_metrics(summary)
+
+
+def materialize_error_metrics(current_date: datetime,
+                              lookback_hours: int = 24) -> pd.DataFrame:
+    """
+    Computes error metrics for the last `lookback_hours` that have both
+    predictions and actual values, inserts them into the metrics feature
+    group and rolls them up into the shared cube of `src.rollup`. Meant to
+    run after each inference cycle. Hours that were already materialized
+    are overwritten, as the primary key is (pickup_location_id,
+    pickup_hour).
+
+    Args:
+        current_date (datetime): current (rounded) hour
+        lookback_hours (int): number of past hours to (re)compute
+
+    Returns:
+        pd.DataFrame: the metrics that were inserted
+    """
+    from src.feature_store_api import get_or_create_feature_group
+    from src.monitoring import load_predictions_and_actual_values_from_store
+    from src.rollup import update_rollup_cube
+
+    monitoring_df = load_predictions_and_actual_values_from_store(
+        from_date=current_date - timedelta(hours=lookback_hours),
+        to_date=current_date
+    )
+    if monitoring_df.empty:
+        print('No predictions with actual values to materialize metrics for')
+        return compute_error_metrics(monitoring_df)
+
+    metrics = compute_error_metrics(monitoring_df)
+    print(f'Materializing {len(metrics)} rows of error metrics')
+
+    metrics_fg = get_or_create_feature_group(
+        name=config.FEATURE_GROUP_MODEL_METRICS,
+        version=config.FEATURE_GROUP_MODEL_METRICS_VERSION,
+        description='Hourly error metrics of the production model',
+        primary_key=['pickup_location_id', 'pickup_hour'],
+        event_time='pickup_hour'
+    )
+    metrics_fg.insert(metrics, write_options={"wait_for_job": True})
+
+    # borough / service zone / city rollups for the dashboards. The feature
+    # group is the source of truth, so a failure is only reported
+    try:
+        update_rollup_cube(metrics)
+    except Exception as e:
+        print(f'Could not update the rollup cube: {e!r}')
+
+    return metrics
+
+
+def load_error_metrics_from_store(from_date: datetime,
+                                  to_date: datetime) -> pd.DataFrame:
+    """
+    Reads the materialized error metrics between `from_date` and `to_date`
+
+    Args:
+        from_date (datetime): min pickup_hour
+        to_date (datetime): max pickup_hour
+
+    Returns:
+        pd.DataFrame: same columns as `compute_error_metrics`
+    """
+    from src.feature_store_api import get_feature_group
+
+    metrics_fg = get_feature_group(
+        name=config.FEATURE_GROUP_MODEL_METRICS,
+        version=config.FEATURE_GROUP_MODEL_METRICS_VERSION
+    )
+    metrics = metrics_fg.filter(
+        (metrics_fg.pickup_hour >= from_date) & (metrics_fg.pickup_hour <= to_date)
+    ).read()
+
+    metrics['pickup_hour'] = pd.to_datetime(metrics['pickup_hour'])
+    metrics = metrics.drop_duplicates(
+        subset=['pickup_location_id', 'pickup_hour'], keep='last'
+    )
+
+    return metrics.sort_values(by=['pickup_hour', 'pickup_location_id']).reset_index(drop=True)
@@ -1,10 +1,33 @@
+import numpy as np
 import pandas as pd
-import lightgbm as lgb
 
-from typing import Optional
-from sklearn.base import BaseEstimator, TransformerMixin
-from sklearn.preprocessing import FunctionTransformer
-from sklearn.pipeline import make_pipeline, Pipeline
+from typing import Dict, List, Optional, Sequence, Tuple, TYPE_CHECKING
+
+import src.config as config
+from src.hours import day_of_week, hour_of_day, to_hour_index
+
+if TYPE_CHECKING:
+    from sklearn.pipeline import Pipeline
+
+# lags every lag subset keeps: the ones `average_rides_last_4_weeks` uses,
+# and the last hour, which the drift sketches read from the features
+REQUIRED_LAGS = [24 * 7 * 4, 24 * 7 * 3, 24 * 7 * 2, 24 * 7, 1]
+
+
+def get_lag_columns(lags: Sequence[int]) -> List[str]:
+    """
+    Lag column names, from the oldest to the most recent hour, as in the
+    features built from the time-series data
+    """
+    return [f'rides_previous_{lag}_hour' for lag in sorted(set(lags), reverse=True)]
+
+
+def keep_lags(X: pd.DataFrame, lags: Sequence[int]) -> pd.DataFrame:
+    """
+    Keeps only the lag columns in `lags`, plus `pickup_hour` and
+    `pickup_location_id`, in a fixed order
+    """
+    return X[get_lag_columns(lags) + ['pickup_hour', 'pickup_location_id']].copy()
 
 
 def average_rides_last_4_weeks(X: pd.DataFrame) -> pd.DataFrame:
@@ -16,14 +39,25 @@ def average_rides_last_4_weeks(X: pd.DataFrame) -> pd.DataFrame:
         - 28 days ago
     """
     X['average_rides_last_4_weeks'] = 0.25 * (
-        X[f'rides_previous_{24 * 7}_hour'] + 
-        X[f'rides_previous_{24 * 7 * 2}_hour'] + 
-        X[f'rides_previous_{24 * 7 * 3}_hour'] + 
+        X[f'rides_previous_{24 * 7}_hour'] +
+        X[f'rides_previous_{24 * 7 * 2}_hour'] +
+        X[f'rides_previous_{24 * 7 * 3}_hour'] +
         X[f'rides_previous_{24 * 7 * 4}_hour'])
-    
+
     return X
 
-def get_pipeline(**hyperparams) -> Pipeline:
+def get_pipeline(lags: Optional[Sequence[int]] = None, **hyperparams) -> "Pipeline":
+    """
+    Args:
+        lags (Optional[Sequence[int]]): lags (in hours) the model uses. All
+            N_FEATURES lags if None. REQUIRED_LAGS are always added
+        **hyperparams: LGBMRegressor hyper-parameters
+    """
+    # LightGBM and sklearn take ~1s to import, so we only load them when
+    # a pipeline is built
+    import lightgbm as lgb
+    from sklearn.preprocessing import FunctionTransformer
+    from sklearn.pipeline import make_pipeline
 
     # sklearn transform
     add_feature_average_rides_last_4_weeks = FunctionTransformer(
@@ -31,40 +65,293 @@ def get_pipeline(**hyperparams) -> Pipeline:
     )
 
     # sklearn transform
-    add_temporal_features = TemporalFeaturesEngineer()
+    add_temporal_features = _get_temporal_features_engineer_class()()
+
+    steps = [add_feature_average_rides_last_4_weeks,
+             add_temporal_features,
+             lgb.LGBMRegressor(**hyperparams)]
+
+    if lags is not None:
+        # sklearn transform, stored in the pickled model, so inference can
+        # read which lags to fetch with `get_model_lags`
+        lags = sorted(set(lags) | set(REQUIRED_LAGS), reverse=True)
+        steps.insert(0, FunctionTransformer(keep_lags, validate=False, kw_args={'lags': lags}))
 
     # sklearn pipeline
-    pipeline = make_pipeline(add_feature_average_rides_last_4_weeks, 
-                             add_temporal_features, 
-                             lgb.LGBMRegressor(**hyperparams)
-                             )
-    
+    pipeline = make_pipeline(*steps)
+
     return pipeline
 
 
-class TemporalFeaturesEngineer(BaseEstimator, TransformerMixin):
-    def fit(
-        self,
-        X: pd.DataFrame,
-        y: Optional[pd.Series] = None
-    ) -> "TemporalFeaturesEngineer":
-        return self
-    
-    def transform(
-        self,
-        X: pd.DataFrame
-    ) -> pd.DataFrame:
-        if 'pickup_hour' not in X.columns:
-            raise KeyError("'pickup_hour' column is required")
-
-        X_ = X.copy()
-
-        # Ensure datetime dtype
-        X_['pickup_hour'] = pd.to_datetime(X_['pickup_hour'])
-
-        # Generate numeric features
-        X_['hour'] = X_['pickup_hour'].dt.hour
-        X_['day_of_week'] = X_['pickup_hour'].dt.dayofweek
-
-        return X_.drop(columns=['pickup_hour'])
-    
+def get_model_lags(model) -> Optional[List[int]]:
+    """
+    Lags (in hours) that `model` uses, from the most to the least distant.
+    None for models trained on all N_FEATURES lags
+    """
+    for step in getattr(model, 'steps', []):
+        transformer = step[1]
+        if getattr(transformer, 'func', None) is keep_lags:
+            return list(transformer.kw_args['lags'])
+    return None
+
+
+def get_features_from_lag_matrix(lag_values: np.ndarray,
+                                 lags: Sequence[int],
+                                 location_ids: np.ndarray,
+                                 pickup_hour) -> pd.DataFrame:
+    """
+    Features in the format of `load_batch_of_features_from_store`, from a
+    (locations x lags) matrix with the lags from the most to the least
+    distant. The lag columns are a view of `lag_values`, not a copy
+    """
+    features = pd.DataFrame(lag_values, columns=get_lag_columns(lags), copy=False)
+    features['pickup_hour'] = pickup_hour
+    features['pickup_location_id'] = location_ids
+
+    return features
+
+
+def get_model_input_columns(lags: Sequence[int]) -> List[str]:
+    """
+    Names of the columns the LGBMRegressor of `get_pipeline(lags)` is
+    trained on, in the order of `get_model_input`
+    """
+    return get_lag_columns(lags) + ['pickup_location_id', 'average_rides_last_4_weeks',
+                                    'hour', 'day_of_week']
+
+
+def get_model_input(lag_values: np.ndarray,
+                    lags: Sequence[int],
+                    location_ids: np.ndarray,
+                    hour_index,
+                    dtype: type = np.float32) -> np.ndarray:
+    """
+    The rows the LGBMRegressor of `get_pipeline(lags)` predicts on, built
+    in one C-contiguous array, which LightGBM reads without a copy: the
+    lags, from the most to the least distant, `pickup_location_id`,
+    `average_rides_last_4_weeks`, `hour` and `day_of_week`.
+
+    Args:
+        lag_values (np.ndarray): (rows x lags) matrix, with the lags from
+            the most to the least distant
+        lags (Sequence[int]): lags (in hours) of the columns of `lag_values`,
+            including the 4 weekly ones `average_rides_last_4_weeks` needs
+        location_ids (np.ndarray): pickup_location_id of each row
+        hour_index: hour index (see `src.hours`) of the pickup_hour of each
+            row, or of all of them
+        dtype (type): dtype of the array
+
+    Returns:
+        np.ndarray: (rows x (lags + 4)) array
+    """
+    lags = sorted(set(lags), reverse=True)
+    n_lags = len(lags)
+
+    x = np.empty((len(lag_values), n_lags + 4), dtype=dtype)
+    x[:, :n_lags] = lag_values
+
+    # same arithmetic, in the dtype of the lags, as `average_rides_last_4_weeks`,
+    # so the values (and the splits they fall on) are the same
+    w1, w2, w3, w4 = (lag_values[:, lags.index(24 * 7 * week)] for week in (1, 2, 3, 4))
+    x[:, n_lags] = location_ids
+    x[:, n_lags + 1] = 0.25 * (w1 + w2 + w3 + w4)
+    x[:, n_lags + 2] = hour_of_day(hour_index)
+    x[:, n_lags + 3] = day_of_week(hour_index)
+
+    return x
+
+
+def _get_pipeline_booster(model):
+    """
+    Booster of a fitted `get_pipeline` pipeline, None for any other model
+    (e.g. a `ShardedPipeline`, or a pipeline with other transforms)
+    """
+    steps = getattr(model, 'steps', None)
+    if not steps:
+        return None
+
+    for _, transformer in steps[:-1]:
+        if (getattr(transformer, 'func', None) not in (keep_lags, average_rides_last_4_weeks)
+                and type(transformer).__name__ != 'TemporalFeaturesEngineer'):
+            return None
+
+    # `booster_` raises an AttributeError while the model is not fitted
+    return getattr(steps[-1][1], 'booster_', None)
+
+
+def predict_features(model, features: pd.DataFrame) -> np.ndarray:
+    """
+    Predictions of `model` on a batch of features from
+    `load_batch_of_features_from_store`.
+
+    For `get_pipeline` pipelines, the booster predicts on one float32
+    array from `get_model_input`, instead of going through the DataFrame
+    transforms and the float64 copy LightGBM makes of a DataFrame, if the
+    booster was trained on `get_model_input_columns`. The predictions are
+    the same. Other models predict on a shallow copy of `features`, so
+    their transforms do not add columns to it.
+    """
+    lags = get_model_lags(model) or list(range(config.N_FEATURES, 0, -1))
+    booster = _get_pipeline_booster(model)
+    if booster is None or booster.feature_name() != get_model_input_columns(lags):
+        return model.predict(features.copy(deep=False))
+
+    # a view when the lag columns are one float32 block, as the features
+    # built by `get_features_from_lag_matrix`
+    lag_values = features[get_lag_columns(lags)].to_numpy()
+    x = get_model_input(lag_values, lags,
+                        features['pickup_location_id'].to_numpy(),
+                        to_hour_index(features['pickup_hour']))
+
+    return booster.predict(x)
+
+
+def rank_lag_importance(pipeline: "Pipeline") -> pd.Series:
+    """
+    Total gain of each lag in the trees of a fitted pipeline, from the most
+    to the least important. Lags never used in a split have 0 gain.
+    The gain of `average_rides_last_4_weeks` is not attributed to its lags,
+    as they are kept anyway.
+    """
+    booster = pipeline.steps[-1][1].booster_
+    gains = pd.Series(booster.feature_importance(importance_type='gain'),
+                      index=booster.feature_name())
+
+    lag_columns = [c for c in gains.index if c.startswith('rides_previous_')]
+    lags = [int(c.split('_')[2]) for c in lag_columns]
+
+    return pd.Series(gains[lag_columns].to_numpy(), index=pd.Index(lags, name='lag'),
+                     name='gain').sort_values(ascending=False, kind='stable')
+
+
+def select_top_lags(importance: pd.Series, n_lags: int) -> List[int]:
+    """
+    `n_lags` most important lags, plus REQUIRED_LAGS, from the most to the
+    least distant
+    """
+    return sorted(set(importance.index[:n_lags]) | set(REQUIRED_LAGS), reverse=True)
+
+
+def _measure_model(pipeline: "Pipeline",
+                   X: pd.DataFrame,
+                   y: pd.Series,
+                   n_runs: int = 3) -> Dict[str, float]:
+    import pickle
+    import time
+
+    from sklearn.metrics import mean_absolute_error
+
+    lags = get_model_lags(pipeline) or list(range(config.N_FEATURES, 0, -1))
+    X_ = keep_lags(X, lags)
+
+    latencies = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        predictions = pipeline.predict(X_)
+        latencies.append(time.perf_counter() - start)
+
+    return {
+        'n_lags': len(lags),
+        'mae': mean_absolute_error(y, predictions),
+        'model_size_bytes': len(pickle.dumps(pipeline)),
+        'inference_matrix_bytes': int(X_[get_lag_columns(lags)].to_numpy(dtype='float32').nbytes),
+        'predict_seconds': min(latencies),
+    }
+
+
+def train_lag_subset_model(
+    X_train: pd.DataFrame,
+    y_train: pd.Series,
+    X_test: pd.DataFrame,
+    y_test: pd.Series,
+    n_lags: int = 48,
+    full_pipeline: Optional["Pipeline"] = None,
+    **hyperparams
+) -> Tuple["Pipeline", pd.DataFrame]:
+    """
+    Ranks the lags by gain in a model trained on all lags, and retrains on
+    the `n_lags` most important ones (plus REQUIRED_LAGS).
+
+    Args:
+        X_train, y_train, X_test, y_test: train and test split, with all lags
+        n_lags (int): number of lags to keep, before adding REQUIRED_LAGS
+        full_pipeline (Optional["Pipeline"]): already fitted pipeline on all
+            lags, to skip training it again
+        **hyperparams: LGBMRegressor hyper-parameters, for both models
+
+    Returns:
+        Tuple[Pipeline, pd.DataFrame]:
+            - fitted pipeline on the lag subset
+            - report with one row per model (`all_lags`, `lag_subset`):
+              n_lags, test mae, pickled model size, size of the float32 lag
+              matrix for X_test and predict latency
+    """
+    if full_pipeline is None:
+        full_pipeline = get_pipeline(**hyperparams)
+        full_pipeline.fit(X_train.copy(), y_train)
+
+    lags = select_top_lags(rank_lag_importance(full_pipeline), n_lags)
+
+    subset_pipeline = get_pipeline(lags=lags, **hyperparams)
+    subset_pipeline.fit(X_train.copy(), y_train)
+
+    report = pd.DataFrame([
+        _measure_model(full_pipeline, X_test.copy(), y_test),
+        _measure_model(subset_pipeline, X_test.copy(), y_test),
+    ], index=['all_lags', 'lag_subset'])
+
+    return subset_pipeline, report
+
+
+def _get_temporal_features_engineer_class() -> type:
+    """
+    Defines `TemporalFeaturesEngineer` the first time it is needed, so
+    importing this module does not import sklearn. The class is then cached
+    as a module attribute, so pickled pipelines resolve to the same class.
+    """
+    if 'TemporalFeaturesEngineer' in globals():
+        return globals()['TemporalFeaturesEngineer']
+
+    from sklearn.base import BaseEstimator, TransformerMixin
+
+    class TemporalFeaturesEngineer(BaseEstimator, TransformerMixin):
+        def fit(
+            self,
+            X: pd.DataFrame,
+            y: Optional[pd.Series] = None
+        ) -> "TemporalFeaturesEngineer":
+            return self
+
+        def transform(
+            self,
+            X: pd.DataFrame
+        ) -> pd.DataFrame:
+            if 'pickup_hour' not in X.columns:
+                raise KeyError("'pickup_hour' column is required")
+
+            # shallow copy: the columns below are set on X_ only, and the
+            # lag columns are not copied
+            X_ = X.copy(deep=False)
+
+            # Generate numeric features, with integer arithmetic on the
+            # hour index. `pickup_hour` can be datetimes or hour indices
+            hour_index = to_hour_index(X_['pickup_hour'])
+            X_['hour'] = hour_of_day(hour_index)
+            X_['day_of_week'] = day_of_week(hour_index)
+
+            return X_.drop(columns=['pickup_hour'])
+
+    # same name and module as when it was defined at the top level, which
+    # is what pickle stores for the models in the registry
+    TemporalFeaturesEngineer.__qualname__ = 'TemporalFeaturesEngineer'
+    TemporalFeaturesEngineer.__module__ = __name__
+
+    globals()['TemporalFeaturesEngineer'] = TemporalFeaturesEngineer
+    return TemporalFeaturesEngineer
+
+
+def __getattr__(name: str):
+    # `from src.model import TemporalFeaturesEngineer`, and unpickling a model
+    if name == 'TemporalFeaturesEngineer':
+        return _get_temporal_features_engineer_class()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
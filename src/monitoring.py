@@ -71,11 +71,14 @@
 Monitoring module for comparing predictions with actual values
 """
 from datetime import datetime, timedelta
+from typing import Optional
 
 import pandas as pd
-from hsfs.client.exceptions import RestAPIError
 
+from src.drift import DemandSketch, compute_drift_scores, get_week_key
 from src.feature_store_api import get_feature_store, get_feature_group
+from src.hours import from_hour_index, to_hour_index
+from src.paths import DRIFT_DIR
 import src.config as config
 
 
@@ -106,15 +109,24 @@ def load_predictions_and_actual_values_from_store(
         name=config.FEATURE_GROUP_MODEL_PREDICTIONS,
         version=1
     )
-    predictions_df = predictions_fg.read()
+    # only the requested hours are read, so the cost of each call does not
+    # grow with the history kept in the feature groups
+    predictions_df = predictions_fg.filter(
+        (predictions_fg.pickup_hour >= from_date) & (predictions_fg.pickup_hour <= to_date)
+    ).read()
     print(f"Predictions shape: {predictions_df.shape}")
     
     if predictions_df.empty:
         print("WARNING: No predictions found in feature store!")
         return pd.DataFrame(columns=['pickup_location_id', 'predicted_demand', 'pickup_hour', 'rides'])
     
-    predictions_df['pickup_hour'] = pd.to_datetime(predictions_df['pickup_hour'])
-    print(f"Predictions date range: {predictions_df['pickup_hour'].min()} to {predictions_df['pickup_hour'].max()}")
+    # compare and join on the integer hour index, filtering each side to the
+    # date range before the merge
+    from_hour, to_hour = to_hour_index(from_date), to_hour_index(to_date)
+    predictions_df['hour_index'] = to_hour_index(predictions_df['pickup_hour'])
+    print(f"Predictions date range: {from_hour_index(predictions_df['hour_index'].min())} "
+          f"to {from_hour_index(predictions_df['hour_index'].max())}")
+    predictions_df = predictions_df[predictions_df['hour_index'].between(from_hour, to_hour)]
     
     # Read actuals directly from feature group
     print("Fetching actuals from feature group...")
@@ -122,22 +134,31 @@ def load_predictions_and_actual_values_from_store(
         name=config.FEATURE_GROUP_NAME,
         version=config.FEATURE_GROUP_VERSION
     )
-    actuals_df = actuals_fg.read()
+    actuals_df = actuals_fg.filter(
+        (actuals_fg.pickup_hour >= from_date) & (actuals_fg.pickup_hour <= to_date)
+    ).read()
     print(f"Actuals shape: {actuals_df.shape}")
     
     if actuals_df.empty:
         print("WARNING: No actuals found in feature store!")
         return pd.DataFrame(columns=['pickup_location_id', 'predicted_demand', 'pickup_hour', 'rides'])
     
-    actuals_df['pickup_hour'] = pd.to_datetime(actuals_df['pickup_hour'])
-    print(f"Actuals date range: {actuals_df['pickup_hour'].min()} to {actuals_df['pickup_hour'].max()}")
+    actuals_df['hour_index'] = to_hour_index(actuals_df['pickup_hour'])
+    print(f"Actuals date range: {from_hour_index(actuals_df['hour_index'].min())} "
+          f"to {from_hour_index(actuals_df['hour_index'].max())}")
+    # the store only has the (location, hour) slots with rides, so up to
+    # the last hour it has in the range, a prediction without actuals had 0 rides
+    last_actual_hour = int(actuals_df['hour_index'].max())
+    actuals_df = actuals_df[actuals_df['hour_index'].between(from_hour, to_hour)]
+    predictions_df = predictions_df[predictions_df['hour_index'] <= last_actual_hour]
     
     # Merge predictions with actuals
-    monitoring_df = predictions_df.merge(
-        actuals_df[['pickup_location_id', 'pickup_hour', 'rides']],
-        on=['pickup_location_id', 'pickup_hour'],
-        how='inner'
+    monitoring_df = predictions_df.drop(columns=['pickup_hour']).merge(
+        actuals_df[['pickup_location_id', 'hour_index', 'rides']],
+        on=['pickup_location_id', 'hour_index'],
+        how='left'
     )
+    monitoring_df['rides'] = monitoring_df['rides'].fillna(0).astype(actuals_df['rides'].dtype)
     
     print(f"Merged shape: {monitoring_df.shape}")
     
@@ -146,15 +167,115 @@ def load_predictions_and_actual_values_from_store(
         print("Predictions are for times where no actual ride data exists yet.")
         return pd.DataFrame(columns=['pickup_location_id', 'predicted_demand', 'pickup_hour', 'rides'])
     
-    # Filter to date range
-    monitoring_df = monitoring_df[monitoring_df['pickup_hour'].between(from_date, to_date)]
-    
     # Remove duplicates
     monitoring_df = monitoring_df.drop_duplicates(
-        subset=['pickup_location_id', 'pickup_hour'],
+        subset=['pickup_location_id', 'hour_index'],
         keep='last'
     )
+    monitoring_df['pickup_hour'] = from_hour_index(monitoring_df['hour_index'].to_numpy())
+    monitoring_df = monitoring_df.drop(columns=['hour_index'])
     
     print(f"Final shape after filtering: {monitoring_df.shape}")
     
-    return monitoring_df
\ No newline at end of file
+    return monitoring_df
+
+def build_drift_reference(ts_data: pd.DataFrame,
+                          predictions: Optional[pd.DataFrame] = None) -> None:
+    """
+    Builds the training-time reference sketches for drift detection, and
+    saves them to DRIFT_DIR. Meant to run in the training pipeline.
+
+    Args:
+        ts_data (pd.DataFrame): training time-series data, with columns
+            `pickup_hour`, `pickup_location_id` and `rides`
+        predictions (Optional[pd.DataFrame]): predictions of the trained model
+            on held-out data, with columns `pickup_hour`, `pickup_location_id`
+            and `predicted_demand`. If None, the distribution of actual rides
+            is used as reference for the predictions too.
+    """
+    features_sketch = DemandSketch().update(
+        ts_data['pickup_location_id'].values, ts_data['pickup_hour'], ts_data['rides'].values
+    )
+    features_sketch.save(DRIFT_DIR / 'reference_features.npz')
+
+    if predictions is None:
+        predictions_sketch = features_sketch
+    else:
+        predictions_sketch = DemandSketch().update(
+            predictions['pickup_location_id'].values,
+            predictions['pickup_hour'],
+            predictions['predicted_demand'].values
+        )
+    predictions_sketch.save(DRIFT_DIR / 'reference_predictions.npz')
+
+
+def update_drift_sketches(features: pd.DataFrame,
+                          predictions: pd.DataFrame) -> None:
+    """
+    Adds the newest hour of inference inputs and the new predictions to the
+    sketches of the current week. Each call costs O(locations), and hours
+    that were already added (e.g. when a pipeline run is retried) are skipped.
+
+    Args:
+        features (pd.DataFrame): batch of features used for inference, with
+            `rides_previous_1_hour`, `pickup_hour` and `pickup_location_id`
+        predictions (pd.DataFrame): columns `pickup_location_id`,
+            `predicted_demand` and `pickup_hour`
+    """
+    pickup_hour = pd.to_datetime(predictions['pickup_hour']).max()
+    week_key = get_week_key(pickup_hour)
+
+    # the newest value of the 672-hour profile is the one for the previous hour
+    updates = [
+        ('features', features['pickup_location_id'].values,
+         pickup_hour - timedelta(hours=1), features['rides_previous_1_hour'].values),
+        ('predictions', predictions['pickup_location_id'].values,
+         pickup_hour, predictions['predicted_demand'].values),
+    ]
+    for name, location_ids, hour, values in updates:
+        path = DRIFT_DIR / f'{name}_{week_key}.npz'
+        sketch = DemandSketch.load(path) if path.exists() else DemandSketch()
+        if sketch.last_pickup_hour is not None and hour <= sketch.last_pickup_hour:
+            print(f'Drift sketch {path.name} already has {hour}. Skip update')
+            continue
+        sketch.update(location_ids, hour, values).save(path)
+
+
+def load_drift_scores(current_date: datetime,
+                      n_weeks: int = 1,
+                      by_hour_of_week: bool = False) -> pd.DataFrame:
+    """
+    Compares the sketches of the last `n_weeks` against the training-time
+    reference, without reading any historical data.
+
+    Args:
+        current_date (datetime): current (rounded) hour
+        n_weeks (int): number of weekly sketches to merge, up to the current week
+        by_hour_of_week (bool): score each (location, hour of week) instead of
+            each location
+
+    Returns:
+        pd.DataFrame: output of `src.drift.compute_drift_scores`, with an extra
+        column `sketch` equal to 'features' or 'predictions'
+    """
+    scores = []
+    for name in ['features', 'predictions']:
+        reference_path = DRIFT_DIR / f'reference_{name}.npz'
+        if not reference_path.exists():
+            raise FileNotFoundError(
+                f'{reference_path} not found. Run the training pipeline to build it.'
+            )
+        reference = DemandSketch.load(reference_path)
+
+        current = DemandSketch(reference.bin_edges)
+        for weeks_ago in range(n_weeks):
+            week_key = get_week_key(current_date - timedelta(weeks=weeks_ago))
+            path = DRIFT_DIR / f'{name}_{week_key}.npz'
+            if path.exists():
+                current = current.merge(DemandSketch.load(path))
+
+        scores_one_sketch = compute_drift_scores(reference, current, by_hour_of_week)
+        scores_one_sketch['sketch'] = name
+        scores.append(scores_one_sketch)
+
+    return pd.concat(scores, ignore_index=True)
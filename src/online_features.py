@@ -0,0 +1,213 @@
+"""
+In-memory ring buffer with the last N_FEATURES hours of rides per location,
+so serving does not rebuild the lag vectors from the long-format store
+"""
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+import src.config as config
+from src.data import get_ts_matrix
+from src.hours import to_naive_utc
+from src.model import get_features_from_lag_matrix
+from src.paths import DATA_DIR
+
+ONLINE_FEATURES_PATH = DATA_DIR / 'online_features.npz'
+
+
+class RideHistoryBuffer:
+    """
+    Circular (locations x n_hours) buffer of hourly rides.
+
+    Adding a new hour overwrites the column of the oldest one, in
+    O(locations), and the ordered lag matrix
+    `rides_previous_{n_hours}_hour ... rides_previous_1_hour` is read with
+    one index rotation, without sorting anything.
+    """
+
+    def __init__(self,
+                 location_ids: np.ndarray,
+                 n_hours: int = config.N_FEATURES,
+                 values: Optional[np.ndarray] = None,
+                 position: int = -1,
+                 last_pickup_hour: Optional[pd.Timestamp] = None):
+        """
+        Args:
+            location_ids (np.ndarray): pickup_location_id of each row
+            n_hours (int): number of hours kept per location
+            values (Optional[np.ndarray]): (len(location_ids), n_hours) buffer
+            position (int): column of `values` with the most recent hour
+            last_pickup_hour (Optional[pd.Timestamp]): most recent hour in the buffer
+        """
+        self.location_ids = np.asarray(location_ids, dtype=np.int64)
+        self.n_hours = n_hours
+        if values is None:
+            values = np.zeros((len(self.location_ids), n_hours), dtype=np.float32)
+        self.values = values
+        self.position = position
+        self.last_pickup_hour = last_pickup_hour
+        self._rows = pd.Index(self.location_ids)
+
+    @classmethod
+    def from_ts_data(cls,
+                     ts_data: pd.DataFrame,
+                     n_hours: int = config.N_FEATURES) -> "RideHistoryBuffer":
+        """Builds a buffer with the last `n_hours` hours of `ts_data`"""
+        matrix, location_ids, pickup_hours = get_ts_matrix(ts_data)
+        matrix, pickup_hours = matrix[:, -n_hours:], pickup_hours[-n_hours:]
+
+        values = np.zeros((len(location_ids), n_hours), dtype=np.float32)
+        values[:, :matrix.shape[1]] = matrix
+
+        return cls(location_ids, n_hours, values,
+                   position=matrix.shape[1] - 1,
+                   last_pickup_hour=to_naive_utc(pd.Timestamp(pickup_hours[-1])))
+
+    def _get_rows(self, location_ids: np.ndarray) -> np.ndarray:
+        """Row of each location, adding rows for locations not seen before"""
+        rows = self._rows.get_indexer(location_ids)
+        new_location_ids = np.unique(np.asarray(location_ids)[rows < 0])
+        if len(new_location_ids) > 0:
+            self.location_ids = np.concatenate([self.location_ids, new_location_ids])
+            self.values = np.vstack([
+                self.values,
+                np.zeros((len(new_location_ids), self.n_hours), dtype=np.float32)
+            ])
+            self._rows = pd.Index(self.location_ids)
+            rows = self._rows.get_indexer(location_ids)
+        return rows
+
+    def update(self,
+               pickup_hour: datetime,
+               location_ids: np.ndarray,
+               rides: np.ndarray) -> None:
+        """
+        Sets the rides of every location for `pickup_hour`. Locations that are
+        not in `location_ids` get 0 rides for that hour.
+
+        A `pickup_hour` after `last_pickup_hour` moves the buffer forward
+        (with 0 rides for any hour skipped in between), and one inside the
+        window overwrites that hour, e.g. when late data arrives.
+        """
+        pickup_hour = to_naive_utc(pd.Timestamp(pickup_hour))
+        rows = self._get_rows(location_ids)
+
+        if self.last_pickup_hour is None:
+            self.last_pickup_hour = pickup_hour - timedelta(hours=1)
+
+        hours_ahead = (pickup_hour - self.last_pickup_hour) // timedelta(hours=1)
+        if hours_ahead <= -self.n_hours:
+            # older than anything we keep
+            return
+
+        if hours_ahead > 0:
+            # clear the columns of the skipped hours, up to the whole buffer
+            skipped = (self.position + 1 + np.arange(min(hours_ahead, self.n_hours))) % self.n_hours
+            self.values[:, skipped] = 0
+            self.position = (self.position + hours_ahead) % self.n_hours
+            self.last_pickup_hour = pickup_hour
+            column = self.position
+        else:
+            column = (self.position + hours_ahead) % self.n_hours
+            self.values[:, column] = 0
+
+        self.values[rows, column] = rides
+
+    def update_from_ts_data(self, ts_data: pd.DataFrame) -> None:
+        """Applies every hour of `ts_data`, from the oldest to the most recent"""
+        matrix, location_ids, pickup_hours = get_ts_matrix(ts_data)
+        for i, pickup_hour in enumerate(pickup_hours):
+            self.update(pickup_hour, location_ids, matrix[:, i])
+
+    def get_lag_matrix(self) -> np.ndarray:
+        """
+        Returns:
+            np.ndarray: (n_locations, n_hours) matrix, from the oldest hour
+            (column 0) to `last_pickup_hour` (last column)
+        """
+        oldest_first = (self.position + 1 + np.arange(self.n_hours)) % self.n_hours
+        return self.values[:, oldest_first]
+
+    def covers(self, current_date: datetime) -> bool:
+        """Whether the buffer has all the hours needed to predict `current_date`"""
+        previous_hour = to_naive_utc(pd.Timestamp(current_date)) - timedelta(hours=1)
+        return self.last_pickup_hour is not None and self.last_pickup_hour == previous_hour
+
+    def get_features(self,
+                     current_date: Optional[datetime] = None,
+                     lags: Optional[Sequence[int]] = None) -> pd.DataFrame:
+        """
+        Same output as `load_batch_of_features_from_store`
+
+        Args:
+            current_date (Optional[datetime]): datetime of the prediction.
+                Defaults to the hour after `last_pickup_hour`
+            lags (Optional[Sequence[int]]): lags (in hours) to return, for
+                models trained on a lag subset. All n_hours lags if None
+
+        Returns:
+            pd.DataFrame: one column per lag, plus 2 columns:
+                - 'rides_previous_{n_hours}_hour'
+                - ...
+                - 'rides_previous_1_hour'
+                - 'pickup_hour'
+                - 'pickup_location_id'
+        """
+        if current_date is None:
+            current_date = self.last_pickup_hour + timedelta(hours=1)
+
+        if lags is None:
+            lags = range(self.n_hours, 0, -1)
+        lags = np.array(sorted(set(lags), reverse=True))
+
+        # column of each lag, without materializing the full lag matrix
+        columns = (self.position + 1 - lags) % self.n_hours
+
+        order = np.argsort(self.location_ids)
+        return get_features_from_lag_matrix(self.values[np.ix_(order, columns)], lags,
+                                            self.location_ids[order], current_date)
+
+    def save(self, path: Path = ONLINE_FEATURES_PATH) -> None:
+        """Snapshots the buffer to disk, for a fast restart"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(path,
+                 location_ids=self.location_ids,
+                 values=self.values,
+                 position=self.position,
+                 last_pickup_hour=np.array(self.last_pickup_hour.isoformat()))
+
+    @classmethod
+    def load(cls, path: Path = ONLINE_FEATURES_PATH) -> "RideHistoryBuffer":
+        with np.load(path) as data:
+            return cls(data['location_ids'],
+                       n_hours=data['values'].shape[1],
+                       values=data['values'],
+                       position=int(data['position']),
+                       last_pickup_hour=to_naive_utc(pd.Timestamp(str(data['last_pickup_hour']))))
+
+
+def update_online_buffer(ts_data: pd.DataFrame,
+                         path: Path = ONLINE_FEATURES_PATH) -> RideHistoryBuffer:
+    """
+    Adds `ts_data` to the buffer snapshot in `path` (or builds a new one
+    from it, on the first run) and saves it back.
+
+    Args:
+        ts_data (pd.DataFrame): columns `pickup_hour`, `pickup_location_id` and `rides`
+        path (Path): buffer snapshot
+
+    Returns:
+        RideHistoryBuffer: the updated buffer
+    """
+    if Path(path).exists():
+        buffer = RideHistoryBuffer.load(path)
+        buffer.update_from_ts_data(ts_data)
+    else:
+        buffer = RideHistoryBuffer.from_ts_data(ts_data)
+    buffer.save(path)
+
+    return buffer
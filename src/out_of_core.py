@@ -0,0 +1,315 @@
+"""
+Out-of-core training: LightGBM reads the training windows in chunks from a
+memory-mapped (locations x hours) array of rides, so the wide
+(examples x 672 lags) feature matrix is never built in memory.
+
+Each window is a view into the rides of one location, so the array on disk
+is ~step_size / 672 times the size of the feature matrix it stands for. The
+rows LightGBM reads are the ones the `get_pipeline` transforms would feed to
+its LGBMRegressor, so the booster is the same as the one `pipeline.fit`
+trains on the output of `transform_ts_data_into_features_and_target`
+"""
+import json
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Tuple, TYPE_CHECKING
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, RegressorMixin
+
+import src.config as config
+from src.data import get_ts_matrix
+from src.hours import to_hour_index
+from src.model import REQUIRED_LAGS, get_model_input, get_model_input_columns, get_pipeline
+from src.paths import TRANSFORMED_DATA_DIR
+
+if TYPE_CHECKING:
+    from sklearn.pipeline import Pipeline
+
+TS_MEMMAP_PATH = TRANSFORMED_DATA_DIR / 'ts_matrix.npy'
+
+# windows per chunk pushed into the LightGBM dataset. Each chunk is a
+# (CHUNK_SIZE, n_lags + 4) float64 array, ~54MB with all 672 lags
+CHUNK_SIZE = 10_000
+
+
+def _get_index_path(path: Path) -> Path:
+    return Path(path).with_suffix('.json')
+
+
+def write_ts_memmap(ts_data: pd.DataFrame, path: Path = TS_MEMMAP_PATH) -> Path:
+    """
+    Saves the rides of `ts_data` as a float32 (locations x hours) .npy
+    array, plus a JSON sidecar with the location id of each row and the
+    hour of the first column.
+
+    (location, hour) slots missing in `ts_data` count as 0 rides, as in the
+    time-series data written by the feature pipeline.
+
+    Args:
+        ts_data (pd.DataFrame): columns `pickup_hour`, `pickup_location_id` and `rides`
+        path (Path): .npy file to write
+
+    Returns:
+        Path: `path`
+    """
+    matrix, location_ids, pickup_hours = get_ts_matrix(ts_data)
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.save(path, matrix)
+
+    with open(_get_index_path(path), 'w') as f:
+        json.dump({
+            'location_ids': [int(location_id) for location_id in location_ids],
+            'first_hour': pickup_hours[0].isoformat() if len(pickup_hours) else None,
+        }, f)
+
+    return path
+
+
+def load_ts_memmap(path: Path = TS_MEMMAP_PATH) -> Tuple[np.ndarray, np.ndarray, pd.DatetimeIndex]:
+    """
+    Opens the array written by `write_ts_memmap`, without reading it
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, pd.DatetimeIndex]:
+            - read-only memory map of rides, with shape (n_locations, n_hours)
+            - pickup_location_id of each row
+            - pickup_hour of each column
+    """
+    matrix = np.load(path, mmap_mode='r')
+    with open(_get_index_path(path)) as f:
+        index = json.load(f)
+
+    location_ids = np.array(index['location_ids'], dtype=np.int64)
+    if index['first_hour'] is None:
+        return matrix, location_ids, pd.DatetimeIndex([])
+    pickup_hours = pd.date_range(pd.Timestamp(index['first_hour']),
+                                 periods=matrix.shape[1], freq='h')
+
+    return matrix, location_ids, pickup_hours
+
+
+def get_window_targets(n_hours: int, input_seq_len: int, step_size: int) -> np.ndarray:
+    """
+    Column of the target hour of each window of one location, the same
+    windows `get_cutoff_indices` cuts
+    """
+    return np.arange(input_seq_len, n_hours - 1, step_size)
+
+
+def get_window_grid(n_locations: int, targets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Row and target column of the windows at `targets` for every location,
+    location by location, as `transform_ts_data_into_features_and_target`
+    orders them
+    """
+    return (np.repeat(np.arange(n_locations), len(targets)),
+            np.tile(np.asarray(targets, dtype=np.int64), n_locations))
+
+
+class LagWindowSequence(lgb.Sequence):
+    """
+    Training rows of a list of (location, target hour) windows, read lazily
+    from the rides array.
+
+    Each row has the columns the LGBMRegressor of `get_pipeline(lags)` is
+    fitted on: the lags, from the most to the least distant,
+    `pickup_location_id`, `average_rides_last_4_weeks`, `hour` and
+    `day_of_week`.
+    """
+
+    def __init__(self,
+                 matrix: np.ndarray,
+                 location_ids: np.ndarray,
+                 pickup_hours: pd.DatetimeIndex,
+                 locations: np.ndarray,
+                 targets: np.ndarray,
+                 lags: Sequence[int],
+                 batch_size: int = CHUNK_SIZE):
+        """
+        Args:
+            matrix (np.ndarray): rides, with shape (n_locations, n_hours).
+                Usually the memory map from `load_ts_memmap`
+            location_ids (np.ndarray): pickup_location_id of each row of `matrix`
+            pickup_hours (pd.DatetimeIndex): pickup_hour of each column of `matrix`
+            locations (np.ndarray): row in `matrix` of each window
+            targets (np.ndarray): column in `matrix` of the target hour of
+                each window, see `get_window_grid`
+            lags (Sequence[int]): lags (in hours) to read, including
+                the 4 weekly ones `average_rides_last_4_weeks` needs
+            batch_size (int): rows LightGBM reads per call
+        """
+        self.matrix = matrix
+        self.location_ids = location_ids
+        self.locations = np.asarray(locations, dtype=np.int64)
+        self.targets = np.asarray(targets, dtype=np.int64)
+        self.lags = np.array(sorted(set(lags), reverse=True))
+        self.batch_size = batch_size
+        self._hour_index = to_hour_index(pickup_hours)
+
+    @property
+    def feature_names(self):
+        return get_model_input_columns(self.lags)
+
+    def __len__(self) -> int:
+        return len(self.targets)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.get_rows(np.arange(*idx.indices(len(self))))
+        return self.get_rows(np.array([idx]))[0]
+
+    def get_rows(self, rows: np.ndarray) -> np.ndarray:
+        """Feature rows of the windows with positions `rows`, as float64"""
+        location, target = self.locations[rows], self.targets[rows]
+
+        # only the hours of these windows are read from the memory map
+        lag_values = self.matrix[location[:, None], target[:, None] - self.lags]
+
+        return get_model_input(lag_values, self.lags, self.location_ids[location],
+                               self._hour_index[target], dtype=np.float64)
+
+    def get_labels(self) -> np.ndarray:
+        """Rides at the target hour of every window, in row order"""
+        return np.asarray(self.matrix[self.locations, self.targets], dtype=np.float32)
+
+
+class BoosterRegressor(BaseEstimator, RegressorMixin):
+    """
+    Last step of the pipeline for a booster trained out of core, in place of
+    the LGBMRegressor, so the model predicts on the same features, and
+    `rank_lag_importance` reads its `booster_`, as any other pipeline.
+
+    `fit` trains a new booster in memory on the rows it is given, as the
+    LGBMRegressor would, so the pipeline can be cloned and refitted on the
+    folds of a backtest. `train_out_of_core` is the way to train it from
+    the rides array on disk.
+    """
+
+    def __init__(self,
+                 booster: Optional[lgb.Booster] = None,
+                 hyperparams: Optional[Dict] = None):
+        """
+        Args:
+            booster (Optional[lgb.Booster]): trained booster
+            hyperparams (Optional[Dict]): LGBMRegressor hyper-parameters
+                `fit` trains with
+        """
+        self.booster = booster
+        self.hyperparams = hyperparams
+
+    @property
+    def booster_(self) -> lgb.Booster:
+        return self.booster
+
+    def __sklearn_is_fitted__(self) -> bool:
+        return self.booster is not None
+
+    def fit(self, X, y, sample_weight=None) -> "BoosterRegressor":
+        # the LGBMRegressor hyper-parameter names are aliases LightGBM accepts
+        params = {'objective': 'regression', **(self.hyperparams or {})}
+        num_boost_round = params.pop('n_estimators', 100)
+
+        self.booster = lgb.train(params, lgb.Dataset(X, label=y, weight=sample_weight),
+                                 num_boost_round=num_boost_round)
+        return self
+
+    def predict(self, X) -> np.ndarray:
+        return self.booster.predict(X)
+
+
+def train_out_of_core(cutoff_date: datetime,
+                      path: Path = TS_MEMMAP_PATH,
+                      input_seq_len: int = config.N_FEATURES,
+                      step_size: int = 23,
+                      lags: Optional[Sequence[int]] = None,
+                      windows: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None,
+                      chunk_size: int = CHUNK_SIZE,
+                      **hyperparams) -> Tuple["Pipeline", Dict]:
+    """
+    Trains the `get_pipeline(lags, **hyperparams)` model on the windows of
+    the array written by `write_ts_memmap`, with the same windows and
+    train/test split as notebook 13.
+
+    LightGBM reads the training rows `chunk_size` at a time and only keeps
+    their histogram bins (1 byte per value), so peak memory is the binned
+    dataset plus one chunk, instead of several float32 copies of the feature
+    matrix.
+
+    Args:
+        cutoff_date (datetime): windows whose target hour is before it are
+            used for training, the rest for testing
+        path (Path): array written by `write_ts_memmap`
+        input_seq_len (int): hours in each window
+        step_size (int): hours between the targets of consecutive windows
+        lags (Optional[Sequence[int]]): lags (in hours) to train on, as in
+            `get_pipeline`. All `input_seq_len` lags if None
+        windows (Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]):
+            training windows, as rows, target columns and sample weights,
+            e.g. from `src.sampling.sample_windows`. If None, the windows
+            every `step_size` hours before `cutoff_date`, unweighted.
+            The test windows are always the latter
+        chunk_size (int): rows read per chunk
+        **hyperparams: LGBMRegressor hyper-parameters
+
+    Returns:
+        Tuple[Pipeline, Dict]:
+            - fitted pipeline, that predicts on features in the same format
+              as the rest of the models
+            - report with the number of train and test rows, the test mae
+              and the training time
+    """
+    from sklearn.metrics import mean_absolute_error
+
+    matrix, location_ids, pickup_hours = load_ts_memmap(path)
+    targets = get_window_targets(len(pickup_hours), input_seq_len, step_size)
+    is_train = to_hour_index(pickup_hours[targets]) < to_hour_index(cutoff_date)
+
+    weights = None
+    if windows is None:
+        train_windows = get_window_grid(len(location_ids), targets[is_train])
+    else:
+        train_windows, weights = windows[:2], windows[2]
+    test_windows = get_window_grid(len(location_ids), targets[~is_train])
+
+    if lags is not None:
+        lags = sorted(set(lags) | set(REQUIRED_LAGS), reverse=True)
+    window_lags = lags if lags is not None else range(input_seq_len, 0, -1)
+
+    train_rows = LagWindowSequence(matrix, location_ids, pickup_hours,
+                                   *train_windows, window_lags, chunk_size)
+    test_rows = LagWindowSequence(matrix, location_ids, pickup_hours,
+                                  *test_windows, window_lags, chunk_size)
+
+    # the LGBMRegressor hyper-parameter names are aliases LightGBM accepts
+    params = {'objective': 'regression', **hyperparams}
+    num_boost_round = params.pop('n_estimators', 100)
+
+    start = time.perf_counter()
+    dataset = lgb.Dataset([train_rows], label=train_rows.get_labels(), weight=weights,
+                          feature_name=train_rows.feature_names)
+    booster = lgb.train(params, dataset, num_boost_round=num_boost_round)
+    train_seconds = time.perf_counter() - start
+
+    pipeline = get_pipeline(lags=lags, **hyperparams)
+    pipeline.steps[-1] = (pipeline.steps[-1][0], BoosterRegressor(booster, hyperparams))
+
+    report = {
+        'n_train_rows': len(train_rows),
+        'n_test_rows': len(test_rows),
+        'test_mae': None,
+        'train_seconds': train_seconds,
+    }
+    if len(test_rows):
+        predictions = np.concatenate([
+            booster.predict(test_rows[i:i + chunk_size])
+            for i in range(0, len(test_rows), chunk_size)
+        ])
+        report['test_mae'] = mean_absolute_error(test_rows.get_labels(), predictions)
+
+    return pipeline, report
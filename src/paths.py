@@ -1,20 +1,23 @@
 from pathlib import Path
-import os
 
 PARENT_DIR = Path(__file__).parent.resolve().parent
 DATA_DIR = PARENT_DIR / 'data'
 RAW_DATA_DIR = DATA_DIR / 'raw'
+HOURLY_AGGREGATES_DIR = RAW_DATA_DIR / 'hourly_aggregates'
 TRANSFORMED_DATA_DIR = DATA_DIR / 'transformed'
+TABULAR_DATA_DIR = TRANSFORMED_DATA_DIR / 'tabular_data'
 MODELS_DIR = PARENT_DIR / 'models'
+DRIFT_DIR = DATA_DIR / 'drift'
+QUALITY_REPORTS_DIR = DATA_DIR / 'quality_reports'
+PREDICTION_CACHE_DIR = DATA_DIR / 'prediction_cache'
+PREDICTIONS_DIR = DATA_DIR / 'predictions'
+ROLLUPS_DIR = DATA_DIR / 'rollups'
 
-if not Path(DATA_DIR).exists():
-    os.mkdir(DATA_DIR)
 
-if not Path(RAW_DATA_DIR).exists():
-    os.mkdir(RAW_DATA_DIR)
-
-if not Path(TRANSFORMED_DATA_DIR).exists():
-    os.mkdir(TRANSFORMED_DATA_DIR)
-
-if not Path(MODELS_DIR).exists():
-    os.mkdir(MODELS_DIR)
\ No newline at end of file
+def create_directories() -> None:
+    """
+    Creates the local data and model directories, if they do not exist yet.
+    Called by the code that writes to them, instead of on import.
+    """
+    for directory in [DATA_DIR, RAW_DATA_DIR, TRANSFORMED_DATA_DIR, MODELS_DIR]:
+        directory.mkdir(parents=True, exist_ok=True)
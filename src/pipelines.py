@@ -0,0 +1,205 @@
+"""
+Feature and inference pipelines as importable functions, with the same steps
+as notebooks 12 and 14, so they can run in a resident process
+"""
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+import pandas as pd
+
+import src.config as config
+from src.data import add_missing_slots, get_sparse_ts_data, load_hourly_rides, load_raw_data
+from src.feature_store_api import delta_insert, get_or_create_feature_group
+from src.online_features import RideHistoryBuffer, update_online_buffer
+from src.prediction_store import mirror_predictions
+
+
+def fetch_batch_raw_data(from_date: datetime, to_date: datetime) -> pd.DataFrame:
+    """
+    Simulate production data by sampling historical data from 52 weeks ago (ie 1 year)
+    """
+    from_date_ = from_date - timedelta(days=7*52)
+    to_date_ = to_date - timedelta(days=7*52)
+
+    # download the 1 or 2 files that cover the range. Loading the same month
+    # twice would count its rides twice
+    months = {(from_date_.year, from_date_.month), (to_date_.year, to_date_.month)}
+    rides = pd.concat([load_raw_data(year=year, months=month)
+                       for year, month in sorted(months)])
+    rides['pickup_datetime'] = pd.to_datetime(rides['pickup_datetime']).dt.tz_localize(None)
+    rides = rides[(rides.pickup_datetime >= from_date_.replace(tzinfo=None))
+                  & (rides.pickup_datetime < to_date_.replace(tzinfo=None))].copy()
+
+    # Shift the data to pretend this is recent data
+    rides['pickup_datetime'] += timedelta(days=7*52)
+
+    rides.sort_values(by=['pickup_location_id', 'pickup_datetime'], inplace=True)
+
+    return rides
+
+
+def fetch_batch_hourly_rides(from_date: datetime, to_date: datetime) -> pd.DataFrame:
+    """
+    Same data as `fetch_batch_raw_data`, already counted per pickup_hour and
+    pickup_location_id. Reads the cached hourly aggregates of the raw files,
+    so the raw rides are only read the first time a file is used.
+    `from_date` and `to_date` must be whole hours.
+
+    Returns:
+        pd.DataFrame: columns `pickup_hour`, `pickup_location_id` and `rides`
+    """
+    from_date_ = pd.Timestamp(from_date - timedelta(days=7*52)).tz_localize(None)
+    to_date_ = pd.Timestamp(to_date - timedelta(days=7*52)).tz_localize(None)
+
+    months = {(from_date_.year, from_date_.month), (to_date_.year, to_date_.month)}
+    rides = pd.concat([load_hourly_rides(year=year, months=month)
+                       for year, month in sorted(months)])
+
+    rides = rides[(rides.pickup_hour >= from_date_) & (rides.pickup_hour < to_date_)].copy()
+
+    # Shift the data to pretend this is recent data
+    rides['pickup_hour'] += timedelta(days=7*52)
+
+    rides.sort_values(by=['pickup_location_id', 'pickup_hour'], inplace=True)
+
+    return rides
+
+
+def run_feature_pipeline(current_date: datetime,
+                         feature_group=None,
+                         online_buffer: Optional[RideHistoryBuffer] = None,
+                         wait_for_job: bool = True) -> pd.DataFrame:
+    """
+    Fetches the rides per hour of the last 28 days, and inserts the
+    (location, hour) slots with rides into the feature group. The online
+    buffer is updated with every slot, with 0 rides in the ones without.
+
+    Args:
+        current_date (datetime): current (rounded) hour, tz-aware UTC
+        feature_group: time-series feature group. Fetched from the feature
+            store if None
+        online_buffer (Optional[RideHistoryBuffer]): buffer updated in place
+            with the new data. The buffer snapshot on disk is updated if None
+        wait_for_job (bool): wait for the offline materialization job of the
+            insert. The online store is updated either way
+
+    Returns:
+        pd.DataFrame: dense time-series data, whose non-zero rows were inserted
+    """
+    # we fetch raw data for the last 28 days, to add redundancy to our data pipeline
+    fetch_data_to = current_date
+    fetch_data_from = current_date - timedelta(days=28)
+
+    rides = fetch_batch_hourly_rides(from_date=fetch_data_from, to_date=fetch_data_to)
+    ts_data = add_missing_slots(rides)
+    ts_data['pickup_location_id'] = ts_data['pickup_location_id'].astype('int64')
+
+    if feature_group is None:
+        feature_group = get_or_create_feature_group(
+            name=config.FEATURE_GROUP_NAME,
+            version=config.FEATURE_GROUP_VERSION,
+            description="Time series data at hourly frequency",
+            primary_key=['pickup_location_id', 'pickup_hour'],
+            event_time='pickup_hour'
+        )
+    # readers fill in the 0s, and only the hours that changed since the
+    # last run are sent
+    delta_insert(feature_group, get_sparse_ts_data(ts_data),
+                 write_options={"wait_for_job": wait_for_job})
+
+    if online_buffer is None:
+        update_online_buffer(ts_data)
+    else:
+        online_buffer.update_from_ts_data(ts_data)
+
+    return ts_data
+
+
+def run_inference_pipeline(current_date: datetime,
+                           model=None,
+                           predictions_feature_group=None,
+                           online_buffer: Optional[RideHistoryBuffer] = None,
+                           wait_for_job: bool = True,
+                           shadow_models: Optional[Dict[int, object]] = None,
+                           shadow_feature_group=None) -> pd.DataFrame:
+    """
+    Predicts the demand for `current_date` in every location and inserts
+    the predictions into the predictions feature group.
+
+    With `shadow_models`, the challengers score the same feature matrix as
+    the production model, and the predictions of all of them, tagged with
+    their model_version, are inserted into the shadow predictions feature
+    group. Only the production model's predictions go to the predictions
+    feature group.
+
+    Args:
+        current_date (datetime): current (rounded) hour, tz-aware UTC
+        model: trained model. Loaded from the model registry if None
+        predictions_feature_group: predictions feature group. Fetched from
+            the feature store if None
+        online_buffer (Optional[RideHistoryBuffer]): if it covers
+            `current_date`, features are read from it instead of the store
+        wait_for_job (bool): wait for the offline materialization job of the
+            insert
+        shadow_models (Optional[Dict[int, object]]): challenger models, by
+            registry version
+        shadow_feature_group: shadow predictions feature group. Fetched
+            from the feature store if None
+
+    Returns:
+        pd.DataFrame: predictions of the production model, with columns `pickup_location_id`,
+        `predicted_demand` and `pickup_hour`
+    """
+    from src.inference_1 import (
+        get_model_predictions,
+        load_batch_of_features_from_store,
+        load_model_from_registry
+    )
+    from src.model import get_model_lags
+    from src.monitoring import update_drift_sketches
+
+    if model is None:
+        model = load_model_from_registry()
+
+    # models trained on a lag subset only need those lags fetched (lags is
+    # None for models that use all of them)
+    if shadow_models:
+        from src.shadow import get_shared_lags, score_models, write_shadow_predictions
+
+        models = {config.MODEL_VERSION: model, **shadow_models}
+
+        # one feature matrix, with the lags of every model
+        features = load_batch_of_features_from_store(
+            current_date, online_buffer=online_buffer, lags=get_shared_lags(models))
+
+        all_predictions, latencies = score_models(models, features)
+        write_shadow_predictions(all_predictions, latencies, shadow_feature_group, wait_for_job)
+
+        is_production = all_predictions['model_version'] == config.MODEL_VERSION
+        predictions = all_predictions.loc[is_production].drop(columns='model_version')
+        predictions = predictions.reset_index(drop=True)
+    else:
+        features = load_batch_of_features_from_store(
+            current_date, online_buffer=online_buffer, lags=get_model_lags(model))
+
+        predictions = get_model_predictions(model, features)
+        predictions['pickup_hour'] = current_date
+
+    if predictions_feature_group is None:
+        predictions_feature_group = get_or_create_feature_group(
+            name=config.FEATURE_GROUP_MODEL_PREDICTIONS,
+            version=1,
+            description="Predictions generated by our production model",
+            primary_key=['pickup_location_id', 'pickup_hour'],
+            event_time='pickup_hour'
+        )
+    delta_insert(predictions_feature_group, predictions,
+                 write_options={"wait_for_job": wait_for_job})
+    # local copy, read by `load_predictions_from_store` without waiting for
+    # the offline materialization
+    mirror_predictions(predictions)
+
+    # add this hour of inputs and predictions to the drift sketches
+    update_drift_sketches(features, predictions)
+
+    return predictions
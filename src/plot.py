@@ -1,20 +1,21 @@
+import numpy as np
 import pandas as pd
 from typing import Optional
 from datetime import timedelta
 
-import plotly.express as px
-
 def plot_one_sample(
         features: pd.DataFrame,
         targets: pd.Series,
         example_id: int,
         predictions: Optional[pd.Series]=None,):
     """"""
+    import plotly.express as px
+
     features_ = features.iloc[example_id]
     target_ = targets.iloc[example_id]
 
     ts_columns = [c for c in features.columns if c.startswith('rides_previous_')]
-    ts_values = [features_[c] for c in ts_columns] + [target_]
+    ts_values = np.append(features_[ts_columns].to_numpy(dtype=np.float64), target_)
     ts_dates = pd.date_range(
         features_['pickup_hour'] - timedelta(hours=len(ts_columns)),
         features_['pickup_hour'],
@@ -42,4 +43,134 @@ def plot_one_sample(
                     mode='markers', marker_symbol= 'x', 
                     marker_size=15, name='prediction')
         
-    return fig
\ No newline at end of file
+    return fig
+
+def lttb_indices(values: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets downsampling, vectorized across series.
+
+    Keeps the first and last point of each series, and from each of the
+    `n_out - 2` buckets in between, the point that forms the largest triangle
+    with the point kept in the previous bucket and the average of the next
+    bucket. This preserves peaks and dips much better than taking every k-th
+    point.
+
+    Args:
+        values (np.ndarray): (n_series, n_points) array of evenly spaced values
+        n_out (int): number of points to keep per series
+
+    Returns:
+        np.ndarray: (n_series, n_out) array with the indices of the points
+        to keep, in increasing order
+    """
+    n_series, n_points = values.shape
+    if n_out >= n_points or n_out < 3:
+        return np.tile(np.arange(n_points), (n_series, 1))
+
+    rows = np.arange(n_series)
+    indices = np.empty((n_series, n_out), dtype=np.int64)
+    indices[:, 0] = 0
+    indices[:, -1] = n_points - 1
+
+    # bucket boundaries over the points between the first and the last one
+    edges = np.linspace(1, n_points - 1, n_out - 1).astype(np.int64)
+
+    prev_idx = np.zeros(n_series, dtype=np.int64)
+    for b in range(n_out - 2):
+        start, stop = edges[b], edges[b + 1]
+        next_start = stop
+        next_stop = edges[b + 2] if b + 2 < len(edges) else n_points
+        next_x = 0.5 * (next_start + next_stop - 1)
+        next_y = values[:, next_start:next_stop].mean(axis=1)
+
+        prev_y = values[rows, prev_idx]
+        bucket_x = np.arange(start, stop)
+        bucket_y = values[:, start:stop]
+
+        # twice the area of the triangles (prev point, candidate, next avg)
+        areas = np.abs(
+            (prev_idx[:, None] - next_x) * (bucket_y - prev_y[:, None])
+            - (prev_idx[:, None] - bucket_x[None, :]) * (next_y - prev_y)[:, None]
+        )
+        prev_idx = start + areas.argmax(axis=1)
+        indices[:, b + 1] = prev_idx
+
+    return indices
+
+
+def plot_top_samples(
+        features: pd.DataFrame,
+        predictions: pd.Series,
+        n_to_plot: int = 10,
+        targets: Optional[pd.Series] = None,
+        max_points: Optional[int] = 150):
+    """
+    Plots the `n_to_plot` time-series with the highest predictions in one
+    faceted figure, one row per location, instead of one figure per location.
+
+    Args:
+        features (pd.DataFrame): columns `rides_previous_N_hour` ...
+            `rides_previous_1_hour`, `pickup_hour` and `pickup_location_id`
+        predictions (pd.Series): predicted demand, aligned with `features` rows
+        n_to_plot (int): number of locations to plot
+        targets (Optional[pd.Series]): actual values, aligned with `features` rows
+        max_points (Optional[int]): if set, each series is downsampled with LTTB
+            to at most this many points, to keep the figure light in the browser
+
+    Returns:
+        plotly Figure
+    """
+    from plotly.subplots import make_subplots
+    import plotly.graph_objects as go
+
+    predictions_ = np.asarray(predictions, dtype=np.float64)
+    row_indices = np.argsort(predictions_)[::-1][:n_to_plot]
+
+    # one slice with the history of all the locations we plot
+    ts_columns = [c for c in features.columns if c.startswith('rides_previous_')]
+    ts_values = features[ts_columns].to_numpy(dtype=np.float64)[row_indices]
+    n_hours = len(ts_columns)
+
+    if max_points is not None:
+        point_indices = lttb_indices(ts_values, max_points)
+        ts_values = np.take_along_axis(ts_values, point_indices, axis=1)
+    else:
+        point_indices = np.tile(np.arange(n_hours), (len(row_indices), 1))
+
+    pickup_hours = pd.to_datetime(features['pickup_hour']).to_numpy()[row_indices]
+    location_ids = features['pickup_location_id'].to_numpy()[row_indices]
+
+    fig = make_subplots(
+        rows=len(row_indices), cols=1,
+        subplot_titles=[f'Pick up hour={h}, location_id={l}'
+                        for h, l in zip(pd.DatetimeIndex(pickup_hours), location_ids)],
+        vertical_spacing=min(0.3 / max(len(row_indices), 1), 0.05),
+    )
+
+    hour = np.timedelta64(1, 'h')
+    for i in range(len(row_indices)):
+        ts_dates = pickup_hours[i] - (n_hours - point_indices[i]) * hour
+        show_legend = i == 0
+
+        fig.add_trace(go.Scattergl(x=ts_dates, y=ts_values[i], mode='lines+markers',
+                                   line_color='#636efa', marker_size=4,
+                                   name='past values', legendgroup='past',
+                                   showlegend=show_legend),
+                      row=i + 1, col=1)
+
+        if targets is not None:
+            fig.add_trace(go.Scattergl(x=[pickup_hours[i]], y=[targets.iloc[row_indices[i]]],
+                                       mode='markers', marker_color='green', marker_size=10,
+                                       name='actual value', legendgroup='actual',
+                                       showlegend=show_legend),
+                          row=i + 1, col=1)
+
+        fig.add_trace(go.Scattergl(x=[pickup_hours[i]], y=[predictions_[row_indices[i]]],
+                                   mode='markers', marker_color='red', marker_symbol='x',
+                                   marker_size=15, name='prediction', legendgroup='prediction',
+                                   showlegend=show_legend),
+                      row=i + 1, col=1)
+
+    fig.update_layout(template='plotly_dark', height=300 * len(row_indices))
+
+    return fig
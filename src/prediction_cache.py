@@ -0,0 +1,320 @@
+"""
+Cache of the live frontend's features and predictions, shared by every
+session and rerun of the app.
+
+Predictions only change once per hour, so each entry is computed once and
+kept until the end of the hour it was computed in, in memory and on disk
+(so a restarted or second app process reuses it). Concurrent sessions that
+miss the same entry wait for the one computing it (single flight), within
+the process through a lock per entry and across processes through a lock
+file, instead of all reading the store and predicting at once.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.hours import from_hour_index, to_hour_index
+from src.paths import PREDICTION_CACHE_DIR
+
+
+def get_features_fingerprint(features: pd.DataFrame) -> str:
+    """
+    Fingerprint of a batch of features, so predictions are only reused for
+    the exact features they were computed on. Computed on the lag values,
+    location ids and hour indices, so it does not change when the batch is
+    read back from disk with another datetime unit
+    """
+    lag_columns = [c for c in features.columns if c.startswith('rides_previous_')]
+
+    digest = hashlib.sha1(','.join(lag_columns).encode())
+    digest.update(np.ascontiguousarray(features[lag_columns].to_numpy(dtype=np.float32)))
+    digest.update(features['pickup_location_id'].to_numpy(dtype=np.int64))
+    digest.update(np.asarray(to_hour_index(features['pickup_hour']), dtype=np.int64))
+
+    return digest.hexdigest()[:16]
+
+
+def get_expiry_hour(now: Optional[datetime] = None) -> int:
+    """Hour index (see `src.hours`) of the next hour boundary after `now`"""
+    if now is None:
+        now = pd.Timestamp.now(tz='UTC')
+    return to_hour_index(now) + 1
+
+
+class HourlyCache:
+    """
+    Single-flight cache of DataFrames that expire at the next hour boundary
+    after they were computed.
+
+    Entries live in a small in-memory LRU, and, with `cache_dir`, as parquet
+    files with a JSON sidecar holding the key and the expiry hour. Cached
+    frames are shared by all callers, which must not modify them.
+    """
+
+    def __init__(self,
+                 cache_dir: Optional[Path] = PREDICTION_CACHE_DIR,
+                 max_entries: int = 8,
+                 clock: Callable[[], datetime] = lambda: pd.Timestamp.now(tz='UTC')):
+        """
+        Args:
+            cache_dir (Optional[Path]): directory of the disk entries. Memory
+                only if None
+            max_entries (int): max number of entries kept in memory
+            clock (Callable[[], datetime]): current UTC time
+        """
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self._max_entries = max_entries
+        self._clock = clock
+
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks: Dict[str, threading.Lock] = {}
+
+        # number of `get` calls answered from memory, from disk, or computed
+        self.stats = {'memory': 0, 'disk': 0, 'computed': 0}
+
+    @staticmethod
+    def _digest(key: Tuple[Hashable, ...]) -> str:
+        return hashlib.sha1('|'.join(map(str, key)).encode()).hexdigest()[:16]
+
+    def _get_from_memory(self, digest: str, now_hour: int) -> Optional[pd.DataFrame]:
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            expiry_hour, value = entry
+            if now_hour >= expiry_hour:
+                del self._entries[digest]
+                return None
+            self._entries.move_to_end(digest)
+            return value
+
+    def _put_in_memory(self, digest: str, expiry_hour: int, value: pd.DataFrame) -> None:
+        with self._lock:
+            self._entries[digest] = (expiry_hour, value)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self._max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                self._key_locks.pop(evicted, None)
+
+    def _count(self, source: str) -> None:
+        with self._lock:
+            self.stats[source] += 1
+
+    def _get_from_disk(self, digest: str, now_hour: int) -> Optional[Tuple[int, pd.DataFrame]]:
+        if self.cache_dir is None:
+            return None
+
+        metadata_path = self.cache_dir / f'{digest}.json'
+        try:
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+            if now_hour >= metadata['expiry_hour']:
+                return None
+            return metadata['expiry_hour'], pd.read_parquet(self.cache_dir / f'{digest}.parquet')
+        except FileNotFoundError:
+            # not cached, or just removed as expired by another process
+            return None
+
+    def _put_on_disk(self,
+                     digest: str,
+                     key: Tuple[Hashable, ...],
+                     expiry_hour: int,
+                     value: pd.DataFrame) -> None:
+        # written under temporary names and renamed, so readers in other
+        # processes never see a partial file. The sidecar goes last, as it
+        # is what marks the entry as valid
+        data_path = self.cache_dir / f'{digest}.parquet'
+        value.to_parquet(data_path.with_suffix('.parquet.tmp'), index=False)
+        os.replace(data_path.with_suffix('.parquet.tmp'), data_path)
+
+        metadata_path = self.cache_dir / f'{digest}.json'
+        with open(metadata_path.with_suffix('.json.tmp'), 'w') as f:
+            json.dump({'key': [str(part) for part in key],
+                       'expiry_hour': expiry_hour,
+                       'expires_at': from_hour_index(expiry_hour).isoformat()}, f)
+        os.replace(metadata_path.with_suffix('.json.tmp'), metadata_path)
+
+    def _remove_expired_from_disk(self, now_hour: int) -> None:
+        """Deletes the disk entries of past hours, so the directory does not grow"""
+        for metadata_path in self.cache_dir.glob('*.json'):
+            try:
+                with open(metadata_path) as f:
+                    expiry_hour = json.load(f)['expiry_hour']
+            except (OSError, ValueError, KeyError):
+                # being replaced by another process
+                continue
+            if now_hour >= expiry_hour:
+                for suffix in ('.json', '.parquet'):
+                    metadata_path.with_suffix(suffix).unlink(missing_ok=True)
+
+        # lock files of entries with no sidecar (expired, or never computed)
+        # are only removed while holding them, so no other process is
+        # computing their entry. `_lock_entry` reopens a lock file removed
+        # while it waited for it
+        for lock_path in self.cache_dir.glob('*.lock'):
+            if lock_path.with_suffix('.json').exists():
+                continue
+            try:
+                with open(lock_path, 'a') as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    lock_path.unlink(missing_ok=True)
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+            except (BlockingIOError, FileNotFoundError):
+                continue
+
+    def _lock_entry(self, digest: str):
+        """
+        Lock file of `digest`, open and locked, blocking while another
+        process holds it
+        """
+        lock_path = self.cache_dir / f'{digest}.lock'
+        while True:
+            lock_file = open(lock_path, 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # the file may have been removed (and recreated) while this
+                # process waited, its lock no longer excludes anyone
+                if os.fstat(lock_file.fileno()).st_ino == os.stat(lock_path).st_ino:
+                    return lock_file
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+
+    def _get_key_lock(self, digest: str) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(digest, threading.Lock())
+
+    def get(self,
+            key: Tuple[Hashable, ...],
+            compute: Callable[[], pd.DataFrame],
+            is_cacheable: Optional[Callable[[pd.DataFrame], bool]] = None) -> pd.DataFrame:
+        """
+        Returns the entry for `key`, calling `compute` only if it is not
+        cached yet (or it expired). Concurrent callers with the same key
+        wait for the first one, and get its result.
+
+        Args:
+            key (Tuple[Hashable, ...]): key of the entry. Its parts are
+                compared as strings
+            compute (Callable[[], pd.DataFrame]): builds the entry
+            is_cacheable (Optional[Callable[[pd.DataFrame], bool]]): whether
+                a computed entry can be kept. Entries it rejects are
+                returned but not cached, so the next call computes them
+                again. Every entry is kept if None
+
+        Returns:
+            pd.DataFrame: cached or computed entry
+        """
+        digest = self._digest(key)
+        now_hour = to_hour_index(self._clock())
+
+        value = self._get_from_memory(digest, now_hour)
+        if value is not None:
+            self._count('memory')
+            return value
+
+        with self._get_key_lock(digest):
+            # another thread may have filled it while this one waited
+            value = self._get_from_memory(digest, now_hour)
+            if value is not None:
+                self._count('memory')
+                return value
+
+            if self.cache_dir is None:
+                return self._compute(digest, key, compute, is_cacheable)
+
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # blocks while another process computes the same entry
+            with self._lock_entry(digest) as lock_file:
+                try:
+                    cached = self._get_from_disk(digest, now_hour)
+                    if cached is not None:
+                        self._count('disk')
+                        self._put_in_memory(digest, *cached)
+                        return cached[1]
+
+                    return self._compute(digest, key, compute, is_cacheable)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _compute(self,
+                 digest: str,
+                 key: Tuple[Hashable, ...],
+                 compute: Callable[[], pd.DataFrame],
+                 is_cacheable: Optional[Callable[[pd.DataFrame], bool]] = None) -> pd.DataFrame:
+        value = compute()
+        self._count('computed')
+        if is_cacheable is not None and not is_cacheable(value):
+            return value
+
+        # valid until the end of the hour it was computed in
+        expiry_hour = get_expiry_hour(self._clock())
+        self._put_in_memory(digest, expiry_hour, value)
+        if self.cache_dir is not None:
+            self._remove_expired_from_disk(expiry_hour - 1)
+            self._put_on_disk(digest, key, expiry_hour, value)
+
+        return value
+
+
+class PredictionCache(HourlyCache):
+    """
+    The frontend's features and predictions for an hour: the features are
+    read from the store once per hour, and the predictions computed once
+    per (pickup_hour, model_version, features fingerprint)
+    """
+
+    def get_features(self,
+                     pickup_hour: datetime,
+                     load_features: Callable[[datetime], pd.DataFrame]) -> pd.DataFrame:
+        """
+        Features for `pickup_hour`, from `load_features(pickup_hour)`
+        (e.g. `load_batch_of_features_from_store`) on a miss.
+
+        Features that do not reach the hour before `pickup_hour` (the
+        feature pipeline has not written it yet) are not cached, so the
+        next call reads the store again instead of serving stale features
+        for the rest of the hour.
+        """
+        hour_index = to_hour_index(pickup_hour)
+
+        def is_up_to_date(features: pd.DataFrame) -> bool:
+            # the last lag of a batch is the hour before its pickup_hour
+            return (not features.empty
+                    and to_hour_index(features['pickup_hour']).max() >= hour_index)
+
+        return self.get(('features', hour_index), lambda: load_features(pickup_hour), is_up_to_date)
+
+    def get_predictions(self,
+                        pickup_hour: datetime,
+                        model_version: int,
+                        features: pd.DataFrame,
+                        predict: Callable[[pd.DataFrame], pd.DataFrame]) -> pd.DataFrame:
+        """
+        Predictions on `features`, from `predict(features)` on a miss.
+        `predict` is only called on a miss, so it is where the model should
+        be loaded.
+
+        Args:
+            pickup_hour (datetime): hour the predictions are for
+            model_version (int): version of the model that makes them
+            features (pd.DataFrame): batch of features for `pickup_hour`
+            predict (Callable[[pd.DataFrame], pd.DataFrame]): e.g.
+                `get_model_predictions` with the model loaded
+
+        Returns:
+            pd.DataFrame: columns `pickup_location_id` and `predicted_demand`
+        """
+        key = ('predictions', to_hour_index(pickup_hour), model_version,
+               get_features_fingerprint(features))
+        return self.get(key, lambda: predict(features))
@@ -0,0 +1,114 @@
+"""
+Local copy of the predictions feature group, indexed by hour.
+
+Each pickup_hour is one parquet file, named by its hour index (see
+`src.hours`), so reading the predictions of a (from_hour, to_hour) range
+opens only the files of those hours, at a cost proportional to the result
+and not to the history in the feature group. The inference pipelines mirror
+the predictions they insert, and `src.inference_1.load_predictions_from_store`
+reads the hours it does not have from the feature group, with a filter on
+the missing range, and mirrors them too.
+"""
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.hours import from_hour_index, to_hour_index
+from src.paths import PREDICTIONS_DIR
+
+PREDICTION_COLUMNS = ['pickup_location_id', 'predicted_demand', 'pickup_hour']
+
+
+class LocalPredictionStore:
+    """
+    Predictions on local disk, one parquet file per pickup_hour.
+
+    Writes upsert on (pickup_location_id, pickup_hour), as inserts into the
+    feature group do, and replace each file atomically, so readers in other
+    processes (e.g. the frontend) never see a partial file.
+    """
+
+    def __init__(self, path: Path = PREDICTIONS_DIR):
+        self.path = Path(path)
+
+    def _get_path(self, hour_index: int) -> Path:
+        return self.path / f'{hour_index}.parquet'
+
+    def write(self, predictions: pd.DataFrame) -> None:
+        """
+        Adds `predictions` to the store, replacing the ones it already has
+        for the same location and hour.
+
+        Args:
+            predictions (pd.DataFrame): columns `pickup_location_id`,
+                `predicted_demand` and `pickup_hour`, of one or more hours
+        """
+        if predictions.empty:
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        hour_index = to_hour_index(predictions['pickup_hour'])
+        order = np.argsort(hour_index, kind='stable')
+        hours, starts = np.unique(hour_index[order], return_index=True)
+
+        for hour, rows in zip(hours, np.split(order, starts[1:])):
+            # pickup_hour is stored as tz-aware UTC, whatever it was written as
+            hour_predictions = predictions.iloc[rows][PREDICTION_COLUMNS].assign(
+                pickup_hour=from_hour_index(int(hour)))
+
+            path = self._get_path(int(hour))
+            if path.exists():
+                hour_predictions = pd.concat([pd.read_parquet(path), hour_predictions],
+                                             ignore_index=True)
+                hour_predictions = hour_predictions.drop_duplicates(
+                    subset=['pickup_location_id'], keep='last')
+
+            tmp_path = path.with_suffix('.parquet.tmp')
+            hour_predictions.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+
+    def read(self,
+             from_hour: datetime,
+             to_hour: datetime) -> Tuple[pd.DataFrame, List[int]]:
+        """
+        Predictions for the hours in [from_hour, to_hour] the store has.
+
+        Returns:
+            Tuple[pd.DataFrame, List[int]]:
+                - predictions, with columns `pickup_location_id`,
+                  `predicted_demand` and `pickup_hour`
+                - hour indices of the hours in the range the store does not
+                  have
+        """
+        return self.read_hours(range(to_hour_index(from_hour), to_hour_index(to_hour) + 1))
+
+    def read_hours(self, hours: Sequence[int]) -> Tuple[pd.DataFrame, List[int]]:
+        """Same as `read`, for a list of hour indices"""
+        frames, missing_hours = [], []
+        for hour in hours:
+            path = self._get_path(int(hour))
+            try:
+                frames.append(pd.read_parquet(path))
+            except FileNotFoundError:
+                missing_hours.append(hour)
+
+        if not frames:
+            return pd.DataFrame(columns=PREDICTION_COLUMNS), missing_hours
+
+        return pd.concat(frames, ignore_index=True), missing_hours
+
+
+def mirror_predictions(predictions: pd.DataFrame) -> None:
+    """
+    Writes predictions just inserted into the predictions feature group to
+    the local store. A failure is only reported, as the feature group is
+    the source of truth, and readers fall back to it
+    """
+    try:
+        LocalPredictionStore().write(predictions)
+    except Exception as e:
+        print(f'Could not mirror {len(predictions)} predictions locally: {e!r}')
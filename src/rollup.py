@@ -0,0 +1,316 @@
+"""
+Spatial rollup of the hourly error metrics, from taxi zones to boroughs,
+service zones and the whole city.
+
+The additive metrics of every zone and hour (`src.metrics.SUM_COLUMNS`:
+actual rides, predictions, errors) are rolled up to every group of every
+level at once, with one multiply by a sparse (groups x zones) aggregation
+matrix built from the taxi zone lookup. The result is a small dense
+(groups x hours x SUM_COLUMNS) cube, so a rollup for any group and range
+of hours is an index lookup instead of a join and a group-by over the
+monitoring data.
+
+`materialize_error_metrics` keeps the cube up to date and uploads it to
+the project's datasets (config.ROLLUP_CUBE_DATASET_DIR), next to the
+metrics feature group, where the monitoring dashboard downloads it from.
+"""
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Sequence, Tuple, TYPE_CHECKING
+
+import numpy as np
+import pandas as pd
+
+import src.config as config
+from src.feature_store_api import download_dataset_file, get_dataset_api, upload_dataset_file
+from src.hours import from_hour_index, to_hour_index
+from src.metrics import ALL_LOCATIONS, SUM_COLUMNS, summarize_error_metrics
+from src.paths import ROLLUPS_DIR
+
+if TYPE_CHECKING:
+    from hopsworks.core.dataset_api import DatasetApi
+    from scipy.sparse import csr_matrix
+
+ROLLUP_CUBE_PATH = ROLLUPS_DIR / 'error_metrics_cube.npz'
+
+# levels above the zones, from the columns of the taxi zone lookup, plus
+# the whole city
+ROLLUP_LEVELS = ['borough', 'service_zone', 'city']
+CITY = 'NYC'
+
+# group of the zones the lookup has no borough or service zone for
+UNKNOWN_GROUP = 'Unknown'
+
+
+def get_aggregation_matrix(location_ids: np.ndarray,
+                           zone_lookup: pd.DataFrame,
+                           levels: Sequence[str] = ROLLUP_LEVELS
+                           ) -> Tuple["csr_matrix", pd.MultiIndex]:
+    """
+    0/1 matrix that sums the rows of each group of each level, e.g. the
+    zones of each borough.
+
+    Args:
+        location_ids (np.ndarray): pickup_location_id of each column
+        zone_lookup (pd.DataFrame): output of `src.data.load_taxi_zone_lookup`
+        levels (Sequence[str]): columns of `zone_lookup`, or 'city'
+
+    Returns:
+        Tuple[csr_matrix, pd.MultiIndex]:
+            - (groups x locations) sparse matrix, with one 1 per location
+              and level
+            - (level, group) of each row, sorted by group within each level
+    """
+    from scipy.sparse import csr_matrix
+
+    zones = zone_lookup.drop_duplicates('pickup_location_id').set_index('pickup_location_id')
+    columns = np.arange(len(location_ids))
+
+    rows, group_levels, group_names = [], [], []
+    for level in levels:
+        if level == 'city':
+            labels = pd.Series(CITY, index=location_ids)
+        else:
+            labels = zones[level].reindex(location_ids).fillna(UNKNOWN_GROUP).astype(str)
+        codes, names = pd.factorize(labels, sort=True)
+
+        rows.append(len(group_names) + codes)
+        group_levels += [level] * len(names)
+        group_names += list(names)
+
+    matrix = csr_matrix(
+        (np.ones(len(levels) * len(location_ids)), (np.concatenate(rows), np.tile(columns, len(levels)))),
+        shape=(len(group_names), len(location_ids)),
+    )
+    groups = pd.MultiIndex.from_arrays([group_levels, group_names], names=['level', 'group'])
+
+    return matrix, groups
+
+
+class RollupCube:
+    """
+    SUM_COLUMNS of every (level, group) and hour, in a
+    (groups x hours x SUM_COLUMNS) array.
+
+    Cubes add up like the metrics they hold: `update` overwrites the hours
+    the new cube has, as `materialize_error_metrics` recomputes the last
+    hours on each run.
+    """
+
+    def __init__(self,
+                 groups: pd.MultiIndex,
+                 first_hour: int = 0,
+                 values: Optional[np.ndarray] = None):
+        """
+        Args:
+            groups (pd.MultiIndex): (level, group) of each row
+            first_hour (int): hour index (see `src.hours`) of the first column
+            values (Optional[np.ndarray]): float64 array with shape
+                (len(groups), n_hours, len(SUM_COLUMNS))
+        """
+        if values is None:
+            values = np.zeros((len(groups), 0, len(SUM_COLUMNS)))
+        assert values.shape[0] == len(groups) and values.shape[2] == len(SUM_COLUMNS)
+
+        self.groups = groups
+        self.first_hour = int(first_hour)
+        self.values = values
+
+    @property
+    def n_hours(self) -> int:
+        return self.values.shape[1]
+
+    @classmethod
+    def from_metrics(cls,
+                     metrics: pd.DataFrame,
+                     zone_lookup: Optional[pd.DataFrame] = None) -> "RollupCube":
+        """
+        Rolls up per-zone metrics.
+
+        Args:
+            metrics (pd.DataFrame): output of `compute_error_metrics` or
+                `load_error_metrics_from_store`. The ALL_LOCATIONS rows are
+                ignored, the city level adds up the zones
+            zone_lookup (Optional[pd.DataFrame]): from
+                `src.data.load_taxi_zone_lookup` if None
+
+        Returns:
+            RollupCube: one column per hour between the first and the last
+            hour of `metrics`
+        """
+        if zone_lookup is None:
+            from src.data import load_taxi_zone_lookup
+            zone_lookup = load_taxi_zone_lookup()
+
+        metrics = metrics[metrics['pickup_location_id'] != ALL_LOCATIONS]
+        location_ids, rows = np.unique(
+            metrics['pickup_location_id'].to_numpy(dtype=np.int64), return_inverse=True)
+        matrix, groups = get_aggregation_matrix(location_ids, zone_lookup)
+
+        if metrics.empty:
+            return cls(groups)
+
+        hour_index = to_hour_index(metrics['pickup_hour'])
+        first_hour = int(hour_index.min())
+        n_hours = int(hour_index.max()) - first_hour + 1
+
+        # (locations, hours x SUM_COLUMNS) in one scatter, and every group
+        # of every level in one multiply
+        per_location = np.zeros((len(location_ids), n_hours, len(SUM_COLUMNS)))
+        per_location[rows, hour_index - first_hour] = metrics[SUM_COLUMNS].to_numpy(dtype=np.float64)
+        values = matrix @ per_location.reshape(len(location_ids), -1)
+
+        return cls(groups, first_hour, np.asarray(values).reshape(len(groups), n_hours, -1))
+
+    def update(self, other: "RollupCube") -> "RollupCube":
+        """
+        New cube with the hours and groups of both, taking the hours with
+        observations in `other` from `other`
+        """
+        if other.n_hours == 0:
+            return self
+        if self.n_hours == 0 and self.groups.equals(other.groups):
+            return other
+
+        groups = self.groups.append(other.groups[~other.groups.isin(self.groups)])
+        first_hour = min(self.first_hour, other.first_hour) if self.n_hours else other.first_hour
+        last_hour = max(self.first_hour + self.n_hours, other.first_hour + other.n_hours)
+
+        values = np.zeros((len(groups), last_hour - first_hour, len(SUM_COLUMNS)))
+        for cube in (self, other):
+            rows = groups.get_indexer(cube.groups)
+            start = cube.first_hour - first_hour
+            has_obs = cube.values[:, :, SUM_COLUMNS.index('n_obs')].sum(axis=0) > 0
+            hours = start + np.flatnonzero(has_obs)
+            values[:, hours] = 0
+            values[rows[:, None], hours] = cube.values[:, has_obs]
+
+        return RollupCube(groups, first_hour, values)
+
+    def query(self,
+              level: str,
+              group: Optional[str] = None,
+              from_hour: Optional[datetime] = None,
+              to_hour: Optional[datetime] = None,
+              by_hour: bool = True) -> pd.DataFrame:
+        """
+        Metrics of the groups of `level` (or only `group`) between
+        `from_hour` and `to_hour`, read from the cube by index.
+
+        Args:
+            level (str): one of ROLLUP_LEVELS
+            group (Optional[str]): e.g. 'Manhattan'. Every group of `level`
+                if None
+            from_hour (Optional[datetime]): first hour, included. The first
+                hour of the cube if None
+            to_hour (Optional[datetime]): last hour, included. The last
+                hour of the cube if None
+            by_hour (bool): one row per group and hour, else one row per
+                group for the whole range
+
+        Returns:
+            pd.DataFrame: columns `level`, `group`, `pickup_hour` (with
+            `by_hour`), SUM_COLUMNS, `mae`, `mape`, `bias` and
+            `rollup_abs_error`, the absolute error of the group's total
+            prediction (|predicted_demand - rides|). Only hours with
+            observations are returned
+        """
+        rows = np.flatnonzero(self.groups.get_level_values('level') == level)
+        if group is not None:
+            rows = rows[self.groups[rows].get_level_values('group') == group]
+
+        start = 0 if from_hour is None else max(to_hour_index(from_hour) - self.first_hour, 0)
+        end = self.n_hours if to_hour is None else min(to_hour_index(to_hour) - self.first_hour + 1,
+                                                       self.n_hours)
+        end = max(end, start)
+        values = self.values[rows, start:end]
+
+        groups = self.groups[rows]
+        n_hours = end - start
+        rollup = pd.DataFrame(values.reshape(-1, len(SUM_COLUMNS)), columns=SUM_COLUMNS)
+        rollup.insert(0, 'level', np.repeat(groups.get_level_values('level'), n_hours))
+        rollup.insert(1, 'group', np.repeat(groups.get_level_values('group'), n_hours))
+        rollup.insert(2, 'pickup_hour', np.tile(
+            from_hour_index(self.first_hour + np.arange(start, end)), len(groups)))
+        rollup = rollup[rollup['n_obs'] > 0]
+
+        by = ['level', 'group', 'pickup_hour'] if by_hour else ['level', 'group']
+        rollup = summarize_error_metrics(rollup, by=by)
+        rollup['rollup_abs_error'] = (rollup['predicted_demand'] - rollup['rides']).abs()
+
+        return rollup
+
+    def save(self, path: Path = ROLLUP_CUBE_PATH) -> None:
+        """Writes the cube as .npz, replacing `path` atomically"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix('.npz.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f,
+                                levels=np.array(self.groups.get_level_values('level'), dtype=str),
+                                groups=np.array(self.groups.get_level_values('group'), dtype=str),
+                                first_hour=np.array(self.first_hour),
+                                columns=np.array(SUM_COLUMNS),
+                                values=self.values)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path = ROLLUP_CUBE_PATH) -> "RollupCube":
+        with np.load(path) as data:
+            # cubes of another version of SUM_COLUMNS can not be queried
+            assert list(data['columns']) == SUM_COLUMNS
+            groups = pd.MultiIndex.from_arrays([data['levels'], data['groups']],
+                                               names=['level', 'group'])
+            return cls(groups, int(data['first_hour']), data['values'])
+
+
+def download_rollup_cube(local_dir: Path = ROLLUPS_DIR,
+                         dataset_api: Optional["DatasetApi"] = None) -> Optional[RollupCube]:
+    """
+    Latest cube uploaded by `update_rollup_cube`, downloaded to `local_dir`
+
+    Returns:
+        Optional[RollupCube]: None if no cube was uploaded yet
+    """
+    path = Path(local_dir) / ROLLUP_CUBE_PATH.name
+    if not download_dataset_file(config.ROLLUP_CUBE_DATASET_DIR, path, dataset_api):
+        return None
+    return RollupCube.load(path)
+
+
+def upload_rollup_cube(path: Path = ROLLUP_CUBE_PATH,
+                       dataset_api: Optional["DatasetApi"] = None) -> None:
+    """Uploads the cube saved in `path` for `download_rollup_cube`"""
+    upload_dataset_file(path, config.ROLLUP_CUBE_DATASET_DIR, dataset_api)
+
+
+def update_rollup_cube(metrics: pd.DataFrame,
+                       zone_lookup: Optional[pd.DataFrame] = None,
+                       path: Path = ROLLUP_CUBE_PATH,
+                       shared: bool = True) -> RollupCube:
+    """
+    Rolls up newly materialized metrics and merges them into the last
+    cube, saved in `path`.
+
+    With `shared`, the last cube is the one uploaded to the project, as the
+    pipelines run on machines that do not keep `path` between runs, and
+    the updated cube is uploaded back for the dashboard.
+
+    Returns:
+        RollupCube: the updated cube
+    """
+    dataset_api = get_dataset_api() if shared else None
+
+    cube = RollupCube.from_metrics(metrics, zone_lookup)
+    previous = download_rollup_cube(Path(path).parent, dataset_api) if shared else None
+    if previous is None and Path(path).exists():
+        previous = RollupCube.load(path)
+    if previous is not None:
+        cube = previous.update(cube)
+    cube.save(path)
+
+    if shared:
+        upload_rollup_cube(path, dataset_api)
+
+    return cube
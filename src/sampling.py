@@ -0,0 +1,190 @@
+"""
+Demand-aware sampling of training windows, in place of a uniform
+`step_size`.
+
+A window is identified by its location (row) and the column of its target
+hour in the (locations x hours) rides matrix of `src.data.get_ts_matrix`,
+so a sample is a pair of index arrays over the time-series data, plus the
+weight of each window. Windows are drawn independently, each with its own
+inclusion probability, and weighted by its inverse, so the weighted
+training loss is an unbiased estimate of the loss on all windows
+"""
+from datetime import datetime
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+import src.config as config
+from src.hours import HOURS_PER_WEEK, hour_of_week, to_hour_index
+
+# strategies to weight the windows within each stratum
+WEIGHT_BY_DEMAND = 'demand'
+WEIGHT_BY_ERROR = 'error'
+
+# added to the rides of every window when weighting by demand, so windows
+# with 0 rides can still be drawn
+DEMAND_OFFSET = 1.0
+
+# fraction of the mean location error added to every location's error when
+# weighting by error, for the same reason
+ERROR_FLOOR = 0.1
+
+
+def get_inclusion_probabilities(scores: np.ndarray, n: float) -> np.ndarray:
+    """
+    Probabilities proportional to `scores` that add up to `n`, capped at 1.
+    The budget of the capped items goes to the rest, in proportion to their
+    scores.
+    """
+    scores = np.maximum(np.asarray(scores, dtype=np.float64), 0)
+    probabilities = np.zeros_like(scores)
+    capped = np.zeros(len(scores), dtype=bool)
+
+    while True:
+        free = ~capped
+        budget = n - capped.sum()
+        total = scores[free].sum()
+        if budget <= 0 or total == 0:
+            break
+
+        probabilities[free] = budget * scores[free] / total
+        over = free & (probabilities >= 1)
+        if not over.any():
+            break
+        probabilities[over] = 1
+        capped |= over
+
+    return np.minimum(probabilities, 1)
+
+
+def sample_windows(matrix: np.ndarray,
+                   location_ids: np.ndarray,
+                   pickup_hours: pd.DatetimeIndex,
+                   n_windows: int,
+                   input_seq_len: int = config.N_FEATURES,
+                   stratify_by_hour_of_week: bool = True,
+                   weight_by: Optional[str] = None,
+                   errors: Optional[pd.Series] = None,
+                   recent_weeks: int = 2,
+                   cutoff_date: Optional[datetime] = None,
+                   seed: int = 0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Draws about `n_windows` training windows out of all the (location,
+    target hour) windows of `matrix`.
+
+        - the windows with a target hour in the last `recent_weeks` weeks
+          are always included, with weight 1
+        - with `stratify_by_hour_of_week`, the rest of the budget is split
+          between the 168 hours of the week in proportion to their number
+          of windows, so quiet hours keep their share of the sample
+        - within each hour of the week (or overall), windows are drawn with
+          a probability proportional to:
+            - 1 if `weight_by` is None
+            - rides at their target hour (plus DEMAND_OFFSET) with
+              `weight_by='demand'`, so busy zones and hours are sampled more
+            - the recent error of their location with `weight_by='error'`
+
+    Args:
+        matrix (np.ndarray): rides, with shape (n_locations, n_hours). Can be
+            the memory map of `src.out_of_core.load_ts_memmap`
+        location_ids (np.ndarray): pickup_location_id of each row of `matrix`
+        pickup_hours (pd.DatetimeIndex): pickup_hour of each column of `matrix`
+        n_windows (int): expected number of windows in the sample
+        input_seq_len (int): hours in each window
+        stratify_by_hour_of_week (bool): split the budget by hour of the week
+        weight_by (Optional[str]): None, 'demand' or 'error'
+        errors (Optional[pd.Series]): error of each location (e.g. MAE), by
+            pickup_location_id, for `weight_by='error'`. See
+            `src.metrics.summarize_error_metrics`
+        recent_weeks (int): weeks before the last target hour that are
+            always included
+        cutoff_date (Optional[datetime]): only windows with a target hour
+            before it are drawn, e.g. the train/test cutoff
+        seed (int): random seed
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]:
+            - row in `matrix` of each window
+            - column in `matrix` of the target hour of each window
+            - weight of each window, the inverse of its probability
+        Sorted by row and target column, so reading the windows goes
+        through the matrix in order.
+    """
+    if weight_by not in (None, WEIGHT_BY_DEMAND, WEIGHT_BY_ERROR):
+        raise ValueError(f'Unknown weight_by {weight_by!r}')
+    if weight_by == WEIGHT_BY_ERROR and errors is None:
+        raise ValueError("weight_by='error' needs the `errors` of each location")
+
+    # the same candidate windows as `get_cutoff_indices` with step_size=1
+    targets = np.arange(input_seq_len, len(pickup_hours) - 1)
+    if cutoff_date is not None:
+        targets = targets[to_hour_index(pickup_hours[targets]) < to_hour_index(cutoff_date)]
+
+    n_locations = len(location_ids)
+    probabilities = np.zeros((n_locations, len(targets)))
+    if len(targets) == 0 or n_locations == 0:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, np.array([], dtype=np.float32)
+
+    # scores of the (locations, targets) candidates
+    if weight_by == WEIGHT_BY_DEMAND:
+        scores = np.asarray(matrix[:, targets], dtype=np.float64) + DEMAND_OFFSET
+    elif weight_by == WEIGHT_BY_ERROR:
+        location_errors = errors.reindex(location_ids).to_numpy(dtype=np.float64)
+        mean_error = np.nanmean(location_errors) if np.isfinite(location_errors).any() else 1.0
+        # locations without a known error get the mean one
+        location_errors = np.where(np.isnan(location_errors), mean_error, location_errors)
+        location_errors = np.maximum(location_errors, 0) + ERROR_FLOOR * mean_error
+        scores = np.repeat(location_errors[:, None], len(targets), axis=1)
+    else:
+        scores = np.ones((n_locations, len(targets)))
+
+    is_recent = targets > targets[-1] - recent_weeks * HOURS_PER_WEEK
+    probabilities[:, is_recent] = 1
+
+    n_rest = max(n_windows - n_locations * int(is_recent.sum()), 0)
+    rest = np.flatnonzero(~is_recent)
+    if stratify_by_hour_of_week:
+        strata = hour_of_week(pickup_hours[targets[rest]])
+    else:
+        strata = np.zeros(len(rest), dtype=np.int64)
+
+    for stratum in np.unique(strata):
+        columns = rest[strata == stratum]
+        n_stratum = n_rest * len(columns) / len(rest)
+        probabilities[:, columns] = get_inclusion_probabilities(
+            scores[:, columns].ravel(), n_stratum).reshape(n_locations, len(columns))
+
+    rng = np.random.default_rng(seed)
+    is_sampled = rng.random(probabilities.shape) < probabilities
+
+    locations, columns = np.nonzero(is_sampled)
+    weights = (1 / probabilities[locations, columns]).astype(np.float32)
+
+    return locations, targets[columns], weights
+
+
+def get_features_and_target(matrix: np.ndarray,
+                            location_ids: np.ndarray,
+                            pickup_hours: pd.DatetimeIndex,
+                            locations: np.ndarray,
+                            targets: np.ndarray,
+                            input_seq_len: int = config.N_FEATURES
+                            ) -> Tuple[pd.DataFrame, pd.Series]:
+    """
+    Features and target of the windows of a sample, in the same format as
+    `transform_ts_data_into_features_and_target`, to train a model in
+    memory (pass the sample weights to `fit`)
+    """
+    lags = np.arange(input_seq_len, 0, -1)
+    x = np.asarray(matrix[locations[:, None], targets[:, None] - lags], dtype=np.float32)
+
+    features = pd.DataFrame(x, columns=[f'rides_previous_{lag}_hour' for lag in lags])
+    features['pickup_hour'] = pickup_hours[targets].values
+    features['pickup_location_id'] = location_ids[locations]
+
+    target = pd.Series(np.asarray(matrix[locations, targets], dtype=np.float32),
+                       name='target_rides_next_hour')
+
+    return features, target
@@ -0,0 +1,282 @@
+"""
+Resident scheduler that runs the feature pipeline and then the inference
+pipeline every hour, in place of the hourly notebook executions.
+
+The Hopsworks connection, feature groups, model and online buffer are loaded
+once and kept warm between runs, so each hourly run only pays for fetching
+the new data, predicting and inserting the results.
+
+Run it from the project root with:
+
+    python -m src.scheduler          # every hour, until interrupted
+    python -m src.scheduler --once   # a single run for the current hour
+"""
+import argparse
+import fcntl
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Deque, Dict, Optional, Sequence
+
+import pandas as pd
+
+import src.config as config
+from src.online_features import ONLINE_FEATURES_PATH, RideHistoryBuffer
+from src.paths import DATA_DIR, create_directories
+from src.pipelines import run_feature_pipeline, run_inference_pipeline
+
+SCHEDULER_LOCK_PATH = DATA_DIR / 'scheduler.lock'
+
+
+def get_current_hour() -> datetime:
+    """Current UTC time, floored to the hour"""
+    return pd.Timestamp.now(tz='UTC').floor('h').to_pydatetime()
+
+
+class HourlyScheduler:
+    """
+    Runs the feature and inference stages for each new hour, with warm state.
+
+    Only one run happens at a time: within the process through a lock, and
+    across processes through an exclusive lock on `lock_path`. A run that
+    finds either lock taken is skipped, not queued.
+    """
+    def __init__(self,
+                 delay: timedelta = timedelta(minutes=1),
+                 lock_path: Path = SCHEDULER_LOCK_PATH,
+                 wait_for_job: bool = False,
+                 materialize_metrics: bool = True,
+                 shadow_versions: Optional[Sequence[int]] = None,
+                 history_size: int = 24 * 7):
+        """
+        Args:
+            delay (timedelta): time after each hour boundary to start the run,
+                so the data of the hour that just finished is available
+            lock_path (Path): lockfile shared by all scheduler processes
+            wait_for_job (bool): wait for the offline materialization jobs of
+                the inserts. The online store is updated either way, so the
+                default is not to wait, which is what keeps runs short
+            materialize_metrics (bool): materialize the error metrics after
+                each run, as notebook 14 does. Timed apart from the two
+                stages, as predictions are already served by then
+            shadow_versions (Optional[Sequence[int]]): registry versions
+                scored in shadow mode on the same features as the production
+                model. Defaults to config.SHADOW_MODEL_VERSIONS
+            history_size (int): number of past run timings to keep
+        """
+        self.delay = delay
+        self.lock_path = Path(lock_path)
+        self.wait_for_job = wait_for_job
+        self.materialize_metrics = materialize_metrics
+        if shadow_versions is None:
+            shadow_versions = config.SHADOW_MODEL_VERSIONS
+        self.shadow_versions = [v for v in shadow_versions if v != config.MODEL_VERSION]
+
+        self._run_lock = threading.Lock()
+        self.timings: Deque[Dict] = deque(maxlen=history_size)
+        self.last_run_hour: Optional[datetime] = None
+
+        # warm state, loaded by `warm_up`
+        self.model = None
+        self.feature_group = None
+        self.predictions_feature_group = None
+        self.shadow_models = None
+        self.shadow_feature_group = None
+        self.online_buffer: Optional[RideHistoryBuffer] = None
+
+    def warm_up(self) -> None:
+        """
+        Logs into Hopsworks, gets the feature groups, downloads the model and
+        loads the online buffer snapshot. Called once, before the first run.
+        """
+        from src.feature_store_api import get_or_create_feature_group
+        from src.inference_1 import load_model_from_registry
+
+        start = time.perf_counter()
+        create_directories()
+
+        self.feature_group = get_or_create_feature_group(
+            name=config.FEATURE_GROUP_NAME,
+            version=config.FEATURE_GROUP_VERSION,
+            description="Time series data at hourly frequency",
+            primary_key=['pickup_location_id', 'pickup_hour'],
+            event_time='pickup_hour'
+        )
+        self.predictions_feature_group = get_or_create_feature_group(
+            name=config.FEATURE_GROUP_MODEL_PREDICTIONS,
+            version=1,
+            description="Predictions generated by our production model",
+            primary_key=['pickup_location_id', 'pickup_hour'],
+            event_time='pickup_hour'
+        )
+        self.model = load_model_from_registry()
+
+        if self.shadow_versions:
+            from src.shadow import get_shadow_predictions_feature_group, load_models_from_registry
+
+            self.shadow_models = load_models_from_registry(self.shadow_versions)
+            self.shadow_feature_group = get_shadow_predictions_feature_group()
+
+        if ONLINE_FEATURES_PATH.exists():
+            self.online_buffer = RideHistoryBuffer.load(ONLINE_FEATURES_PATH)
+
+        print(f'Scheduler warmed up in {time.perf_counter() - start:.1f}s')
+
+    def reload_model(self) -> None:
+        """Downloads the models again, eg after a new version was registered"""
+        from src.inference_1 import load_model_from_registry
+
+        with self._run_lock:
+            self.model = load_model_from_registry()
+            if self.shadow_versions:
+                from src.shadow import load_models_from_registry
+                self.shadow_models = load_models_from_registry(self.shadow_versions)
+
+    def run_once(self, current_date: Optional[datetime] = None) -> Optional[Dict]:
+        """
+        Runs the feature stage and then the inference stage for `current_date`
+        (default: the current hour).
+
+        Returns:
+            Optional[Dict]: timings of the run, in seconds. None if the run
+            was skipped because another run was in progress
+        """
+        if current_date is None:
+            current_date = get_current_hour()
+
+        if not self._run_lock.acquire(blocking=False):
+            print(f'Skipping run for {current_date}: a run is already in progress')
+            return None
+
+        try:
+            self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.lock_path, 'w') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    print(f'Skipping run for {current_date}: '
+                          f'another scheduler holds {self.lock_path}')
+                    return None
+
+                try:
+                    return self._run(current_date)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            self._run_lock.release()
+
+    def _run(self, current_date: datetime) -> Dict:
+        if self.model is None:
+            self.warm_up()
+
+        start = time.perf_counter()
+        ts_data = run_feature_pipeline(
+            current_date,
+            feature_group=self.feature_group,
+            online_buffer=self.online_buffer,
+            wait_for_job=self.wait_for_job
+        )
+        feature_seconds = time.perf_counter() - start
+
+        if self.online_buffer is None:
+            # first run without a snapshot on disk
+            self.online_buffer = RideHistoryBuffer.from_ts_data(ts_data)
+
+        start_inference = time.perf_counter()
+        predictions = run_inference_pipeline(
+            current_date,
+            model=self.model,
+            predictions_feature_group=self.predictions_feature_group,
+            online_buffer=self.online_buffer,
+            wait_for_job=self.wait_for_job,
+            shadow_models=self.shadow_models,
+            shadow_feature_group=self.shadow_feature_group
+        )
+        inference_seconds = time.perf_counter() - start_inference
+
+        # snapshot for a fast restart, outside the timed stages
+        self.online_buffer.save(ONLINE_FEATURES_PATH)
+
+        metrics_seconds = None
+        if self.materialize_metrics:
+            from src.metrics import materialize_error_metrics
+
+            start_metrics = time.perf_counter()
+            try:
+                materialize_error_metrics(current_date)
+            except Exception as e:
+                # metrics are for the monitoring dashboard, a failure
+                # here must not fail the run
+                print(f'Error metrics for {current_date} failed: {e!r}')
+            metrics_seconds = time.perf_counter() - start_metrics
+
+        timing = {
+            'pickup_hour': current_date,
+            'feature_seconds': feature_seconds,
+            'inference_seconds': inference_seconds,
+            'total_seconds': feature_seconds + inference_seconds,
+            'metrics_seconds': metrics_seconds,
+            'n_predictions': len(predictions),
+        }
+        self.timings.append(timing)
+        self.last_run_hour = current_date
+
+        print(f'Run for {current_date}: feature stage {feature_seconds:.1f}s, '
+              f'inference stage {inference_seconds:.1f}s, '
+              f'{len(predictions)} predictions')
+
+        return timing
+
+    def seconds_until_next_run(self) -> float:
+        """Seconds until the next hour boundary plus `delay`"""
+        now = datetime.now(timezone.utc)
+        next_run = get_current_hour() + self.delay
+        if next_run <= now:
+            next_run += timedelta(hours=1)
+        return (next_run - now).total_seconds()
+
+    def run_forever(self) -> None:
+        """
+        Runs once for the current hour, then once after every hour boundary.
+        Hours missed while a run was too slow, or while the machine was
+        asleep, are not replayed: the feature stage always refetches the
+        last 28 days, so the next run catches up.
+        """
+        self.warm_up()
+
+        while True:
+            current_date = get_current_hour()
+            if current_date != self.last_run_hour:
+                try:
+                    self.run_once(current_date)
+                except Exception as e:
+                    # keep the scheduler alive, the next hour retries
+                    print(f'Run for {current_date} failed: {e!r}')
+
+            time.sleep(self.seconds_until_next_run())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--once', action='store_true',
+                        help='run the pipelines for the current hour and exit')
+    parser.add_argument('--delay-minutes', type=int, default=1,
+                        help='minutes after each hour boundary to start a run')
+    parser.add_argument('--wait-for-job', action='store_true',
+                        help='wait for the offline materialization of each insert')
+    parser.add_argument('--no-metrics', action='store_true',
+                        help='do not materialize the error metrics after each run')
+    parser.add_argument('--shadow-versions', type=int, nargs='*', default=None,
+                        help='model registry versions to score in shadow mode')
+    args = parser.parse_args()
+
+    scheduler = HourlyScheduler(delay=timedelta(minutes=args.delay_minutes),
+                                wait_for_job=args.wait_for_job,
+                                materialize_metrics=not args.no_metrics,
+                                shadow_versions=args.shadow_versions)
+    if args.once:
+        scheduler.run_once()
+    else:
+        scheduler.run_forever()
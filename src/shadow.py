@@ -0,0 +1,180 @@
+"""
+Shadow scoring: several model versions from the registry score the same
+feature matrix, so a challenger can be compared with the champion on live
+data at little more than the cost of scoring one model
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, Optional, Sequence, Tuple
+
+import pandas as pd
+
+import src.config as config
+from src.model import get_model_lags, predict_features
+
+
+def load_models_from_registry(versions: Sequence[int]) -> Dict[int, object]:
+    """
+    Downloads several versions of the model, with one Hopsworks login.
+    Downloads run in parallel, as they are I/O bound.
+
+    Returns:
+        Dict[int, object]: model of each version
+    """
+    import joblib
+    from pathlib import Path
+
+    from src.inference_1 import get_hopsworks_project
+
+    model_registry = get_hopsworks_project().get_model_registry()
+
+    def _load(version: int):
+        model = model_registry.get_model(name=config.MODEL_NAME, version=version)
+        return joblib.load(Path(model.download()) / 'model.pkl')
+
+    with ThreadPoolExecutor(max_workers=max(len(versions), 1)) as executor:
+        models = list(executor.map(_load, versions))
+
+    return dict(zip(versions, models))
+
+
+def get_shared_lags(models: Dict[int, object]) -> Optional[Sequence[int]]:
+    """
+    Lags to build so every model in `models` can score the same features:
+    the union of their lag subsets, or None (all lags) if any model uses
+    all of them
+    """
+    lags = set()
+    for model in models.values():
+        model_lags = get_model_lags(model)
+        if model_lags is None:
+            return None
+        lags |= set(model_lags)
+    return sorted(lags, reverse=True)
+
+
+def score_models(models: Dict[int, object],
+                 features: pd.DataFrame,
+                 max_workers: Optional[int] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Runs every model on `features`, from a thread pool. LightGBM releases
+    the GIL while predicting, so the models run concurrently on machines
+    with cores to spare (each predict call also uses OpenMP threads).
+
+    Models share `features`: `predict_features` does not add columns to it.
+
+    Args:
+        models (Dict[int, object]): model of each version
+        features (pd.DataFrame): features with (at least) the lags of every
+            model, see `get_shared_lags`
+        max_workers (Optional[int]): number of threads. One per model if None
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]:
+            - predictions of every model, with columns `pickup_location_id`,
+              `predicted_demand`, `pickup_hour` and `model_version`
+            - latency of each model, with columns `model_version`,
+              `predict_seconds` and `n_predictions`
+    """
+    def _score(version: int) -> Tuple[pd.DataFrame, float]:
+        start = time.perf_counter()
+        predicted_demand = predict_features(models[version], features)
+        predict_seconds = time.perf_counter() - start
+
+        predictions = pd.DataFrame({
+            'pickup_location_id': features['pickup_location_id'].to_numpy(),
+            'predicted_demand': predicted_demand.round(0),
+            'pickup_hour': features['pickup_hour'].array,
+            'model_version': version,
+        })
+        return predictions, predict_seconds
+
+    versions = list(models)
+    with ThreadPoolExecutor(max_workers=max_workers or max(len(versions), 1)) as executor:
+        results = list(executor.map(_score, versions))
+
+    predictions = pd.concat([result[0] for result in results], ignore_index=True)
+    latencies = pd.DataFrame({
+        'model_version': versions,
+        'predict_seconds': [result[1] for result in results],
+        'n_predictions': [len(result[0]) for result in results],
+    })
+
+    return predictions, latencies
+
+
+def write_shadow_predictions(predictions: pd.DataFrame,
+                             latencies: pd.DataFrame,
+                             feature_group=None,
+                             wait_for_job: bool = True) -> None:
+    """
+    Inserts the tagged predictions of all models in one batch, with the
+    predict latency of their model on each row, so the latency history can
+    be read along with the predictions
+    """
+    from src.feature_store_api import delta_insert
+
+    if feature_group is None:
+        feature_group = get_shadow_predictions_feature_group()
+
+    predictions = predictions.merge(
+        latencies[['model_version', 'predict_seconds']], on='model_version', how='left')
+    delta_insert(feature_group, predictions, write_options={"wait_for_job": wait_for_job})
+
+
+def get_shadow_predictions_feature_group():
+    from src.feature_store_api import get_or_create_feature_group
+
+    return get_or_create_feature_group(
+        name=config.FEATURE_GROUP_SHADOW_PREDICTIONS,
+        version=config.FEATURE_GROUP_SHADOW_PREDICTIONS_VERSION,
+        description="Predictions of every model version scored in shadow mode",
+        primary_key=['pickup_location_id', 'pickup_hour', 'model_version'],
+        event_time='pickup_hour'
+    )
+
+
+def run_shadow_scoring(current_date: datetime,
+                       versions: Optional[Sequence[int]] = None,
+                       models: Optional[Dict[int, object]] = None,
+                       online_buffer=None,
+                       feature_group=None,
+                       wait_for_job: bool = True) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Scores `current_date` with several model versions on one feature matrix
+    and writes their tagged predictions to the shadow predictions feature
+    group.
+
+    Args:
+        current_date (datetime): hour to predict
+        versions (Optional[Sequence[int]]): registry versions to score.
+            Defaults to MODEL_VERSION plus SHADOW_MODEL_VERSIONS
+        models (Optional[Dict[int, object]]): already loaded models, by
+            version. Loaded from the registry if None
+        online_buffer: if it covers `current_date`, features are read from
+            it instead of the store
+        feature_group: shadow predictions feature group. Fetched if None
+        wait_for_job (bool): wait for the offline materialization job
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: predictions and latencies, see
+        `score_models`
+    """
+    from src.inference_1 import load_batch_of_features_from_store
+
+    if models is None:
+        if versions is None:
+            versions = [config.MODEL_VERSION] + list(config.SHADOW_MODEL_VERSIONS)
+        models = load_models_from_registry(versions)
+
+    # the feature matrix is built once, for all models
+    features = load_batch_of_features_from_store(
+        current_date, online_buffer=online_buffer, lags=get_shared_lags(models))
+
+    predictions, latencies = score_models(models, features)
+    write_shadow_predictions(predictions, latencies, feature_group, wait_for_job)
+
+    print('Shadow scoring latencies:\n' + latencies.to_string(index=False))
+
+    return predictions, latencies
@@ -0,0 +1,145 @@
+"""
+One model per segment of locations (e.g. borough or demand tier), trained in
+parallel and served behind a single predictor
+"""
+from typing import Dict, Hashable, Iterable, Optional
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, RegressorMixin
+
+from src.model import get_pipeline
+
+# segment of the locations that are not in `segments`
+OTHER_SEGMENT = 'other'
+
+
+def get_borough_segments(zone_lookup: pd.DataFrame) -> Dict[int, str]:
+    """
+    Maps each pickup_location_id to its borough
+
+    Args:
+        zone_lookup (pd.DataFrame): output of `src.data.load_taxi_zone_lookup`
+    """
+    return dict(zip(zone_lookup['pickup_location_id'].astype(int), zone_lookup['borough']))
+
+
+def get_demand_tier_segments(ts_data: pd.DataFrame, n_tiers: int = 3) -> Dict[int, str]:
+    """
+    Maps each pickup_location_id to a demand tier, from 'tier_0' (lowest
+    average hourly rides) to f'tier_{n_tiers - 1}' (highest)
+
+    Args:
+        ts_data (pd.DataFrame): columns `pickup_location_id` and `rides`
+        n_tiers (int): number of tiers, with about the same number of locations each
+    """
+    mean_rides = ts_data.groupby('pickup_location_id')['rides'].mean()
+    tiers = pd.qcut(mean_rides.rank(method='first'), q=n_tiers, labels=False)
+    return {int(location_id): f'tier_{tier}' for location_id, tier in tiers.items()}
+
+
+def _fit_one_segment(hyperparams: dict, X: pd.DataFrame, y: pd.Series):
+    pipeline = get_pipeline(**hyperparams)
+    pipeline.fit(X, y)
+    return pipeline
+
+
+class ShardedPipeline(BaseEstimator, RegressorMixin):
+    """
+    Trains one `get_pipeline(**hyperparams)` model per segment of locations,
+    in parallel processes, and routes each row to the model of its
+    `pickup_location_id` segment at prediction time.
+
+    Segments can be retrained on their own with `fit_segments`, e.g. after
+    one segment degrades, without touching the models of the other ones.
+    """
+
+    def __init__(self,
+                 segments: Dict[int, Hashable],
+                 hyperparams: Optional[dict] = None,
+                 n_jobs: int = -1):
+        """
+        Args:
+            segments (Dict[int, Hashable]): segment of each pickup_location_id.
+                Locations not in it go to the OTHER_SEGMENT
+            hyperparams (Optional[dict]): hyper-parameters of every segment model
+            n_jobs (int): number of segment models trained in parallel
+        """
+        self.segments = segments
+        self.hyperparams = hyperparams
+        self.n_jobs = n_jobs
+
+    def _segment_codes(self, location_ids: np.ndarray) -> np.ndarray:
+        """Vectorized lookup of the segment code of each row"""
+        location_ids = np.asarray(location_ids, dtype=np.int64)
+        codes = np.full(len(location_ids), len(self.segment_names_) - 1, dtype=np.int64)
+        in_range = (location_ids >= 0) & (location_ids < len(self.lookup_))
+        codes[in_range] = self.lookup_[location_ids[in_range]]
+        return codes
+
+    def _groups(self, X: pd.DataFrame):
+        """Yields (segment code, row positions) with one stable argsort"""
+        codes = self._segment_codes(X['pickup_location_id'].to_numpy())
+        order = np.argsort(codes, kind='stable')
+        boundaries = np.flatnonzero(np.diff(codes[order])) + 1
+        for positions in np.split(order, boundaries):
+            if len(positions) > 0:
+                yield codes[positions[0]], positions
+
+    def fit(self, X: pd.DataFrame, y: pd.Series) -> "ShardedPipeline":
+        # segment names, with OTHER_SEGMENT always last
+        self.segment_names_ = sorted({s for s in self.segments.values()}, key=str)
+        self.segment_names_ = (
+            [s for s in self.segment_names_ if s != OTHER_SEGMENT] + [OTHER_SEGMENT])
+        codes = {name: code for code, name in enumerate(self.segment_names_)}
+
+        # with no `segments`, every location goes to the OTHER_SEGMENT
+        max_location_id = max(max(self.segments, default=0), int(X['pickup_location_id'].max()))
+        self.lookup_ = np.full(max_location_id + 1, codes[OTHER_SEGMENT], dtype=np.int64)
+        for location_id, segment in self.segments.items():
+            self.lookup_[location_id] = codes[segment]
+
+        self.models_ = {}
+        return self.fit_segments(X, y)
+
+    def fit_segments(self,
+                     X: pd.DataFrame,
+                     y: pd.Series,
+                     segment_names: Optional[Iterable[Hashable]] = None) -> "ShardedPipeline":
+        """
+        (Re)trains the models of `segment_names` only, on the rows of `X`
+        that belong to them. All segments with rows in `X` if None.
+        """
+        refit = None if segment_names is None else set(segment_names)
+
+        jobs = []
+        for code, positions in self._groups(X):
+            name = self.segment_names_[code]
+            if refit is None or name in refit:
+                jobs.append((name, positions))
+
+        print(f'Training {len(jobs)} segment models: {[name for name, _ in jobs]}')
+        models = joblib.Parallel(n_jobs=self.n_jobs)(
+            joblib.delayed(_fit_one_segment)(
+                self.hyperparams or {}, X.iloc[positions], y.iloc[positions]
+            )
+            for _, positions in jobs
+        )
+        self.models_.update({name: model for (name, _), model in zip(jobs, models)})
+
+        return self
+
+    def predict(self, X: pd.DataFrame) -> np.ndarray:
+        predictions = np.zeros(len(X), dtype=np.float64)
+        for code, positions in self._groups(X):
+            name = self.segment_names_[code]
+            if name not in self.models_:
+                # e.g. a location we did not see in training, without an
+                # OTHER_SEGMENT model. Fall back to the biggest segment model
+                n_locations = np.bincount(self.lookup_, minlength=len(self.segment_names_))
+                name = max(self.models_,
+                           key=lambda n: n_locations[self.segment_names_.index(n)])
+            predictions[positions] = self.models_[name].predict(X.iloc[positions])
+
+        return predictions
@@ -22,8 +22,11 @@ from src.inference_1 import(
     get_model_predictions
 )
 
+import src.config as config
+from src.hours import to_hour_index
+from src.map_payload import ZoneMapPayloads
 from src.paths import DATA_DIR
-from src.plot import plot_one_sample
+from src.plot import plot_top_samples
 
 st.set_page_config(layout="wide")
 
@@ -53,6 +56,7 @@ def load_shape_data_file():
     # download zip file
     URL = 'https://d37ci6vzurychx.cloudfront.net/misc/taxi_zones.zip'
     response = requests.get(url=URL)
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
     path = DATA_DIR / f'taxi_zones.zip'
     if response.status_code == 200:
         open(path, "wb").write(response.content)
@@ -66,6 +70,13 @@ def load_shape_data_file():
     # load and return shape file
     return gpd.read_file(DATA_DIR / 'taxi_zones/taxi_zones.shp').to_crs('epsg:4326')
 
+@st.cache_resource
+def _get_map_payloads() -> ZoneMapPayloads:
+    """Shape data and map payloads, shared by all the sessions of the app,
+    so the shape file is downloaded and serialized only once per process
+    """
+    return ZoneMapPayloads(load_shape_data_file())
+
 @st.cache_data
 def _load_batch_of_features_from_store(current_date: datetime) -> pd.DataFrame:
     """Wrapped versioin of src.inference_1.load_batch_of_features_from_store, so
@@ -108,7 +119,7 @@ def _load_predictions_from_store(
 
 
 with st.spinner(text="Downloading shape file to plot taxi zones"):
-    geo_df = load_shape_data_file()
+    map_payloads = _get_map_payloads()
     st.sidebar.write('✅ Shape file was downloaded')
     progress_bar.progress(1/N_STEPS)
 
@@ -122,17 +133,18 @@ with st.spinner(text="Fetching model predictions from store"):
 
 # Here we are checking the predictions for the current hour 
 # that have already been computed and are available
+prediction_hours = to_hour_index(predictions_df['pickup_hour'])
 next_hour_predictions_ready = \
-    False if predictions_df[predictions_df.pickup_hour == current_date].empty else True
+    bool((prediction_hours == to_hour_index(current_date)).any())
 prev_hour_predictions_ready = \
-    False if predictions_df[predictions_df.pickup_hour == (current_date - timedelta(hours=1))].empty else True
+    bool((prediction_hours == to_hour_index(current_date) - 1).any())
 
 if next_hour_predictions_ready:
     # predictions for the current hour are available
-    predictions_df = predictions_df[predictions_df.pickup_hour == current_date]
+    predictions_df = predictions_df[prediction_hours == to_hour_index(current_date)]
 elif prev_hour_predictions_ready:
     # predictions for current hour are not available, so we use previous hour predictions
-    predictions_df = predictions_df[predictions_df.pickup_hour == (current_date - timedelta(hours=1))]
+    predictions_df = predictions_df[prediction_hours == to_hour_index(current_date) - 1]
     current_date = current_date - timedelta(hours=1)
     st.subheader('⚠️ Predictions for current hour not available, using previous hour predictions')
 else:
@@ -140,27 +152,7 @@ else:
                     Is your feature pipeline up and running? 🤔')
 
 with st.spinner(text="Preparing data to plot"):
-
-    def pseudocolor(val, minval, maxval, startcolor, stopcolor):
-        """
-        Convert value in the range minval..maxval to a color in the range
-        startcolor to stopcolor. The colors passed and the one returned are
-        composed of a sequence of N component values.
-        
-        Credis to https://stackoverflow.com/a/10987855
-        """
-        f = float(val - minval) / (maxval - minval)
-        return tuple(f*(b-a)+a for (a, b) in zip(startcolor, stopcolor))
-    
-    df = pd.merge(geo_df, predictions_df, 
-                  right_on='pickup_location_id', 
-                  left_on='LocationID',
-                  how='inner')
-
-    BLACK, GREEN = (0, 0, 0), (0, 255, 0)
-    df['color_scaling'] = df['predicted_demand']
-    max_pred, min_pred = df['color_scaling'].max(), df['color_scaling'].min()
-    df['fill_color'] = df['color_scaling'].apply(lambda x: pseudocolor(x, min_pred, max_pred, BLACK, GREEN))
+    map_data = map_payloads.get(current_date, config.MODEL_VERSION, predictions_df)
     progress_bar.progress(3/N_STEPS)
 
 with st.spinner(text="Generating NYC Map"):
@@ -176,20 +168,20 @@ with st.spinner(text="Generating NYC Map"):
 
     geojson = pdk.Layer(
         "GeoJsonLayer",
-        df,
+        map_data,
         opacity=0.25,
         stroked=False,
         filled=True,
         extruded=False,
         wireframe=True,
         get_elevation=10,
-        get_fill_color='fill_color',
+        get_fill_color='properties.fill_color',
         get_line_color=[255, 255, 255],
         auto_highight=True,
         pickable=True
     )
 
-    tooltip = {"html": "<b>Zone:</b> [{LocationID}] {zone} <br /> <b>Predicted rides:</b> {predicted_demand}"}
+    tooltip = {"html": "<b>Zone:</b> [{properties.LocationID}] {properties.zone} <br /> <b>Predicted rides:</b> {properties.predicted_demand}"}
 
     r = pdk.Deck(
         layers=[geojson],
@@ -206,17 +198,14 @@ with st.spinner(text="Fetcing batch of features used in the last run"):
     progress_bar.progress(5/N_STEPS)
 
 with st.spinner(text="Plotting time-series data"):
-    row_indices = np.argsort(predictions_df['predicted_demand'].values)[::-1]
     n_to_plot = 10
 
-    # plot each time-series with the prediction
-    for row_id in row_indices[:n_to_plot]:
-        fig = plot_one_sample(
-            features=features_df,
-            targets=predictions_df['predicted_demand'],
-            example_id=row_id,
-            predictions=pd.Series(predictions_df['predicted_demand'])
-        )
-        st.plotly_chart(fig, theme='streamlit', use_container_width=True, width='stretch')
-
-    progress_bar.progress(6/N_STEPS)
\ No newline at end of file
+    # one faceted figure with the top locations by predicted demand
+    fig = plot_top_samples(
+        features=features_df,
+        predictions=predictions_df['predicted_demand'],
+        n_to_plot=n_to_plot
+    )
+    st.plotly_chart(fig, theme='streamlit', use_container_width=True, width='stretch')
+
+    progress_bar.progress(6/N_STEPS)
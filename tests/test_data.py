@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+
+from src.data import densify_ts_data, get_sparse_ts_data, get_ts_matrix
+
+
+def get_ts_data(n_hours: int = 48, n_locations: int = 5, tz=None) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    hours = pd.date_range('2024-01-01', periods=n_hours, freq='h', tz=tz)
+    ts_data = pd.DataFrame({
+        'pickup_hour': np.tile(hours, n_locations),
+        'pickup_location_id': np.repeat(np.arange(1, n_locations + 1), n_hours),
+        # mostly 0 rides, as most zones at night
+        'rides': rng.poisson(0.5, n_hours * n_locations),
+    })
+    # the first and last slots have rides, so the grid spans every hour
+    ts_data.loc[[0, len(ts_data) - 1], 'rides'] = 1
+    return ts_data
+
+
+def test_densify_restores_the_sparse_rows():
+    for tz in (None, 'UTC'):
+        ts_data = get_ts_data(tz=tz)
+        sparse = get_sparse_ts_data(ts_data)
+
+        assert (sparse['rides'] != 0).all()
+        assert len(sparse) == (ts_data['rides'] != 0).sum()
+        pd.testing.assert_frame_equal(densify_ts_data(sparse), ts_data)
+
+
+def test_densify_within_bounds():
+    ts_data = get_ts_data()
+    sparse = get_sparse_ts_data(ts_data)
+    hours = ts_data['pickup_hour'].drop_duplicates().sort_values()
+    location_ids = np.array([2, 3, 99])
+
+    dense = densify_ts_data(sparse, location_ids, hours.iloc[10], hours.iloc[19])
+
+    expected = ts_data[ts_data['pickup_location_id'].isin(location_ids)
+                       & ts_data['pickup_hour'].between(hours.iloc[10], hours.iloc[19])]
+    assert len(dense) == len(location_ids) * 10
+    assert (dense.loc[dense['pickup_location_id'] == 99, 'rides'] == 0).all()
+    pd.testing.assert_frame_equal(
+        dense[dense['pickup_location_id'] != 99].reset_index(drop=True),
+        expected.reset_index(drop=True))
+
+
+def test_ts_matrix_reads_sparse_and_dense_data_the_same():
+    ts_data = get_ts_data()
+    dense_matrix, dense_ids, dense_hours = get_ts_matrix(ts_data)
+    sparse_matrix, sparse_ids, sparse_hours = get_ts_matrix(
+        get_sparse_ts_data(ts_data).sample(frac=1, random_state=0))
+
+    np.testing.assert_array_equal(sparse_matrix, dense_matrix)
+    np.testing.assert_array_equal(sparse_ids, dense_ids)
+    assert sparse_hours.equals(dense_hours)
@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.feature_store_api import (
+    _load_write_digest,
+    compute_partition_digests,
+    delta_insert,
+    get_changed_rows,
+)
+
+
+def get_ts_data(n_hours: int = 6, n_locations: int = 3) -> pd.DataFrame:
+    hours = pd.date_range('2024-01-01', periods=n_hours, freq='h', tz='UTC')
+    return pd.DataFrame({
+        'pickup_hour': np.repeat(hours, n_locations),
+        'pickup_location_id': np.tile(np.arange(1, n_locations + 1), n_hours),
+        'rides': np.arange(n_hours * n_locations),
+    })
+
+
+class FakeFeatureGroup:
+    """Records the inserted frames, and fails the inserts of `failing_hours`"""
+
+    name, version = 'fake', 1
+
+    def __init__(self, failing_hours=()):
+        self.failing_hours = set(failing_hours)
+        self.inserted = []
+        self.materialization_job = self
+
+    def insert(self, df, write_options=None):
+        if self.failing_hours & set(df['pickup_hour']):
+            raise ConnectionError('insert failed')
+        self.inserted.append(df)
+
+    def run(self, await_termination=True):
+        pass
+
+
+def test_partition_digests_do_not_depend_on_row_order():
+    df = get_ts_data()
+    keys, digests, _ = compute_partition_digests(df)
+    shuffled_keys, shuffled_digests, _ = compute_partition_digests(df.sample(frac=1, random_state=0))
+
+    np.testing.assert_array_equal(keys, shuffled_keys)
+    np.testing.assert_array_equal(digests, shuffled_digests)
+
+
+def test_get_changed_rows():
+    df = get_ts_data()
+    keys, digests, _ = compute_partition_digests(df)
+
+    changed_rows, changed_keys, _ = get_changed_rows(df, keys, digests)
+    assert changed_rows.empty and len(changed_keys) == 0
+
+    # one changed hour and one new hour
+    new_hour = df['pickup_hour'].max() + pd.Timedelta(hours=1)
+    updated = pd.concat([
+        df.assign(rides=np.where(df['pickup_hour'] == df['pickup_hour'].min(), -1, df['rides'])),
+        pd.DataFrame({'pickup_hour': [new_hour], 'pickup_location_id': [1], 'rides': [0]}),
+    ], ignore_index=True)
+
+    changed_rows, changed_keys, changed_digests = get_changed_rows(updated, keys, digests)
+    assert set(changed_rows['pickup_hour']) == {df['pickup_hour'].min(), new_hour}
+    assert len(changed_keys) == len(changed_digests) == 2
+
+    # without a previous digest every row is new
+    changed_rows, _, _ = get_changed_rows(
+        df, np.array([], dtype=np.int64), np.array([], dtype=np.uint64))
+    assert len(changed_rows) == len(df)
+
+
+def test_delta_insert_writes_only_changed_partitions(tmp_path):
+    df = get_ts_data()
+    digest_path = tmp_path / 'digest.npz'
+    fg = FakeFeatureGroup()
+
+    assert len(delta_insert(fg, df, digest_path=digest_path, shared=False)) == len(df)
+    assert delta_insert(fg, df, digest_path=digest_path, shared=False).empty
+
+    updated = df.assign(rides=np.where(df['pickup_location_id'] == 1, -1, df['rides']))
+    inserted = delta_insert(fg, updated.iloc[:3], digest_path=digest_path, shared=False)
+    assert len(inserted) == 3
+    assert len(fg.inserted) == 2
+
+
+def test_delta_insert_keeps_digests_of_written_chunks_after_a_failure(tmp_path):
+    df = get_ts_data()
+    digest_path = tmp_path / 'digest.npz'
+    failing_hour = df['pickup_hour'].iloc[-1]
+    fg = FakeFeatureGroup(failing_hours=[failing_hour])
+
+    # one chunk per hour, the last one fails
+    with pytest.raises(ConnectionError):
+        delta_insert(fg, df, chunk_size=3, n_jobs=2, digest_path=digest_path, shared=False)
+
+    keys, _ = _load_write_digest(digest_path)
+    written_hours = pd.DatetimeIndex(keys).tz_localize('UTC')
+    assert failing_hour not in written_hours
+    assert len(written_hours) == df['pickup_hour'].nunique() - 1
+
+    # the next call only retries the hour that failed
+    fg.failing_hours.clear()
+    retried = delta_insert(fg, df, chunk_size=3, digest_path=digest_path, shared=False)
+    assert set(retried['pickup_hour']) == {failing_hour}
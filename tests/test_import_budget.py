@@ -0,0 +1,21 @@
+from src.import_budget import IMPORT_TIME_BUDGETS_MS, check_import_budgets
+from src.paths import PARENT_DIR
+
+# streamlit apps import streamlit on purpose, the training-only modules
+# import sklearn and lightgbm at the top and are not imported by the apps or pipelines,
+# and the checker itself is not imported by anything else
+UNBUDGETED_MODULES = {
+    'src.__init__', 'src.import_budget',
+    'src.frontend', 'src.frontend_monitoring', 'src.simple_frontend',
+    'src.sharded_model', 'src.out_of_core',
+}
+
+
+def test_every_module_has_a_budget():
+    modules = {f'src.{path.stem}' for path in (PARENT_DIR / 'src').glob('*.py')}
+    missing = sorted(modules - UNBUDGETED_MODULES - set(IMPORT_TIME_BUDGETS_MS))
+    assert missing == [], f'add {missing} to IMPORT_TIME_BUDGETS_MS'
+
+
+def test_import_budgets():
+    assert check_import_budgets() == []
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import src.config as config
+from src.data import transform_ts_data_into_features_and_target
+from src.model import get_features_from_lag_matrix, get_pipeline, predict_features
+from src.online_features import RideHistoryBuffer
+
+
+@pytest.fixture(scope='module')
+def ts_data() -> pd.DataFrame:
+    rng = np.random.default_rng(1)
+    n_hours, n_locations = config.N_FEATURES + 24 * 5, 10
+    hours = pd.date_range('2024-01-01', periods=n_hours, freq='h')
+    return pd.DataFrame({
+        'pickup_hour': np.tile(hours, n_locations),
+        'pickup_location_id': np.repeat(np.arange(1, n_locations + 1), n_hours),
+        'rides': rng.poisson(5, n_hours * n_locations),
+    })
+
+
+@pytest.fixture(scope='module')
+def training_data(ts_data):
+    return transform_ts_data_into_features_and_target(
+        ts_data, input_seq_len=config.N_FEATURES, step_size=24)
+
+
+@pytest.mark.parametrize('lags', [None, [1, 2, 3, 24]])
+def test_predict_features_matches_pipeline_predict(ts_data, training_data, lags):
+    features, targets = training_data
+    pipeline = get_pipeline(lags=lags, n_estimators=10, verbose=-1).fit(features.copy(), targets)
+
+    np.testing.assert_array_equal(predict_features(pipeline, features),
+                                  pipeline.predict(features.copy()))
+
+    # on the float32 features the online buffer serves
+    online_features = RideHistoryBuffer.from_ts_data(ts_data).get_features()
+    np.testing.assert_array_equal(predict_features(pipeline, online_features),
+                                  pipeline.predict(online_features.copy()))
+
+
+def test_predict_features_does_not_modify_the_features(training_data):
+    features, targets = training_data
+    pipeline = get_pipeline(n_estimators=10, verbose=-1).fit(features.copy(), targets)
+    columns = list(features.columns)
+
+    predict_features(pipeline, features)
+    assert list(features.columns) == columns
+
+
+def test_predict_features_falls_back_to_predict(training_data):
+    features, targets = training_data
+    # a booster trained on other columns than `get_model_input_columns`
+    renamed = features.rename(columns={'pickup_location_id': 'location_id'})
+    pipeline = get_pipeline(n_estimators=10, verbose=-1).fit(renamed.copy(), targets)
+
+    class Model:
+        def __init__(self):
+            self.calls = 0
+
+        def predict(self, X):
+            self.calls += 1
+            return pipeline.predict(X.rename(columns={'pickup_location_id': 'location_id'}))
+
+    model = Model()
+    model.steps = pipeline.steps
+    np.testing.assert_array_equal(predict_features(model, features),
+                                  pipeline.predict(renamed.copy()))
+    assert model.calls == 1
+
+
+def test_features_from_lag_matrix_are_a_view():
+    lag_values = np.ones((3, 4), dtype=np.float32)
+    features = get_features_from_lag_matrix(lag_values, [4, 3, 2, 1], np.arange(1, 4),
+                                            pd.Timestamp('2024-01-01'))
+
+    assert list(features.columns[:4]) == [f'rides_previous_{lag}_hour' for lag in [4, 3, 2, 1]]
+    assert np.shares_memory(features.iloc[:, :4].to_numpy(), lag_values)
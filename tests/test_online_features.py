@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+
+from src.data import transform_ts_data_into_features_and_target
+from src.online_features import RideHistoryBuffer
+
+N_HOURS = 4
+
+
+def get_ts_data(n_hours: int, location_ids=(1, 2, 3)) -> pd.DataFrame:
+    hours = pd.date_range('2024-01-01', periods=n_hours, freq='h')
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'pickup_hour': np.tile(hours, len(location_ids)),
+        'pickup_location_id': np.repeat(location_ids, n_hours),
+        'rides': rng.integers(0, 20, n_hours * len(location_ids)),
+    })
+
+
+def test_features_match_the_training_features():
+    # one training example per location, with its target in hour N_HOURS
+    # (get_cutoff_indices leaves the last hour out)
+    ts_data = get_ts_data(N_HOURS + 2)
+    features, _ = transform_ts_data_into_features_and_target(
+        ts_data, input_seq_len=N_HOURS, step_size=1)
+
+    target_hour = features['pickup_hour'].iloc[0]
+    buffer = RideHistoryBuffer.from_ts_data(ts_data[ts_data['pickup_hour'] < target_hour], N_HOURS)
+    online_features = buffer.get_features(target_hour)
+
+    lag_columns = [c for c in features.columns if c.startswith('rides_previous_')]
+    assert list(online_features.columns) == list(features.columns)
+    np.testing.assert_array_equal(online_features[lag_columns], features[lag_columns])
+    assert (online_features['pickup_hour'] == target_hour).all()
+
+
+def test_updates_wrap_around_the_buffer():
+    ts_data = get_ts_data(3 * N_HOURS + 1)
+    first_hour = ts_data['pickup_hour'].min()
+
+    buffer = RideHistoryBuffer.from_ts_data(ts_data[ts_data['pickup_hour'] == first_hour], N_HOURS)
+    buffer.update_from_ts_data(ts_data[ts_data['pickup_hour'] > first_hour])
+
+    expected = RideHistoryBuffer.from_ts_data(ts_data, N_HOURS)
+    assert buffer.last_pickup_hour == expected.last_pickup_hour
+    np.testing.assert_array_equal(buffer.get_lag_matrix(), expected.get_lag_matrix())
+
+
+def test_skipped_hours_and_late_data():
+    ts_data = get_ts_data(N_HOURS)
+    buffer = RideHistoryBuffer.from_ts_data(ts_data, N_HOURS)
+    last_hour = buffer.last_pickup_hour
+
+    # two hours ahead: the hour in between has 0 rides
+    buffer.update(last_hour + pd.Timedelta(hours=2), np.array([1]), np.array([5]))
+    np.testing.assert_array_equal(buffer.get_lag_matrix()[:, -2:], [[0, 5], [0, 0], [0, 0]])
+
+    # late rides for the skipped hour overwrite it
+    buffer.update(last_hour + pd.Timedelta(hours=1), np.array([2]), np.array([7]))
+    np.testing.assert_array_equal(buffer.get_lag_matrix()[:, -2:], [[0, 5], [7, 0], [0, 0]])
+
+    # new locations get a row of their own
+    buffer.update(last_hour + pd.Timedelta(hours=2), np.array([9]), np.array([1]))
+    assert 9 in buffer.location_ids
+
+
+def test_covers():
+    buffer = RideHistoryBuffer.from_ts_data(get_ts_data(N_HOURS), N_HOURS)
+    next_hour = buffer.last_pickup_hour + pd.Timedelta(hours=1)
+
+    assert buffer.covers(next_hour)
+    assert buffer.covers(next_hour.tz_localize('UTC'))
+    assert not buffer.covers(next_hour + pd.Timedelta(hours=1))
+    assert not RideHistoryBuffer(np.array([1]), N_HOURS).covers(next_hour)
+
+
+def test_save_and_load(tmp_path):
+    buffer = RideHistoryBuffer.from_ts_data(get_ts_data(N_HOURS + 2), N_HOURS)
+    buffer.save(tmp_path / 'buffer.npz')
+    loaded = RideHistoryBuffer.load(tmp_path / 'buffer.npz')
+
+    pd.testing.assert_frame_equal(loaded.get_features(), buffer.get_features())
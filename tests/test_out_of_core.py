@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+
+import src.config as config
+from src.data import transform_ts_data_into_features_and_target
+from src.model import REQUIRED_LAGS, get_pipeline
+from src.out_of_core import (
+    LagWindowSequence,
+    get_window_grid,
+    get_window_targets,
+    load_ts_memmap,
+    train_out_of_core,
+    write_ts_memmap,
+)
+
+STEP_SIZE = 24
+
+
+def get_ts_data(n_hours: int = config.N_FEATURES + 24 * 3, n_locations: int = 3) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    hours = pd.date_range('2024-01-01', periods=n_hours, freq='h')
+    return pd.DataFrame({
+        'pickup_hour': np.tile(hours, n_locations),
+        'pickup_location_id': np.repeat(np.arange(1, n_locations + 1), n_hours),
+        'rides': rng.poisson(5, n_hours * n_locations),
+    })
+
+
+def test_window_targets_match_the_training_windows(tmp_path):
+    ts_data = get_ts_data()
+    features, targets = transform_ts_data_into_features_and_target(
+        ts_data, input_seq_len=config.N_FEATURES, step_size=STEP_SIZE)
+
+    matrix, location_ids, pickup_hours = load_ts_memmap(write_ts_memmap(ts_data, tmp_path / 'ts.npy'))
+    window_targets = get_window_targets(len(pickup_hours), config.N_FEATURES, STEP_SIZE)
+    locations, columns = get_window_grid(len(location_ids), window_targets)
+
+    np.testing.assert_array_equal(location_ids[locations], features['pickup_location_id'])
+    np.testing.assert_array_equal(pickup_hours[columns], features['pickup_hour'])
+    np.testing.assert_array_equal(matrix[locations, columns], targets)
+
+
+def test_window_rows_match_the_pipeline_input(tmp_path):
+    ts_data = get_ts_data()
+    features, targets = transform_ts_data_into_features_and_target(
+        ts_data, input_seq_len=config.N_FEATURES, step_size=STEP_SIZE)
+
+    matrix, location_ids, pickup_hours = load_ts_memmap(write_ts_memmap(ts_data, tmp_path / 'ts.npy'))
+    windows = get_window_grid(
+        len(location_ids), get_window_targets(len(pickup_hours), config.N_FEATURES, STEP_SIZE))
+
+    for lags in (None, [1, 2, 3, 24]):
+        pipeline = get_pipeline(lags=lags)
+        # what the LGBMRegressor of the pipeline is fitted on
+        expected = pipeline[:-1].fit_transform(features.copy())
+
+        window_lags = sorted(set(lags) | set(REQUIRED_LAGS)) if lags else range(1, config.N_FEATURES + 1)
+        rows = LagWindowSequence(matrix, location_ids, pickup_hours, *windows, window_lags,
+                                 batch_size=4)
+
+        assert rows.feature_names == list(expected.columns)
+        np.testing.assert_allclose(rows[0:len(rows)], expected.to_numpy(dtype=np.float64))
+        np.testing.assert_array_equal(rows.get_labels(), targets)
+
+
+def test_booster_regressor_fits_the_given_rows(tmp_path):
+    ts_data = get_ts_data()
+    features, targets = transform_ts_data_into_features_and_target(
+        ts_data, input_seq_len=config.N_FEATURES, step_size=1)
+    hyperparams = {'n_estimators': 5, 'verbose': -1}
+
+    pipeline, _ = train_out_of_core(features['pickup_hour'].max(),
+                                    write_ts_memmap(ts_data, tmp_path / 'ts.npy'),
+                                    step_size=1, **hyperparams)
+    refitted = pipeline.fit(features.copy(), targets)
+    expected = get_pipeline(**hyperparams).fit(features.copy(), targets)
+
+    np.testing.assert_allclose(refitted.predict(features.copy()), expected.predict(features.copy()))
@@ -0,0 +1,114 @@
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.model import get_features_from_lag_matrix
+from src.prediction_cache import HourlyCache, PredictionCache
+
+
+class Clock:
+    def __init__(self, now: str):
+        self.now = pd.Timestamp(now, tz='UTC')
+
+    def __call__(self) -> pd.Timestamp:
+        return self.now
+
+
+class Counter:
+    """`compute` function that counts its calls"""
+
+    def __init__(self, delay: float = 0):
+        self.calls = 0
+        self.delay = delay
+        self._lock = threading.Lock()
+
+    def __call__(self) -> pd.DataFrame:
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        return pd.DataFrame({'value': [self.calls]})
+
+
+def test_entries_expire_at_the_next_hour(tmp_path):
+    for cache_dir in (None, tmp_path):
+        clock = Clock('2024-03-01 10:20')
+        cache = HourlyCache(cache_dir=cache_dir, clock=clock)
+        compute = Counter()
+
+        cache.get(('key',), compute)
+        clock.now = pd.Timestamp('2024-03-01 10:59:59', tz='UTC')
+        cache.get(('key',), compute)
+        assert compute.calls == 1
+
+        clock.now = pd.Timestamp('2024-03-01 11:00', tz='UTC')
+        cache.get(('key',), compute)
+        assert compute.calls == 2
+
+
+def test_disk_entries_are_shared(tmp_path):
+    clock = Clock('2024-03-01 10:20')
+    compute = Counter()
+
+    HourlyCache(cache_dir=tmp_path, clock=clock).get(('key',), compute)
+    cache = HourlyCache(cache_dir=tmp_path, clock=clock)
+    value = cache.get(('key',), compute)
+
+    assert compute.calls == 1
+    assert cache.stats == {'memory': 0, 'disk': 1, 'computed': 0}
+    pd.testing.assert_frame_equal(value, pd.DataFrame({'value': [1]}))
+
+
+def test_single_flight(tmp_path):
+    for cache_dir in (None, tmp_path):
+        cache = HourlyCache(cache_dir=cache_dir, clock=Clock('2024-03-01 10:20'))
+        compute = Counter(delay=0.1)
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get(('key',), compute)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert compute.calls == 1
+        assert all(result is results[0] for result in results)
+
+
+def test_is_cacheable():
+    cache = HourlyCache(cache_dir=None, clock=Clock('2024-03-01 10:20'))
+    compute = Counter()
+
+    cache.get(('key',), compute, is_cacheable=lambda value: False)
+    cache.get(('key',), compute, is_cacheable=lambda value: False)
+    assert compute.calls == 2
+
+    cache.get(('key',), compute, is_cacheable=lambda value: True)
+    cache.get(('key',), compute, is_cacheable=lambda value: True)
+    assert compute.calls == 3
+
+
+def test_stale_features_are_not_cached(tmp_path):
+    cache = PredictionCache(cache_dir=tmp_path, clock=Clock('2024-03-01 10:20'))
+    pickup_hour = pd.Timestamp('2024-03-01 10:00', tz='UTC')
+    calls = []
+
+    def load_features(last_hour):
+        def load(current_date):
+            calls.append(current_date)
+            return get_features_from_lag_matrix(np.ones((3, 4), dtype=np.float32), [4, 3, 2, 1],
+                                                np.arange(1, 4), last_hour)
+        return load
+
+    # the feature pipeline has not written the last hour yet
+    stale = load_features(pickup_hour - pd.Timedelta(hours=1))
+    cache.get_features(pickup_hour, stale)
+    cache.get_features(pickup_hour, stale)
+    assert len(calls) == 2
+
+    fresh = load_features(pickup_hour)
+    cache.get_features(pickup_hour, fresh)
+    cache.get_features(pickup_hour, fresh)
+    assert len(calls) == 3
@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+
+from src.metrics import ALL_LOCATIONS, compute_error_metrics, summarize_error_metrics
+from src.rollup import RollupCube, update_rollup_cube
+
+N_LOCATIONS = 20
+HOURS = pd.date_range('2024-01-01', periods=12, freq='h', tz='UTC')
+
+
+def get_zone_lookup() -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    zone_lookup = pd.DataFrame({
+        'pickup_location_id': np.arange(1, N_LOCATIONS + 1),
+        'borough': rng.choice(['Manhattan', 'Brooklyn', 'Queens'], N_LOCATIONS),
+        'zone': 'zone',
+        'service_zone': rng.choice(['Yellow Zone', 'Boro Zone'], N_LOCATIONS),
+    })
+    # zones without a borough are rolled up into UNKNOWN_GROUP
+    zone_lookup.loc[0, 'borough'] = None
+    return zone_lookup
+
+
+def get_metrics(hours: pd.DatetimeIndex = HOURS, offset: float = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(1)
+    n_rows = N_LOCATIONS * len(hours)
+    monitoring_df = pd.DataFrame({
+        'pickup_location_id': np.tile(np.arange(1, N_LOCATIONS + 1), len(hours)),
+        'pickup_hour': np.repeat(hours, N_LOCATIONS),
+        'rides': rng.poisson(5, n_rows).astype(float),
+        'predicted_demand': rng.poisson(5, n_rows).astype(float) + offset,
+    })
+    return compute_error_metrics(monitoring_df)
+
+
+def test_query_matches_a_group_by():
+    zone_lookup = get_zone_lookup()
+    metrics = get_metrics()
+    cube = RollupCube.from_metrics(metrics, zone_lookup)
+
+    rollup = cube.query('borough', by_hour=False).set_index('group')
+    zone_metrics = metrics[metrics['pickup_location_id'] != ALL_LOCATIONS].merge(
+        zone_lookup.fillna({'borough': 'Unknown'}), on='pickup_location_id')
+    expected = summarize_error_metrics(zone_metrics, by=['borough']).set_index('borough')
+
+    assert sorted(rollup.index) == sorted(expected.index)
+    for column in ['rides', 'mae', 'mape', 'bias']:
+        np.testing.assert_allclose(rollup[column], expected.loc[rollup.index, column])
+
+    # the city level adds up to the ALL_LOCATIONS rows
+    city = cube.query('city')
+    all_locations = metrics[metrics['pickup_location_id'] == ALL_LOCATIONS].sort_values('pickup_hour')
+    np.testing.assert_allclose(city['mae'], all_locations['mae'])
+
+
+def test_query_hour_range():
+    cube = RollupCube.from_metrics(get_metrics(), get_zone_lookup())
+
+    rollup = cube.query('borough', 'Manhattan', HOURS[3], HOURS[5])
+    assert list(rollup['pickup_hour']) == list(HOURS[3:6])
+    assert cube.query('borough', from_hour=HOURS[-1] + pd.Timedelta(hours=1)).empty
+
+
+def test_update_overwrites_the_hours_of_the_new_cube():
+    zone_lookup = get_zone_lookup()
+    old = get_metrics(HOURS[:8])
+    new = get_metrics(HOURS[4:], offset=1)
+
+    cube = RollupCube.from_metrics(old, zone_lookup).update(RollupCube.from_metrics(new, zone_lookup))
+    expected = RollupCube.from_metrics(
+        pd.concat([old[old['pickup_hour'] < HOURS[4]], new]), zone_lookup)
+
+    assert cube.groups.equals(expected.groups)
+    assert cube.first_hour == expected.first_hour
+    np.testing.assert_allclose(cube.values, expected.values)
+
+
+def test_update_merges_groups():
+    zone_lookup = get_zone_lookup()
+    metrics = get_metrics()
+    # the first cube only has the zones of one borough
+    manhattan = zone_lookup.loc[zone_lookup['borough'] == 'Manhattan', 'pickup_location_id']
+    first = RollupCube.from_metrics(metrics[metrics['pickup_location_id'].isin(manhattan)], zone_lookup)
+
+    cube = first.update(RollupCube.from_metrics(metrics, zone_lookup))
+    assert set(cube.groups) == set(RollupCube.from_metrics(metrics, zone_lookup).groups)
+
+
+def test_update_rollup_cube_saves_the_merged_cube(tmp_path):
+    zone_lookup = get_zone_lookup()
+    path = tmp_path / 'cube.npz'
+
+    update_rollup_cube(get_metrics(HOURS[:8]), zone_lookup, path, shared=False)
+    cube = update_rollup_cube(get_metrics(HOURS[4:], offset=1), zone_lookup, path, shared=False)
+
+    loaded = RollupCube.load(path)
+    assert loaded.groups.equals(cube.groups)
+    np.testing.assert_array_equal(loaded.values, cube.values)